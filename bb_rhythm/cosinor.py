@@ -0,0 +1,526 @@
+import numpy as np
+import scipy.stats
+
+
+def concatenate_series(series_lst):
+    """
+    Concatenates a list of 1d series to one flat array and the offsets of the
+    series in it, so that series i is values[offsets[i]:offsets[i + 1]].
+
+    :param series_lst: list of array-like
+    :return: (np.array, np.array of int64 with length len(series_lst) + 1)
+    """
+    offsets = np.zeros(len(series_lst) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(series) for series in series_lst])
+    if len(series_lst) == 0:
+        return np.empty(0, dtype=np.float64), offsets
+    values = np.concatenate([np.asarray(series) for series in series_lst])
+    return values, offsets
+
+
+def get_segment_ids(offsets):
+    """
+    Maps ragged offsets to the index of the series each sample belongs to.
+
+    :param offsets: np.array of length n_series + 1
+    :return: np.array of int64 with length offsets[-1]
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def get_cosinor_design(timeseries, period=24 * 60 * 60):
+    """
+    Returns the cosine and sine regressors (beta_x, gamma_x) of the cosinor model.
+
+    :param timeseries: np.array of timestamps in seconds
+    :param period: period in seconds
+    :return: (np.array, np.array)
+    """
+    timeseries = np.asarray(timeseries, dtype=np.float64)
+    beta_x = np.cos((timeseries / period) * 2.0 * np.pi)
+    gamma_x = np.sin((timeseries / period) * 2.0 * np.pi)
+    return beta_x, gamma_x
+
+
+def get_cosinor_sums(beta_x, gamma_x, velocities, segment_ids, n_segments):
+    """
+    Calculates the sufficient statistics of the cosinor least squares problem
+    per segment, i.e. X'X, X'y, y'y and the number of samples for the design
+    X = [1, beta_x, gamma_x].
+
+    :param beta_x: np.array
+    :param gamma_x: np.array
+    :param velocities: np.array
+    :param segment_ids: np.array of segment index per sample
+    :param n_segments: number of segments
+    :return: (xtx (n_segments, 3, 3), xty (n_segments, 3), yty (n_segments,), n (n_segments,))
+    """
+
+    def segment_sum(weights):
+        return np.bincount(segment_ids, weights=weights, minlength=n_segments)
+
+    n = np.bincount(segment_ids, minlength=n_segments).astype(np.float64)
+    sum_b = segment_sum(beta_x)
+    sum_g = segment_sum(gamma_x)
+    sum_bb = segment_sum(beta_x * beta_x)
+    sum_gg = segment_sum(gamma_x * gamma_x)
+    sum_bg = segment_sum(beta_x * gamma_x)
+    xtx = np.stack(
+        [
+            np.stack([n, sum_b, sum_g], axis=-1),
+            np.stack([sum_b, sum_bb, sum_bg], axis=-1),
+            np.stack([sum_g, sum_bg, sum_gg], axis=-1),
+        ],
+        axis=-2,
+    )
+    xty = np.stack(
+        [
+            segment_sum(velocities),
+            segment_sum(beta_x * velocities),
+            segment_sum(gamma_x * velocities),
+        ],
+        axis=-1,
+    )
+    yty = segment_sum(velocities * velocities)
+    return xtx, xty, yty, n
+
+
+def solve_cosinor_normal_equations(xtx, xty, n):
+    """
+    Solves a stack of cosinor normal equations. Segments with less than four
+    samples or a singular design get NaN parameters.
+
+    :param xtx: np.array of shape (N, 3, 3)
+    :param xty: np.array of shape (N, 3)
+    :param n: np.array of shape (N,)
+    :return: (params (N, 3), xtx_inv (N, 3, 3), valid (N,))
+    """
+    valid = n > 3
+    if np.any(valid):
+        valid[valid] = np.linalg.cond(xtx[valid]) < 1 / np.finfo(np.float64).eps
+    xtx_safe = np.where(valid[:, None, None], xtx, np.eye(3))
+    xtx_inv = np.linalg.inv(xtx_safe)
+    params = np.einsum("nij,nj->ni", xtx_inv, xty)
+    params[~valid] = np.nan
+    xtx_inv[~valid] = np.nan
+    return params, xtx_inv, valid
+
+
+def get_acrophase(beta, gamma):
+    """
+    Calculates the acrophase in [-pi, pi] from the cosine and sine coefficients
+    the same way as rhythm.derive_cosine_parameter_from_cosinor.
+
+    :param beta: np.array
+    :param gamma: np.array
+    :return: np.array
+    """
+    acrophase = np.mod(-np.arctan2(gamma, beta), 2 * np.pi)
+    return np.where(acrophase > np.pi, acrophase - 2 * np.pi, acrophase)
+
+
+def get_cosinor_inference_batch(params, cov_params, alpha=0.05):
+    """
+    Derives mesor, amplitude and acrophase of many cosinor fits together with
+    their confidence intervals and p-values (z-test) from the delta method, the
+    same way as rhythm.derive_cosine_parameter_from_cosinor and
+    rhythm.get_significance_values_cosinor.
+
+    :param params: np.array of shape (N, 3) with (mesor, beta, gamma) per fit
+    :param cov_params: np.array of shape (N, 3, 3), covariance of the params
+    :param alpha: significance level of the confidence intervals
+    :return: dict of np.arrays of shape (N,)
+    """
+    params = np.asarray(params, dtype=np.float64)
+    cov_params = np.asarray(cov_params, dtype=np.float64)
+    beta, gamma = params[:, 1], params[:, 2]
+    amplitude = np.sqrt(beta**2 + gamma**2)
+    coef = np.stack([params[:, 0], amplitude, get_acrophase(beta, gamma)], axis=1)
+
+    # jacobian of (mesor, amplitude, acrophase) with respect to the params
+    jacobian = np.zeros(cov_params.shape)
+    jacobian[:, 0, 0] = 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        jacobian[:, 1, 1] = beta / amplitude
+        jacobian[:, 1, 2] = gamma / amplitude
+        jacobian[:, 2, 1] = -gamma / amplitude**2
+        jacobian[:, 2, 2] = beta / amplitude**2
+        se = np.sqrt(
+            np.einsum("nij,njk,nik->ni", jacobian, cov_params, jacobian)
+        )
+        z = np.abs(scipy.stats.norm.ppf(alpha / 2))
+        lower = coef - np.abs(z * se)
+        upper = coef + np.abs(z * se)
+        p_values = 2 * scipy.stats.norm.cdf(-np.abs(coef / se))
+
+    data = {"mesor": coef[:, 0], "amplitude": coef[:, 1], "phase": coef[:, 2]}
+    for i, name in enumerate(["mesor", "amplitude", "acrophase"]):
+        data["p_%s" % name] = p_values[:, i]
+        data["ci_%s_lower" % name] = lower[:, i]
+        data["ci_%s_upper" % name] = upper[:, i]
+    return data
+
+
+def get_cosinor_statistics(params, xtx_inv, rss, tss, n, n_params=3):
+    """
+    Derives the cosine parameters with confidence intervals and the F-test
+    statistics of a stack of solved cosinor fits.
+
+    :param params: np.array of shape (N, 3)
+    :param xtx_inv: np.array of shape (N, 3, 3)
+    :param rss: residual sum of squares per fit
+    :param tss: centered total sum of squares per fit
+    :param n: number of samples per fit
+    :param n_params: number of model parameters
+    :return: dict
+    """
+    df_resid = n - n_params
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ess = tss - rss
+        r_squared = 1 - rss / tss
+        r_squared_adj = 1 - (n - 1) / df_resid * (1 - r_squared)
+        f_value = (ess / (n_params - 1)) / (rss / df_resid)
+        p_value = scipy.stats.f.sf(f_value, n_params - 1, df_resid)
+        cov_params = (rss / df_resid)[:, None, None] * xtx_inv
+    data = get_cosinor_inference_batch(params, cov_params)
+    data.update(
+        {
+            "p_value": p_value,
+            "f_value": f_value,
+            "r_squared": r_squared,
+            "r_squared_adj": r_squared_adj,
+            "RSS": rss,
+            "ESS": ess,
+            "n_data_points": n.astype(np.int64),
+            "params": params,
+            "cov_params": cov_params,
+        }
+    )
+    return data
+
+
+def fit_cosinor_batch(
+    timeseries, velocities, offsets, period=24 * 60 * 60, return_residuals=False
+):
+    """
+    Fits the cosinor model y ~ mesor + beta * cos(wx) + gamma * sin(wx) to many
+    ragged series at once. Series i is timeseries[offsets[i]:offsets[i + 1]] and
+    its velocities. The results are the same as those of rhythm.fit_cosinor_per_bee
+    for each series, but without building a statsmodels model per fit.
+
+    :param timeseries: concatenated timestamps in seconds, see concatenate_series
+    :param velocities: concatenated velocities without NaNs
+    :param offsets: np.array of length n_series + 1
+    :param period: period in seconds
+    :param return_residuals: if True, the concatenated residuals are returned as "resid"
+    :return: dict of np.arrays with one entry per series
+    """
+    velocities = np.asarray(velocities, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_segments = len(offsets) - 1
+    segment_ids = get_segment_ids(offsets)
+
+    # least squares via the normal equations of all fits at once
+    beta_x, gamma_x = get_cosinor_design(timeseries, period=period)
+    xtx, xty, _, n = get_cosinor_sums(
+        beta_x, gamma_x, velocities, segment_ids, n_segments
+    )
+    params, xtx_inv, valid = solve_cosinor_normal_equations(xtx, xty, n)
+
+    # residual and total sum of squares in two passes for numerical accuracy
+    sample_params = params[segment_ids]
+    resid = velocities - (
+        sample_params[:, 0]
+        + sample_params[:, 1] * beta_x
+        + sample_params[:, 2] * gamma_x
+    )
+    rss = np.bincount(segment_ids, weights=resid**2, minlength=n_segments)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y_mean = xty[:, 0] / n
+    tss = np.bincount(
+        segment_ids,
+        weights=(velocities - y_mean[segment_ids]) ** 2,
+        minlength=n_segments,
+    )
+    rss[~valid] = np.nan
+    tss[~valid] = np.nan
+
+    data = get_cosinor_statistics(params, xtx_inv, rss, tss, n)
+    if return_residuals:
+        data["resid"] = resid
+    return data
+
+
+def rotate_cosinor_parameters(params, xtx_inv, references, period=24 * 60 * 60):
+    """
+    Shifts the time origin of cosinor fits to the given reference times, i.e.
+    returns the parameters of the fits with timestamps x - reference.
+
+    :param params: np.array of shape (N, 3)
+    :param xtx_inv: np.array of shape (N, 3, 3)
+    :param references: np.array of shape (N,) in seconds
+    :param period: period in seconds
+    :return: (params (N, 3), xtx_inv (N, 3, 3))
+    """
+    beta_c, gamma_c = get_cosinor_design(references, period=period)
+    rotation = np.zeros((len(beta_c), 3, 3))
+    rotation[:, 0, 0] = 1
+    rotation[:, 1, 1] = beta_c
+    rotation[:, 1, 2] = gamma_c
+    rotation[:, 2, 1] = -gamma_c
+    rotation[:, 2, 2] = beta_c
+    params = np.einsum("nij,nj->ni", rotation, params)
+    xtx_inv = np.einsum("nij,njk,nlk->nil", rotation, xtx_inv, rotation)
+    return params, xtx_inv
+
+
+def fit_cosinor_sliding_window(
+    timeseries,
+    velocities,
+    bin_edges,
+    window_size=3,
+    references=None,
+    period=24 * 60 * 60,
+):
+    """
+    Fits the cosinor model to sliding windows of window_size consecutive bins
+    (e.g. 3 days moved by one day) using running sums of the sufficient
+    statistics. Every sample is accumulated once into its bin, each window
+    advance adds the entering bin's sums and drops the leaving bin's, so the
+    cost per window does not depend on the window length.
+
+    :param timeseries: timestamps in seconds relative to a common origin
+    :param velocities: velocities without NaNs
+    :param bin_edges: sorted bin edges in seconds relative to the same origin
+    :param window_size: number of consecutive bins per window
+    :param references: time origin per window in seconds, defaults to the window centers
+    :param period: period in seconds
+    :return: dict of np.arrays with one entry per window, see fit_cosinor_batch
+    """
+    timeseries = np.asarray(timeseries, dtype=np.float64)
+    velocities = np.asarray(velocities, dtype=np.float64)
+    bin_edges = np.asarray(bin_edges, dtype=np.float64)
+    n_bins = len(bin_edges) - 1
+    n_windows = max(n_bins - window_size + 1, 0)
+
+    # accumulate every sample once into its bin
+    bin_ids = np.searchsorted(bin_edges, timeseries, side="right") - 1
+    in_range = (bin_ids >= 0) & (bin_ids < n_bins)
+    beta_x, gamma_x = get_cosinor_design(timeseries[in_range], period=period)
+    xtx, xty, yty, n = get_cosinor_sums(
+        beta_x, gamma_x, velocities[in_range], bin_ids[in_range], n_bins
+    )
+
+    # running window sums: add the entering bin and drop the leaving bin
+    def window_sum(bin_sums):
+        cumulative = np.concatenate(
+            [np.zeros((1,) + bin_sums.shape[1:]), np.cumsum(bin_sums, axis=0)]
+        )
+        return cumulative[window_size:] - cumulative[: n_windows]
+
+    xtx, xty, yty, n = (window_sum(sums) for sums in (xtx, xty, yty, n))
+    n = np.round(n)
+    params, xtx_inv, valid = solve_cosinor_normal_equations(xtx, xty, n)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rss = np.maximum(yty - np.einsum("ni,ni->n", params, xty), 0)
+        tss = np.maximum(yty - xty[:, 0] ** 2 / n, 0)
+
+    # express parameters relative to the window references
+    if references is None:
+        references = (bin_edges[:n_windows] + bin_edges[window_size:]) / 2
+    params, xtx_inv = rotate_cosinor_parameters(
+        params, xtx_inv, np.asarray(references, dtype=np.float64), period=period
+    )
+    return get_cosinor_statistics(params, xtx_inv, rss, tss, n)
+
+
+def fit_circadian_cosine_batch(X, Y, offsets, period=24 * 60 * 60):
+    """
+    Exact least squares fits of amplitude * cos(wx + phase) + offset with
+    amplitude >= 0 and offset >= 0 to many ragged series at once, as fitted
+    iteratively by rhythm.fit_circadian_cosine. The model is solved linearly as
+    offset + beta * cos(wx) + gamma * sin(wx) with amplitude = |(beta, gamma)|
+    and phase = atan2(-gamma, beta) in [-pi, pi]. Fits with a negative offset
+    are refitted with the offset fixed to 0, which is the constrained optimum.
+    The constant and linear baselines are fitted from the same sums.
+
+    :param X: concatenated timestamps in seconds
+    :param Y: concatenated values
+    :param offsets: np.array of length n_series + 1
+    :param period: period in seconds
+    :return: dict of np.arrays with one entry per series with the keys of
+        rhythm.fit_circadian_cosine
+    """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_segments = len(offsets) - 1
+    segment_ids = get_segment_ids(offsets)
+
+    beta_x, gamma_x = get_cosinor_design(X, period=period)
+    xtx, xty, _, n = get_cosinor_sums(beta_x, gamma_x, Y, segment_ids, n_segments)
+    params, xtx_inv, valid = solve_cosinor_normal_equations(xtx, xty, n)
+
+    # offset >= 0: refit without intercept where the unconstrained offset is negative
+    constrained = valid & (params[:, 0] < 0)
+    if np.any(constrained):
+        trig_inv = np.linalg.inv(xtx[constrained][:, 1:, 1:])
+        params[constrained, 0] = 0
+        params[constrained, 1:] = np.einsum(
+            "nij,nj->ni", trig_inv, xty[constrained][:, 1:]
+        )
+        xtx_inv[constrained] = 0
+        xtx_inv[np.ix_(np.flatnonzero(constrained), [1, 2], [1, 2])] = trig_inv
+
+    sample_params = params[segment_ids]
+    y_predicted = (
+        sample_params[:, 0]
+        + sample_params[:, 1] * beta_x
+        + sample_params[:, 2] * gamma_x
+    )
+    circadian_sse = np.bincount(
+        segment_ids, weights=(y_predicted - Y) ** 2, minlength=n_segments
+    )
+
+    # constant and linear baselines
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_mean = np.bincount(segment_ids, weights=X, minlength=n_segments) / n
+        y_mean = xty[:, 0] / n
+        x_centered = X - x_mean[segment_ids]
+        y_centered = Y - y_mean[segment_ids]
+        s_xx = np.bincount(segment_ids, weights=x_centered**2, minlength=n_segments)
+        s_xy = np.bincount(
+            segment_ids, weights=x_centered * y_centered, minlength=n_segments
+        )
+        slope = s_xy / s_xx
+    intercept = y_mean - slope * x_mean
+    constant_sse = np.bincount(
+        segment_ids, weights=y_centered**2, minlength=n_segments
+    )
+    linear_sse = np.bincount(
+        segment_ids,
+        weights=(y_centered - slope[segment_ids] * x_centered) ** 2,
+        minlength=n_segments,
+    )
+
+    # covariance of (amplitude, phase, offset) by the delta method
+    amplitude = np.sqrt(params[:, 1] ** 2 + params[:, 2] ** 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        jacobian = np.zeros((n_segments, 3, 3))
+        jacobian[:, 0, 1] = params[:, 1] / amplitude
+        jacobian[:, 0, 2] = params[:, 2] / amplitude
+        jacobian[:, 1, 1] = params[:, 2] / amplitude**2
+        jacobian[:, 1, 2] = -params[:, 1] / amplitude**2
+        jacobian[:, 2, 0] = 1
+        cov = (circadian_sse / (n - 3))[:, None, None] * np.einsum(
+            "nij,njk,nlk->nil", jacobian, xtx_inv, jacobian
+        )
+        r_squared = 1.0 - (circadian_sse / constant_sse)
+        r_squared_linear = 1.0 - (circadian_sse / linear_sse)
+
+    return dict(
+        parameters=np.stack(
+            [amplitude, np.arctan2(-params[:, 2], params[:, 1]), params[:, 0]],
+            axis=-1,
+        ),
+        jacobian=cov,
+        circadian_sse=circadian_sse,
+        angular_frequency=2.0 * np.pi * 1 / period,
+        linear_parameters=np.stack([intercept, slope], axis=-1),
+        linear_sse=linear_sse,
+        constant_parameters=y_mean[:, None],
+        constant_sse=constant_sse,
+        r_squared=r_squared,
+        r_squared_linear=r_squared_linear,
+    )
+
+
+def get_cosinor_periodogram(
+    timeseries, velocities, periods, chunk_size=64, return_power_spectrum=False
+):
+    """
+    Fits the cosinor model for every candidate period to many series sharing one
+    time grid (e.g. bee-days of 1 min median velocities) and returns the period
+    with the highest explained variance (power = R²) per series. The trigonometric
+    bases are computed once per period and shared by all series, so the sums of
+    all series and periods reduce to matrix products.
+
+    :param timeseries: shared time grid in seconds, shape (T,)
+    :param velocities: np.array of shape (N, T), missing samples are NaN
+    :param periods: candidate periods in seconds, e.g. np.arange(16, 32, 1 / 60) * 3600
+    :param chunk_size: number of periods evaluated at once to bound memory
+    :param return_power_spectrum: if True, the power of all periods is returned as "power_spectrum"
+    :return: dict of np.arrays with one entry per series with the keys "period",
+        "power", "p_value" (F-test of the best period, not corrected for the scan),
+        "mesor", "amplitude" and "phase"
+    """
+    timeseries = np.asarray(timeseries, dtype=np.float64)
+    velocities = np.atleast_2d(np.asarray(velocities, dtype=np.float64))
+    periods = np.asarray(periods, dtype=np.float64)
+    n_series, n_periods = len(velocities), len(periods)
+
+    is_valid = ~np.isnan(velocities)
+    weights = is_valid.astype(np.float64)
+    y = np.where(is_valid, velocities, 0.0)
+    n = weights.sum(axis=1)
+    sum_y = y.sum(axis=1)
+    sum_yy = (y * y).sum(axis=1)
+
+    power = np.empty((n_series, n_periods))
+    p_values = np.empty((n_series, n_periods))
+    params = np.empty((n_series, n_periods, 3))
+    for start in range(0, n_periods, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        beta_x, gamma_x = get_cosinor_design(
+            timeseries[:, None], period=periods[None, chunk]
+        )
+        n_chunk = beta_x.shape[1]
+
+        # sums of all series and periods of the chunk, shape (N, n_chunk)
+        sum_b, sum_g = weights @ beta_x, weights @ gamma_x
+        sum_bb, sum_gg = weights @ (beta_x * beta_x), weights @ (gamma_x * gamma_x)
+        sum_bg = weights @ (beta_x * gamma_x)
+        n_b = np.broadcast_to(n[:, None], sum_b.shape)
+        xtx = np.stack(
+            [
+                np.stack([n_b, sum_b, sum_g], axis=-1),
+                np.stack([sum_b, sum_bb, sum_bg], axis=-1),
+                np.stack([sum_g, sum_bg, sum_gg], axis=-1),
+            ],
+            axis=-2,
+        ).reshape(-1, 3, 3)
+        xty = np.stack(
+            [np.broadcast_to(sum_y[:, None], sum_b.shape), y @ beta_x, y @ gamma_x],
+            axis=-1,
+        ).reshape(-1, 3)
+        yty = np.repeat(sum_yy, n_chunk)
+        n_flat = np.repeat(n, n_chunk)
+
+        chunk_params, xtx_inv, _ = solve_cosinor_normal_equations(xtx, xty, n_flat)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rss = np.maximum(yty - np.einsum("ni,ni->n", chunk_params, xty), 0)
+            tss = np.maximum(yty - xty[:, 0] ** 2 / n_flat, 0)
+        fits = get_cosinor_statistics(chunk_params, xtx_inv, rss, tss, n_flat)
+        power[:, chunk] = fits["r_squared"].reshape(n_series, n_chunk)
+        p_values[:, chunk] = fits["p_value"].reshape(n_series, n_chunk)
+        params[:, chunk] = chunk_params.reshape(n_series, n_chunk, 3)
+
+    # best period per series
+    has_fit = ~np.all(np.isnan(power), axis=1)
+    best = np.zeros(n_series, dtype=np.int64)
+    best[has_fit] = np.nanargmax(power[has_fit], axis=1)
+    rows = np.arange(n_series)
+    best_params = params[rows, best]
+    data = {
+        "period": np.where(has_fit, periods[best], np.nan),
+        "power": power[rows, best],
+        "p_value": p_values[rows, best],
+        "mesor": best_params[:, 0],
+        "amplitude": np.sqrt(best_params[:, 1] ** 2 + best_params[:, 2] ** 2),
+        "phase": get_acrophase(best_params[:, 1], best_params[:, 2]),
+    }
+    if return_power_spectrum:
+        data["power_spectrum"] = power
+    return data
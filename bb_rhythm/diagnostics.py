@@ -0,0 +1,215 @@
+import numpy as np
+import scipy.stats
+
+from . import cosinor
+
+
+def get_group_ids(*keys):
+    """
+    Assigns consecutive group ids to the unique combinations of the given keys.
+
+    :param keys: np.arrays of equal length
+    :return: (group ids per sample, segment id per group when the first key is
+        the segment id, number of groups)
+    """
+    order = np.lexsort(keys[::-1])
+    is_new_group = np.ones(len(order), dtype=bool)
+    if len(order) > 0:
+        is_new_group[1:] = np.any(
+            [np.diff(key[order]) != 0 for key in keys], axis=0
+        )
+    group_ids = np.empty(len(order), dtype=np.int64)
+    group_ids[order] = np.cumsum(is_new_group) - 1
+    return group_ids, keys[0][order][is_new_group], int(is_new_group.sum())
+
+
+def get_pure_error_sum_of_squares(
+    timeseries, velocities, segment_ids, n_segments, period=24 * 60 * 60
+):
+    """
+    Calculates the sum of squares due to pure error (SSPE) per segment, i.e. the
+    squared deviations of the velocities from the mean velocity at the same
+    time of the period (rounded to 2 decimals), and the number of such time points.
+
+    :param timeseries: np.array of timestamps in seconds
+    :param velocities: np.array
+    :param segment_ids: np.array of segment index per sample
+    :param n_segments: number of segments
+    :param period: period in seconds
+    :return: (SSPE per segment, number of unique time points per segment)
+    """
+    x_periodic = np.round(np.asarray(timeseries) % period, 2)
+    group_ids, group_segments, n_groups = get_group_ids(segment_ids, x_periodic)
+    group_counts = np.bincount(group_ids, minlength=n_groups)
+    group_means = (
+        np.bincount(group_ids, weights=velocities, minlength=n_groups) / group_counts
+    )
+    sspe = np.bincount(
+        segment_ids,
+        weights=(velocities - group_means[group_ids]) ** 2,
+        minlength=n_segments,
+    )
+    m = np.bincount(group_segments, minlength=n_segments)
+    return sspe, m
+
+
+def get_ks_normality_p_values(residuals, segment_ids, n_segments):
+    """
+    Kolmogorov-Smirnov test per segment whether the residuals follow the normal
+    distribution fitted to them, equivalent to scipy.stats.kstest with the
+    cdf of scipy.stats.norm(*scipy.stats.norm.fit(residuals)).
+
+    :param residuals: np.array
+    :param segment_ids: np.array of segment index per sample
+    :param n_segments: number of segments
+    :return: np.array of p-values
+    """
+    n = np.bincount(segment_ids, minlength=n_segments)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.bincount(segment_ids, weights=residuals, minlength=n_segments) / n
+        std = np.sqrt(
+            np.bincount(
+                segment_ids,
+                weights=(residuals - mean[segment_ids]) ** 2,
+                minlength=n_segments,
+            )
+            / n
+        )
+        order = np.lexsort((residuals, segment_ids))
+        sorted_segments = segment_ids[order]
+        cdf_values = scipy.stats.norm.cdf(
+            (residuals[order] - mean[sorted_segments]) / std[sorted_segments]
+        )
+
+    # rank of each sorted residual inside its segment
+    starts = np.concatenate([[0], np.cumsum(n)[:-1]])
+    rank = np.arange(len(order)) - starts[sorted_segments] + 1
+    segment_n = n[sorted_segments]
+    d_plus = np.full(n_segments, -np.inf)
+    d_minus = np.full(n_segments, -np.inf)
+    np.maximum.at(d_plus, sorted_segments, rank / segment_n - cdf_values)
+    np.maximum.at(d_minus, sorted_segments, cdf_values - (rank - 1) / segment_n)
+    d = np.maximum(d_plus, d_minus)
+
+    p_ks = np.full(n_segments, np.nan)
+    valid = (n > 0) & np.isfinite(d) & (std > 0)
+    p_ks[valid] = np.clip(scipy.stats.kstwo.sf(d[valid], n[valid]), 0, 1)
+    return p_ks
+
+
+def get_durbin_watson(residuals, segment_ids, n_segments):
+    """
+    Durbin-Watson statistic of the residuals per segment.
+
+    :param residuals: np.array in time order per segment
+    :param segment_ids: np.array of segment index per sample
+    :param n_segments: number of segments
+    :return: np.array
+    """
+    same_segment = segment_ids[1:] == segment_ids[:-1]
+    diff_ssr = np.bincount(
+        segment_ids[1:][same_segment],
+        weights=np.diff(residuals)[same_segment] ** 2,
+        minlength=n_segments,
+    )
+    ssr = np.bincount(segment_ids, weights=residuals**2, minlength=n_segments)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return diff_ssr / ssr
+
+
+def get_runs_test_p_values(residuals, segment_ids, n_segments, correction=True):
+    """
+    Wald-Wolfowitz runs test per segment of the positive against the negative
+    residuals, equivalent to statsmodels.sandbox.stats.runs.runstest_2samp(
+    resid[resid >= 0], resid[resid < 0]).
+
+    :param residuals: np.array
+    :param segment_ids: np.array of segment index per sample
+    :param n_segments: number of segments
+    :param correction: continuity correction for segments with less than 50 samples
+    :return: np.array of p-values
+    """
+    is_negative = residuals < 0
+    order = np.lexsort((residuals, segment_ids))
+    sorted_segments = segment_ids[order]
+    sorted_negative = is_negative[order]
+    run_start = np.ones(len(order), dtype=bool)
+    run_start[1:] = (sorted_segments[1:] != sorted_segments[:-1]) | (
+        sorted_negative[1:] != sorted_negative[:-1]
+    )
+    n_runs = np.bincount(sorted_segments[run_start], minlength=n_segments)
+    n_neg = np.bincount(segment_ids, weights=is_negative, minlength=n_segments)
+    n = np.bincount(segment_ids, minlength=n_segments).astype(np.float64)
+    npn = n_neg * (n - n_neg)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        run_mean = 2.0 * npn / n + 1
+        run_std = np.sqrt(2.0 * npn * (2.0 * npn - n) / n**2.0 / (n - 1.0))
+        run_demeaned = n_runs - run_mean
+        if correction:
+            corrected = np.where(
+                run_demeaned > 0.5,
+                run_demeaned - 0.5,
+                np.where(run_demeaned < 0.5, run_demeaned + 0.5, 0.0),
+            )
+            run_demeaned = np.where(n >= 50, run_demeaned, corrected)
+        z = run_demeaned / run_std
+        return 2 * scipy.stats.norm.sf(np.abs(z))
+
+
+def get_cosinor_goodness_of_fit_batch(
+    timeseries, velocities, residuals, offsets, period=24 * 60 * 60, n_params=3
+):
+    """
+    Goodness of fit statistics according to Cornelissen for many cosinor fits at
+    once from their ragged residual arrays, see cosinor.fit_cosinor_batch with
+    return_residuals=True. The statistics are the same as in
+    rhythm.fit_cosinor_per_bee:
+        p_reject: lack of fit F-test (eqs (14) - (15)) with SSPE and SSLOF
+        p_ks: kolgomorov-smirnov test for normally distributed residuals
+        p_hom: homogeneity of variance
+        dw: durbin watson statistic for independence of residuals
+        p_runs: runs test of the residuals
+
+    :param timeseries: concatenated timestamps in seconds
+    :param velocities: concatenated velocities
+    :param residuals: concatenated residuals of the fits
+    :param offsets: np.array of length n_series + 1
+    :param period: period in seconds
+    :param n_params: number of model parameters
+    :return: dict of np.arrays with one entry per series
+    """
+    velocities = np.asarray(velocities, dtype=np.float64)
+    residuals = np.asarray(residuals, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_segments = len(offsets) - 1
+    segment_ids = cosinor.get_segment_ids(offsets)
+    n = np.diff(offsets).astype(np.float64)
+
+    # 1 - lack of fit with sum of squares due to pure error
+    rss = np.bincount(segment_ids, weights=residuals**2, minlength=n_segments)
+    sspe, m = get_pure_error_sum_of_squares(
+        timeseries, velocities, segment_ids, n_segments, period=period
+    )
+    sslof = rss - sspe
+    with np.errstate(divide="ignore", invalid="ignore"):
+        F = (sslof / (m - n_params)) / (sspe / (n - m))
+        p_reject = 1 - scipy.stats.f.cdf(F, m - n_params, n - m)
+
+        # 3 - F = (N - 2p - 2)r² / (1-r²) > F -> variance is homogeneous
+        fitted_sum = np.bincount(
+            segment_ids, weights=velocities - residuals, minlength=n_segments
+        )
+        F_hom = n * fitted_sum**2 / (1 - fitted_sum**2)
+        p_hom = 1 - scipy.stats.f.cdf(F_hom, 1, n)
+
+    return {
+        "p_reject": p_reject,
+        "p_ks": get_ks_normality_p_values(residuals, segment_ids, n_segments),
+        "p_hom": p_hom,
+        "dw": get_durbin_watson(residuals, segment_ids, n_segments),
+        "p_runs": get_runs_test_p_values(residuals, segment_ids, n_segments),
+        "RSS": rss,
+        "SSPE": sspe,
+        "SSLOF": sslof,
+    }
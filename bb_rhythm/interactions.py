@@ -1,14 +1,18 @@
 # imports for run job
+import concurrent.futures
 import datetime
 import numpy as np
 import itertools
 import pandas as pd
-import cv2
 import os
 import pytz
+import string
+import sys
 
 import bb_behavior.db
 
+from . import utils
+
 
 def cluster_interactions_over_time(
     iterable,
@@ -133,6 +137,444 @@ def cluster_interactions_over_time(
     return last_x_for_y
 
 
+def get_pair_keys(bee_ids0, bee_ids1):
+    """
+    :param bee_ids0: array-like of bee ids
+    :param bee_ids1: array-like of bee ids
+    :return: np.array of int64 keys bee_id0 << 32 | bee_id1 per pair
+    """
+    return (np.asarray(bee_ids0, dtype=np.int64) << 32) | np.asarray(
+        bee_ids1, dtype=np.int64
+    )
+
+
+def split_pair_keys(keys):
+    """
+    :param keys: np.array of int64 keys, see get_pair_keys
+    :return: (bee_ids0, bee_ids1)
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    return keys >> 32, keys & 0xFFFFFFFF
+
+
+def segment_events(
+    keys,
+    timestamps,
+    min_gap_size=datetime.timedelta(seconds=2),
+    min_event_duration=datetime.timedelta(seconds=1),
+):
+    """
+    Columnar version of cluster_interactions_over_time. The detections are sorted
+    by key and time, a new event starts when the time to the previous detection of
+    the key exceeds min_gap_size and events shorter than min_event_duration are
+    dropped.
+
+    :param keys: np.array of int64 keys per detection, e.g. get_pair_keys
+    :param timestamps: np.array of int64 nanoseconds per detection
+    :param min_gap_size: datetime.timedelta, events are not split if None
+    :param min_event_duration: datetime.timedelta, no events are dropped if None
+    :return: pd.DataFrame with one row per event and columns key, t_start, t_end
+        and loc_start, loc_end, the positions of the first and last detection of
+        the event in the input arrays
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    order = np.lexsort((timestamps, keys))
+    keys, timestamps = keys[order], timestamps[order]
+
+    is_start = np.ones(len(keys), dtype=bool)
+    is_start[1:] = keys[1:] != keys[:-1]
+    if min_gap_size is not None:
+        is_start[1:] |= np.diff(timestamps) > pd.Timedelta(min_gap_size).value
+    starts = np.flatnonzero(is_start)
+    ends = np.append(starts[1:], len(keys)) - 1
+    if min_event_duration:
+        is_event = (
+            timestamps[ends] - timestamps[starts]
+            >= pd.Timedelta(min_event_duration).value
+        )
+        starts, ends = starts[is_event], ends[is_event]
+    return pd.DataFrame(
+        dict(
+            key=keys[starts],
+            t_start=timestamps[starts],
+            t_end=timestamps[ends],
+            loc_start=order[starts],
+            loc_end=order[ends],
+        )
+    )
+
+
+def get_interaction_arrays(interactions):
+    """
+    :param interactions: list of dicts with keys "bee_id0", "bee_id1",
+        "timestamp", "location_info_bee0" and "location_info_bee1" as in
+        fetch_interactions_per_frame
+    :return: (bee_ids0, bee_ids1, timestamps as pd.DatetimeIndex, locations_bee0,
+        locations_bee1) with locations of shape (n, 3) of x, y and theta
+    """
+    n = len(interactions)
+    bee_ids0 = np.fromiter(
+        (interaction["bee_id0"] for interaction in interactions), np.int64, n
+    )
+    bee_ids1 = np.fromiter(
+        (interaction["bee_id1"] for interaction in interactions), np.int64, n
+    )
+    # all interactions of a frame share the timestamp, so only the unique
+    # timestamps are converted
+    unique_timestamps = {
+        timestamp: i
+        for i, timestamp in enumerate(
+            dict.fromkeys(interaction["timestamp"] for interaction in interactions)
+        )
+    }
+    timestamp_indices = np.fromiter(
+        (unique_timestamps[interaction["timestamp"]] for interaction in interactions),
+        np.int64,
+        n,
+    )
+    timestamps = pd.DatetimeIndex(list(unique_timestamps))[timestamp_indices]
+    locations_bee0, locations_bee1 = [
+        np.array(
+            [interaction[column] for interaction in interactions], dtype=np.float64
+        ).reshape(n, 3)
+        for column in ("location_info_bee0", "location_info_bee1")
+    ]
+    return bee_ids0, bee_ids1, timestamps, locations_bee0, locations_bee1
+
+
+def cluster_interactions(
+    bee_ids0,
+    bee_ids1,
+    timestamps,
+    locations_bee0,
+    locations_bee1,
+    min_gap_size=datetime.timedelta(seconds=2),
+    min_event_duration=datetime.timedelta(seconds=1),
+):
+    """
+    Clusters per frame interactions of bee pairs to interaction events, see
+    segment_events.
+
+    :param bee_ids0: array-like of bee ids
+    :param bee_ids1: array-like of bee ids
+    :param timestamps: pd.DatetimeIndex or array-like of datetimes
+    :param locations_bee0: np.array of shape (n, 3) of x, y and theta
+    :param locations_bee1: np.array of shape (n, 3) of x, y and theta
+    :param min_gap_size:
+    :param min_event_duration:
+    :return: pd.DataFrame with the columns of extract_parameters_from_events,
+        sorted by interaction_start
+    """
+    timestamps = pd.DatetimeIndex(timestamps)
+    events = segment_events(
+        get_pair_keys(bee_ids0, bee_ids1),
+        utils.get_utc_nanoseconds(timestamps),
+        min_gap_size=min_gap_size,
+        min_event_duration=min_event_duration,
+    )
+    event_table = get_event_table(events, locations_bee0, locations_bee1)
+    return event_table_to_interaction_df(event_table, timestamps.tz)
+
+
+event_location_columns = [
+    "%s_%s_bee%d" % (parameter, column, bee)
+    for column in ("start", "end")
+    for bee in (0, 1)
+    for parameter in ("x_pos", "y_pos", "theta")
+]
+
+
+def get_event_table(events, locations_bee0, locations_bee1):
+    """
+    :param events: pd.DataFrame of segment_events
+    :param locations_bee0: np.array of shape (n, 3) of x, y and theta
+    :param locations_bee1: np.array of shape (n, 3) of x, y and theta
+    :return: pd.DataFrame with columns key, t_start, t_end and the
+        event_location_columns
+    """
+    event_table = dict(
+        key=events.key.values, t_start=events.t_start.values, t_end=events.t_end.values
+    )
+    for column in ("start", "end"):
+        for bee, locations in enumerate((locations_bee0, locations_bee1)):
+            x, y, theta = np.asarray(locations)[events["loc_%s" % column].values].T
+            event_table["x_pos_%s_bee%d" % (column, bee)] = x
+            event_table["y_pos_%s_bee%d" % (column, bee)] = y
+            event_table["theta_%s_bee%d" % (column, bee)] = theta
+    return pd.DataFrame(event_table)
+
+
+def event_table_to_interaction_df(event_table, tz=None):
+    """
+    :param event_table: pd.DataFrame of get_event_table
+    :param tz: time zone of the interaction times, naive if None
+    :return: pd.DataFrame with the columns of extract_parameters_from_events,
+        sorted by interaction_start
+    """
+    event_table = event_table.sort_values("t_start", kind="stable")
+    bee_ids0, bee_ids1 = split_pair_keys(event_table.key.values)
+    interaction_df = dict(bee_id0=bee_ids0, bee_id1=bee_ids1)
+    for column in ("start", "end"):
+        dts = pd.to_datetime(event_table["t_%s" % column].values, utc=tz is not None)
+        interaction_df["interaction_%s" % column] = (
+            dts.tz_convert(tz) if tz is not None else dts
+        )
+    for column in event_location_columns:
+        interaction_df[column] = event_table[column].values
+    return pd.DataFrame(interaction_df)
+
+
+class StreamingInteractionClusterer:
+    """
+    Clusters time ordered chunks of per frame interactions, e.g. hourly, to
+    interaction events as cluster_interactions. The last event of each pair is
+    kept open across chunks until no further detection can extend it, so the
+    events do not break at chunk boundaries and only the open events are kept
+    in memory. The state can be checkpointed to resume after a failure.
+    """
+
+    def __init__(
+        self,
+        min_gap_size=datetime.timedelta(seconds=2),
+        min_event_duration=datetime.timedelta(seconds=1),
+    ):
+        self.min_gap_size = min_gap_size
+        self.min_event_duration = min_event_duration
+        self.open_events = pd.DataFrame(
+            {
+                column: np.empty(0, dtype=np.int64)
+                for column in ("key", "t_start", "t_end")
+            }
+        )
+        for column in event_location_columns:
+            self.open_events[column] = np.empty(0)
+        # nanoseconds up to which all interactions were added
+        self.watermark = None
+        self.tz = None
+
+    def add(
+        self,
+        bee_ids0,
+        bee_ids1,
+        timestamps,
+        locations_bee0,
+        locations_bee1,
+        until=None,
+    ):
+        """
+        Adds a chunk of per frame interactions and returns the events that are
+        closed.
+
+        :param bee_ids0: array-like of bee ids
+        :param bee_ids1: array-like of bee ids
+        :param timestamps: pd.DatetimeIndex or array-like of datetimes, not
+            before the previous chunks
+        :param locations_bee0: np.array of shape (n, 3) of x, y and theta
+        :param locations_bee1: np.array of shape (n, 3) of x, y and theta
+        :param until: end of the chunk, later chunks start at or after it,
+            defaults to the last timestamp of the chunk
+        :return: pd.DataFrame of the closed events, see cluster_interactions
+        """
+        timestamps = pd.DatetimeIndex(timestamps)
+        if len(timestamps) > 0 and self.tz is None:
+            self.tz = timestamps.tz
+        timestamps = utils.get_utc_nanoseconds(timestamps)
+        if len(timestamps) > 0 and self.watermark is not None:
+            if timestamps.min() < self.watermark:
+                raise ValueError("Chunks have to be added in time order.")
+        chunk_events = get_event_table(
+            segment_events(
+                get_pair_keys(bee_ids0, bee_ids1),
+                timestamps,
+                min_gap_size=self.min_gap_size,
+                min_event_duration=None,
+            ),
+            locations_bee0,
+            locations_bee1,
+        )
+        watermark = max(
+            [
+                value
+                for value in (
+                    self.watermark,
+                    timestamps.max() if len(timestamps) > 0 else None,
+                    utils.get_utc_nanoseconds(until) if until is not None else None,
+                )
+                if value is not None
+            ]
+        )
+        self.watermark = watermark
+
+        # continue the open events with the first event of their pair in the chunk
+        is_first = np.ones(len(chunk_events), dtype=bool)
+        is_first[1:] = chunk_events.key.values[1:] != chunk_events.key.values[:-1]
+        open_events = self.open_events.set_index("key")
+        first_events = chunk_events[is_first & chunk_events.key.isin(open_events.index)]
+        previous_events = open_events.loc[first_events.key.values]
+        is_continued = (
+            first_events.t_start.values - previous_events.t_end.values
+            <= self.get_min_gap_size()
+        )
+        continued = first_events.index[is_continued]
+        # the start time and start locations
+        for column in ["t_start"] + event_location_columns[:6]:
+            chunk_events.loc[continued, column] = previous_events[column].values[
+                is_continued
+            ]
+        open_events = open_events.drop(previous_events.index[is_continued])
+
+        # an event is closed if a later event of its pair exists or if the gap
+        # to the watermark is too large to be bridged by later chunks
+        events = pd.concat(
+            [open_events.reset_index(), chunk_events], ignore_index=True
+        ).sort_values(["key", "t_start"], kind="stable")
+        is_last = np.ones(len(events), dtype=bool)
+        is_last[:-1] = events.key.values[:-1] != events.key.values[1:]
+        is_closed = ~is_last | (
+            watermark - events.t_end.values > self.get_min_gap_size()
+        )
+        self.open_events = events[~is_closed].reset_index(drop=True)
+        return self.get_interaction_df(events[is_closed])
+
+    def flush(self):
+        """
+        Closes all open events, e.g. at the end of the time range.
+
+        :return: pd.DataFrame of the closed events, see cluster_interactions
+        """
+        events = self.open_events
+        self.open_events = self.open_events.iloc[:0]
+        return self.get_interaction_df(events)
+
+    def get_min_gap_size(self):
+        if self.min_gap_size is None:
+            return np.iinfo(np.int64).max
+        return pd.Timedelta(self.min_gap_size).value
+
+    def get_interaction_df(self, events):
+        if self.min_event_duration:
+            events = events[
+                events.t_end.values - events.t_start.values
+                >= pd.Timedelta(self.min_event_duration).value
+            ]
+        return event_table_to_interaction_df(events, self.tz)
+
+    def save_checkpoint(self, path):
+        """
+        Pickles the state of the clusterer atomically to path.
+
+        :param path:
+        :return:
+        """
+        pd.to_pickle(self.__dict__, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def from_checkpoint(cls, path):
+        """
+        :param path: path of save_checkpoint
+        :return: StreamingInteractionClusterer
+        """
+        clusterer = cls()
+        clusterer.__dict__.update(pd.read_pickle(path))
+        return clusterer
+
+
+def iterate_interaction_events(
+    chunks,
+    clusterer=None,
+    checkpoint_path=None,
+):
+    """
+    Streams interaction events of time ordered chunks of per frame interactions.
+
+    :param chunks: iterable of (bee_ids0, bee_ids1, timestamps, locations_bee0,
+        locations_bee1, until), see StreamingInteractionClusterer.add
+    :param clusterer: StreamingInteractionClusterer, e.g. of from_checkpoint
+    :param checkpoint_path: if given, the clusterer is checkpointed after the
+        events of a chunk were consumed, i.e. when the next chunk is requested,
+        so that a resume repeats the chunk whose events were being handled
+    :return: generator of pd.DataFrame of closed events per chunk
+    """
+    if clusterer is None:
+        clusterer = StreamingInteractionClusterer()
+    for chunk in chunks:
+        yield clusterer.add(*chunk)
+        if checkpoint_path is not None:
+            clusterer.save_checkpoint(checkpoint_path)
+    yield clusterer.flush()
+    if checkpoint_path is not None:
+        clusterer.save_checkpoint(checkpoint_path)
+
+
+def get_interactions_over_time_streaming(
+    cam_ids,
+    dt_from,
+    dt_to,
+    db_connection=None,
+    chunk_size=datetime.timedelta(hours=1),
+    checkpoint_path=None,
+    connection_pool=None,
+):
+    """
+    Fetches the per frame interactions chunk wise and streams all interaction
+    events of dt_from to dt_to in bounded memory. If checkpoint_path exists, the
+    stream resumes after the last checkpointed chunk.
+
+    :param cam_ids:
+    :param dt_from:
+    :param dt_to:
+    :param db_connection:
+    :param chunk_size: datetime.timedelta
+    :param checkpoint_path:
+    :param connection_pool: if given, the interactions are fetched with
+        fetch_interactions_bulk instead of one query per frame
+    :return: generator of pd.DataFrame of closed events per chunk
+    """
+    clusterer = None
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        clusterer = StreamingInteractionClusterer.from_checkpoint(checkpoint_path)
+        dt_from = max(
+            dt_from, pd.Timestamp(clusterer.watermark, tz=pytz.UTC).to_pydatetime()
+        )
+
+    def iterate_chunks(fetch):
+        chunk_from = dt_from
+        while chunk_from < dt_to:
+            chunk_to = min(chunk_from + chunk_size, dt_to)
+            yield (*fetch(chunk_from, chunk_to), chunk_to)
+            chunk_from = chunk_to
+
+    if connection_pool is not None:
+        yield from iterate_interaction_events(
+            iterate_chunks(
+                lambda chunk_from, chunk_to: fetch_interactions_bulk(
+                    cam_ids,
+                    chunk_from,
+                    chunk_to,
+                    connection_pool,
+                    chunk_size=chunk_size,
+                )
+            ),
+            clusterer=clusterer,
+            checkpoint_path=checkpoint_path,
+        )
+        return
+
+    with db_connection as db:
+        cursor = db.cursor()
+        yield from iterate_interaction_events(
+            iterate_chunks(
+                lambda chunk_from, chunk_to: get_interaction_arrays(
+                    fetch_interactions_per_frame(cam_ids, cursor, chunk_from, chunk_to)
+                )
+            ),
+            clusterer=clusterer,
+            checkpoint_path=checkpoint_path,
+        )
+
+
 def extract_parameters_from_events(event):
     """
 
@@ -208,50 +650,17 @@ def get_all_interactions_over_time(interaction_generator) -> list:
     :param interaction_generator:
     :return:
     """
-
-    def generator():
-        """
-
-        :return:
-        """
-        for interaction in interaction_generator:
-            (
-                bee_id0,
-                bee_id1,
-                timestamp,
-                location_parameters_bee0,
-                location_parameters_bee1,
-            ) = (
-                interaction["bee_id0"],
-                interaction["bee_id1"],
-                interaction["timestamp"],
-                interaction["location_info_bee0"],
-                interaction["location_info_bee1"],
-            )
-            # Make sure that the bee_id0 always refers to the one with the lower ID here.
-            pair_string = "{}_{}".format(bee_id0, bee_id1)
-            yield dict(
-                y=pair_string,
-                time=timestamp,
-                color="interaction",
-                loc_info_0=location_parameters_bee0,
-                loc_info_1=location_parameters_bee1,
-            )
-
-    clustered_interaction_events = cluster_interactions_over_time(
-        generator(),
+    interactions = list(interaction_generator)
+    if not interactions:
+        return []
+    interaction_df = cluster_interactions(
+        *get_interaction_arrays(interactions),
         min_gap_size=datetime.timedelta(seconds=2),
         min_event_duration=datetime.timedelta(seconds=1),
-        fill_gaps=False,
     )
-    extracted_interactions_lst = []
-    for key in clustered_interaction_events:
-        event_dict = clustered_interaction_events[key]
-        if event_dict:
-            # extract event parameters as interactions
-            interaction_dict = extract_parameters_from_events(event_dict[0])
-            extracted_interactions_lst.append(interaction_dict)
-    return extracted_interactions_lst
+    # the first event per pair is extracted as interaction
+    interaction_df = interaction_df.drop_duplicates(["bee_id0", "bee_id1"])
+    return interaction_df.to_dict("records")
 
 
 def add_post_interaction_velocity_change(interaction_events, velocity_df_path=None):
@@ -261,6 +670,18 @@ def add_post_interaction_velocity_change(interaction_events, velocity_df_path=No
     :param velocity_df_path:
     :return:
     """
+    interaction_events = list(interaction_events)
+    if not interaction_events:
+        return
+    # every bee's velocities are loaded once for all of its interactions
+    delta_t = datetime.timedelta(0, 30)
+    dt_from = min(event["interaction_start"] for event in interaction_events)
+    dt_to = max(event["interaction_end"] for event in interaction_events)
+    velocity_store = utils.VelocityStore(
+        velocity_df_path,
+        dt_from.replace(tzinfo=pytz.UTC) - delta_t,
+        dt_to.replace(tzinfo=pytz.UTC) + delta_t,
+    )
     for interaction_dict in interaction_events:
         # calculate velocity changes
         # "focal" bee
@@ -275,7 +696,7 @@ def add_post_interaction_velocity_change(interaction_events, velocity_df_path=No
             interaction_end=interaction_dict["interaction_end"].replace(
                 tzinfo=pytz.UTC
             ),
-            velocities_path=velocity_df_path,
+            velocity_store=velocity_store,
         )
         # "non-focal" bee
         (
@@ -289,10 +710,33 @@ def add_post_interaction_velocity_change(interaction_events, velocity_df_path=No
             interaction_end=interaction_dict["interaction_end"].replace(
                 tzinfo=pytz.UTC
             ),
-            velocities_path=velocity_df_path,
+            velocity_store=velocity_store,
         )
 
 
+def add_velocity_changes_to_interaction_df(interaction_df, velocity_store):
+    """
+    Adds the velocity changes of both bees of all interactions at once, see
+    get_velocity_change_per_bee.
+
+    :param interaction_df: pd.DataFrame with columns "bee_id0", "bee_id1",
+        "interaction_start" and "interaction_end"
+    :param velocity_store: utils.VelocityStore
+    :return: interaction_df with columns "vel_change_bee0", "rel_change_bee0",
+        "vel_change_bee1" and "rel_change_bee1"
+    """
+    for bee in (0, 1):
+        (
+            interaction_df["vel_change_bee%d" % bee],
+            interaction_df["rel_change_bee%d" % bee],
+        ) = velocity_store.get_velocity_changes(
+            interaction_df["bee_id%d" % bee].values,
+            interaction_df["interaction_start"],
+            interaction_df["interaction_end"],
+        )
+    return interaction_df
+
+
 def fetch_interactions_per_frame(
     cam_ids: list, cursor, dt_from: datetime.datetime, dt_to: datetime.datetime
 ) -> list:
@@ -332,8 +776,339 @@ def fetch_interactions_per_frame(
     return interactions_lst
 
 
+def get_paramstyle(connection):
+    """
+    :param connection: DB-API connection, e.g. of psycopg2 or sqlite3
+    :return: paramstyle of the DB-API module of the connection
+    """
+    module = sys.modules.get(type(connection).__module__.split(".")[0])
+    return getattr(module, "paramstyle", "format")
+
+
+def format_query_parameters(query, parameters, paramstyle):
+    """
+    :param query: query with {name} placeholders
+    :param parameters: dict of name to value
+    :param paramstyle: DB-API paramstyle
+    :return: (query, parameters) in the paramstyle
+    """
+    names = list(
+        dict.fromkeys(
+            name for _, name, _, _ in string.Formatter().parse(query) if name
+        )
+    )
+    if paramstyle in ("named", "pyformat"):
+        placeholder = ":%s" if paramstyle == "named" else "%%(%s)s"
+        return (
+            query.format(**{name: placeholder % name for name in names}),
+            {name: parameters[name] for name in names},
+        )
+    if paramstyle == "numeric":
+        placeholders = {name: ":%d" % (i + 1) for i, name in enumerate(names)}
+    else:
+        placeholders = {name: "?" if paramstyle == "qmark" else "%s" for name in names}
+        # positional parameters per placeholder
+        names = [
+            name for _, name, _, _ in string.Formatter().parse(query) if name
+        ]
+    return query.format(**placeholders), [parameters[name] for name in names]
+
+
+detection_columns = [
+    "frame_id",
+    "timestamp",
+    "cam_id",
+    "bee_id",
+    "x_pos_hive",
+    "y_pos_hive",
+    "orientation_hive",
+    "bee_id_confidence",
+]
+
+
+def fetch_detections(
+    cam_id,
+    dt_from,
+    dt_to,
+    connection,
+    detections_table=None,
+    min_confidence=0.25,
+    chunk_size=datetime.timedelta(hours=1),
+):
+    """
+    Fetches all detections of a camera in [dt_from, dt_to) with one query per
+    chunk of the time range instead of one query per frame.
+
+    :param cam_id:
+    :param dt_from:
+    :param dt_to:
+    :param connection: DB-API connection, e.g. of psycopg2 or sqlite3
+    :param detections_table: defaults to the detections table of bb_behavior
+    :param min_confidence: minimal bee_id_confidence, inclusive as in
+        bb_behavior.db.find_interactions_in_frame
+    :param chunk_size: datetime.timedelta of the time range per query
+    :return: pd.DataFrame with the detection_columns
+    """
+    if detections_table is None:
+        detections_table = bb_behavior.db.base.get_detections_tablename()
+    paramstyle = get_paramstyle(connection)
+    cursor = connection.cursor()
+    detection_dfs = []
+    chunk_from = dt_from
+    while chunk_from < dt_to:
+        chunk_to = min(chunk_from + chunk_size, dt_to)
+        query, parameters = format_query_parameters(
+            "SELECT "
+            + ", ".join(detection_columns)
+            + " FROM "
+            + detections_table
+            + " WHERE cam_id = {cam_id}"
+            " AND timestamp >= {dt_from} AND timestamp < {dt_to}"
+            " AND bee_id_confidence >= {min_confidence}",
+            dict(
+                cam_id=cam_id,
+                dt_from=chunk_from,
+                dt_to=chunk_to,
+                min_confidence=min_confidence,
+            ),
+            paramstyle,
+        )
+        cursor.execute(query, parameters)
+        detection_dfs.append(
+            pd.DataFrame.from_records(cursor.fetchall(), columns=detection_columns)
+        )
+        chunk_from = chunk_to
+    detections = pd.concat(
+        detection_dfs
+        or [pd.DataFrame.from_records([], columns=detection_columns)],
+        ignore_index=True,
+    )
+    detections["timestamp"] = pd.to_datetime(detections["timestamp"], utc=True)
+    return detections
+
+
+def fetch_detections_bulk(
+    cam_ids, dt_from, dt_to, connection_pool, n_workers=None, **kwargs
+):
+    """
+    Fetches the detections of all cameras, see fetch_detections. With a
+    connection pool the cameras are fetched concurrently.
+
+    :param cam_ids:
+    :param dt_from:
+    :param dt_to:
+    :param connection_pool: pool with getconn and putconn as
+        psycopg2.pool.ThreadedConnectionPool, or a single DB-API connection
+    :param n_workers: number of threads, defaults to the number of cameras
+    :param kwargs: further keyword arguments of fetch_detections
+    :return: pd.DataFrame with the detection_columns
+    """
+    if not hasattr(connection_pool, "getconn"):
+        detection_dfs = [
+            fetch_detections(cam_id, dt_from, dt_to, connection_pool, **kwargs)
+            for cam_id in cam_ids
+        ]
+    else:
+
+        def fetch(cam_id):
+            connection = connection_pool.getconn()
+            try:
+                return fetch_detections(cam_id, dt_from, dt_to, connection, **kwargs)
+            finally:
+                connection_pool.putconn(connection)
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=n_workers or max(len(cam_ids), 1)
+        ) as executor:
+            detection_dfs = list(executor.map(fetch, cam_ids))
+    return pd.concat(detection_dfs, ignore_index=True)
+
+
+def find_proximity_pairs(frame_ids, x, y, max_distance=14.0):
+    """
+    Finds all pairs of detections of the same frame closer than max_distance
+    for all frames at once. The detections are hashed to a uniform grid with
+    cells of size max_distance per frame, so only detections of the same or
+    neighbouring cells are compared.
+
+    :param frame_ids: np.array of frame ids per detection
+    :param x: np.array of x positions
+    :param y: np.array of y positions
+    :param max_distance: exclusive
+    :return: (i, j) np.arrays of the indices of the pairs with i < j
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    frame_codes = pd.factorize(np.asarray(frame_ids))[0].astype(np.int64)
+    if len(frame_codes) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # cell keys with an empty border, so that the neighbours of a cell never
+    # wrap to the next row or frame
+    cell_x = np.floor(x / max_distance).astype(np.int64)
+    cell_y = np.floor(y / max_distance).astype(np.int64)
+    cell_x -= cell_x.min() - 1
+    cell_y -= cell_y.min() - 1
+    n_cells_x, n_cells_y = cell_x.max() + 2, cell_y.max() + 2
+    keys = (frame_codes * n_cells_x + cell_x) * n_cells_y + cell_y
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    is_cell_begin = np.ones(len(sorted_keys), dtype=bool)
+    is_cell_begin[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    cell_begins = np.flatnonzero(is_cell_begin)
+    cell_ends = np.append(cell_begins[1:], len(sorted_keys))
+    cell_keys = sorted_keys[cell_begins]
+    cells = np.cumsum(is_cell_begin) - 1
+
+    pairs_i, pairs_j = [], []
+    # half of the neighbourhood, so that every pair of cells is visited once
+    for offset_x, offset_y in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):
+        if offset_x == 0 and offset_y == 0:
+            # pairs within a cell only once
+            begins = np.arange(len(sorted_keys)) + 1
+            ends = cell_ends[cells]
+        else:
+            neighbour_keys = cell_keys + offset_x * n_cells_y + offset_y
+            neighbours = np.minimum(
+                np.searchsorted(cell_keys, neighbour_keys), len(cell_keys) - 1
+            )
+            is_occupied = cell_keys[neighbours] == neighbour_keys
+            begins = np.where(is_occupied, cell_begins[neighbours], 0)[cells]
+            ends = np.where(is_occupied, cell_ends[neighbours], 0)[cells]
+        counts = np.maximum(ends - begins, 0)
+        i = np.repeat(np.arange(len(sorted_keys)), counts)
+        j = np.repeat(begins - np.cumsum(counts) + counts, counts) + np.arange(
+            counts.sum()
+        )
+        pairs_i.append(order[i])
+        pairs_j.append(order[j])
+    i, j = np.concatenate(pairs_i), np.concatenate(pairs_j)
+    is_close = (x[i] - x[j]) ** 2 + (y[i] - y[j]) ** 2 < max_distance**2
+    i, j = i[is_close], j[is_close]
+    return np.minimum(i, j), np.maximum(i, j)
+
+
+def detect_interactions(
+    frame_ids,
+    timestamps,
+    bee_ids,
+    x,
+    y,
+    orientations,
+    confidences=None,
+    max_distance=14.0,
+    min_confidence=None,
+):
+    """
+    Client side version of bb_behavior.db.find_interactions_in_frame for the
+    detections of many frames, e.g. cached detections of fetch_detections_bulk,
+    so that interactions can be detected again with other thresholds.
+
+    :param frame_ids: np.array of frame ids per detection
+    :param timestamps: pd.DatetimeIndex or array-like of datetimes
+    :param bee_ids: np.array of bee ids
+    :param x: np.array of x positions in hive coordinates
+    :param y: np.array of y positions in hive coordinates
+    :param orientations: np.array of orientations
+    :param confidences: np.array of bee id confidences
+    :param max_distance: in hive coordinates, exclusive
+    :param min_confidence: minimal confidence of both detections, inclusive,
+        all detections are used if None
+    :return: (bee_ids0, bee_ids1, timestamps, locations_bee0, locations_bee1)
+        as get_interaction_arrays, with bee_id0 < bee_id1 and sorted by
+        frame, bee_id0 and bee_id1
+    """
+    frame_ids = np.asarray(frame_ids)
+    bee_ids = np.asarray(bee_ids, dtype=np.int64)
+    locations = np.column_stack([x, y, orientations]).astype(np.float64)
+    detections = np.arange(len(bee_ids))
+    if min_confidence is not None:
+        detections = detections[np.asarray(confidences) >= min_confidence]
+    i, j = find_proximity_pairs(
+        frame_ids[detections],
+        locations[detections, 0],
+        locations[detections, 1],
+        max_distance=max_distance,
+    )
+    i, j = detections[i], detections[j]
+
+    # detections of the same bee id are no interaction
+    i, j = i[bee_ids[i] != bee_ids[j]], j[bee_ids[i] != bee_ids[j]]
+    is_swapped = bee_ids[i] > bee_ids[j]
+    i, j = np.where(is_swapped, j, i), np.where(is_swapped, i, j)
+    order = np.lexsort((bee_ids[j], bee_ids[i], frame_ids[i]))
+    i, j = i[order], j[order]
+    return (
+        bee_ids[i],
+        bee_ids[j],
+        pd.DatetimeIndex(timestamps)[i],
+        locations[i],
+        locations[j],
+    )
+
+
+def find_interactions_in_detections(
+    detections, max_distance=14.0, min_confidence=None
+):
+    """
+    Client side version of bb_behavior.db.find_interactions_in_frame for many
+    frames, see detect_interactions.
+
+    :param detections: pd.DataFrame with the detection_columns
+    :param max_distance: in hive coordinates
+    :param min_confidence: minimal bee_id_confidence, inclusive
+    :return: (bee_ids0, bee_ids1, timestamps, locations_bee0, locations_bee1)
+        as get_interaction_arrays
+    """
+    return detect_interactions(
+        detections.frame_id.values,
+        detections.timestamp,
+        detections.bee_id.values,
+        detections.x_pos_hive.values,
+        detections.y_pos_hive.values,
+        detections.orientation_hive.values,
+        confidences=detections.bee_id_confidence.values,
+        max_distance=max_distance,
+        min_confidence=min_confidence,
+    )
+
+
+def fetch_interactions_bulk(
+    cam_ids,
+    dt_from,
+    dt_to,
+    connection_pool,
+    max_distance=14.0,
+    n_workers=None,
+    **kwargs
+):
+    """
+    Bulk version of fetch_interactions_per_frame: the detections are fetched
+    per camera and time range and paired client side.
+
+    :param cam_ids:
+    :param dt_from:
+    :param dt_to:
+    :param connection_pool: see fetch_detections_bulk
+    :param max_distance: in hive coordinates
+    :param n_workers:
+    :param kwargs: further keyword arguments of fetch_detections
+    :return: (bee_ids0, bee_ids1, timestamps, locations_bee0, locations_bee1)
+        as get_interaction_arrays
+    """
+    detections = fetch_detections_bulk(
+        cam_ids, dt_from, dt_to, connection_pool, n_workers=n_workers, **kwargs
+    )
+    return find_interactions_in_detections(detections, max_distance=max_distance)
+
+
 def get_velocity_change_per_bee(
-    bee_id, interaction_start, interaction_end, velocities_path=None
+    bee_id,
+    interaction_start,
+    interaction_end,
+    velocities_path=None,
+    velocity_store=None,
+    cache=None,
 ):
     """
 
@@ -341,9 +1116,19 @@ def get_velocity_change_per_bee(
     :param interaction_start:
     :param interaction_end:
     :param velocities_path:
+    :param velocity_store: utils.VelocityStore which keeps the bee's velocities
+        indexed between calls instead of reading them again
+    :param cache: utils.VelocityCache shared by the velocity readers of a job
     :return:
     """
     delta_t = datetime.timedelta(0, 30)
+    if velocity_store is not None:
+        if velocity_store.load(bee_id) is None:
+            return None, None
+        vel_change, percent_change = velocity_store.get_velocity_changes(
+            [bee_id], [interaction_start], [interaction_end], delta_t=delta_t
+        )
+        return vel_change[0], percent_change[0]
     dt_before, dt_after = interaction_start - delta_t, interaction_end + delta_t
 
     if type(bee_id) == np.int64:
@@ -351,15 +1136,11 @@ def get_velocity_change_per_bee(
 
     try:
         # fetch velocities
-        velocities = pd.read_pickle(os.path.join(velocities_path, "%d.pickle" % bee_id))
+        velocities = utils.read_velocities_pickle(bee_id, velocities_path, cache=cache)
     except (FileNotFoundError, TypeError):
         # fetch velocities
-        velocities = bb_behavior.db.trajectory.get_bee_velocities(
-            bee_id,
-            dt_before,
-            dt_after,
-            confidence_threshold=0.1,
-            max_mm_per_second=15.0,
+        velocities = utils.fetch_velocities_from_db(
+            bee_id, dt_before, dt_after, cache=cache
         )
 
     if velocities is None:
@@ -496,27 +1277,49 @@ def transform_coordinates(interaction, focal_bee=0):
         return transformed[0], transformed[1], bee0_theta - bee1_theta
 
 
-def apply_transformation(interaction_df):
-    # apply transformation of coordinates
-    transformed_coords_focal0 = interaction_df.apply(
-        transform_coordinates, axis=1, result_type="expand", focal_bee=0
-    )
-    transformed_coords_focal1 = interaction_df.apply(
-        transform_coordinates, axis=1, result_type="expand", focal_bee=1
-    )
+def get_transformed_coordinates(interaction_df):
+    """
+    Vectorized transform_coordinates for both focal bees.
 
-    # rounded coordinates to discretize positions
-    transformed_coords_focal0 = transformed_coords_focal0.apply(round)
-    transformed_coords_focal1 = transformed_coords_focal1.apply(round)
+    :param interaction_df: pd.DataFrame with the start positions and angles of
+        both bees
+    :return: dict of focal bee to (x, y, theta) np.arrays of the non-focal bee
+    """
+    x = [interaction_df["x_pos_start_bee%d" % bee].values for bee in (0, 1)]
+    y = [interaction_df["y_pos_start_bee%d" % bee].values for bee in (0, 1)]
+    theta = [interaction_df["theta_start_bee%d" % bee].values for bee in (0, 1)]
+    transformed = {}
+    for focal_bee, non_focal_bee in ((0, 1), (1, 0)):
+        # translation to make the focal bee coordinates the origin
+        x_prime = x[non_focal_bee] - x[focal_bee]
+        y_prime = y[non_focal_bee] - y[focal_bee]
+        # rotation to make the focal bee angle zero
+        cos, sin = np.cos(theta[focal_bee]), np.sin(theta[focal_bee])
+        transformed[focal_bee] = (
+            cos * x_prime + sin * y_prime,
+            -sin * x_prime + cos * y_prime,
+            theta[non_focal_bee] - theta[focal_bee],
+        )
+    return transformed
 
-    # append columns to original vel_change_matrix_df
-    interaction_df[
-        ["focal0_x_trans", "focal0_y_trans", "focal0_theta_trans"]
-    ] = transformed_coords_focal0
-    interaction_df[
-        ["focal1_x_trans", "focal1_y_trans", "focal1_theta_trans"]
-    ] = transformed_coords_focal1
 
+def apply_transformation(interaction_df, dtype=None):
+    """
+    Adds the rounded coordinates and angle of the non-focal bee relative to
+    the focal bee for both bees as focal bee.
+
+    :param interaction_df:
+    :param dtype: e.g. np.int16 for the discretized positions, the rounded
+        floats are kept if None
+    :return: interaction_df with columns focal{0,1}_{x,y,theta}_trans
+    """
+    for focal_bee, coordinates in get_transformed_coordinates(interaction_df).items():
+        for column, values in zip(("x", "y", "theta"), coordinates):
+            # rounded coordinates to discretize positions
+            values = np.round(values)
+            interaction_df["focal%d_%s_trans" % (focal_bee, column)] = (
+                values if dtype is None else values.astype(dtype)
+            )
     return interaction_df
 
 
@@ -735,34 +1538,34 @@ def get_interactions(dt_from=None, dt_to=None, db_connection=None):
         if not events:
             return {None: dict(error="No events found..")}
 
-        # get interactions and velocity changes
-        extracted_interactions_lst = []
-        for key in events:
-            event_dict = events[key]
-            if events[key]:
-                # extract events parameters as interactions
-                interaction_dict = extract_parameters_from_events(event_dict[0])
-                # get velocity changes
-                # "focal" bee
-                (
-                    interaction_dict["vel_change_bee0"],
-                    interaction_dict["rel_change_bee0"],
-                ) = get_velocity_change_per_bee(
-                    bee_id=interaction_dict["bee_id0"],
-                    interaction_start=interaction_dict["interaction_start"],
-                    interaction_end=interaction_dict["interaction_end"],
-                )
-                # "non-focal" bee
-                (
-                    interaction_dict["vel_change_bee1"],
-                    interaction_dict["rel_change_bee1"],
-                ) = get_velocity_change_per_bee(
-                    bee_id=interaction_dict["bee_id1"],
-                    interaction_start=interaction_dict["interaction_start"],
-                    interaction_end=interaction_dict["interaction_end"],
-                )
-                extracted_interactions_lst.append(interaction_dict)
-        return extracted_interactions_lst
+        # get interactions and velocity changes, every bee's velocities are
+        # fetched once for all of its interactions
+        delta_t = datetime.timedelta(0, 30)
+        velocity_store = utils.VelocityStore(
+            dt_from=dt_from - delta_t, dt_to=dt_to + delta_t
+        )
+        for interaction_dict in events:
+            # "focal" bee
+            (
+                interaction_dict["vel_change_bee0"],
+                interaction_dict["rel_change_bee0"],
+            ) = get_velocity_change_per_bee(
+                bee_id=interaction_dict["bee_id0"],
+                interaction_start=interaction_dict["interaction_start"],
+                interaction_end=interaction_dict["interaction_end"],
+                velocity_store=velocity_store,
+            )
+            # "non-focal" bee
+            (
+                interaction_dict["vel_change_bee1"],
+                interaction_dict["rel_change_bee1"],
+            ) = get_velocity_change_per_bee(
+                bee_id=interaction_dict["bee_id1"],
+                interaction_start=interaction_dict["interaction_start"],
+                interaction_end=interaction_dict["interaction_end"],
+                velocity_store=velocity_store,
+            )
+        return events
 
 
 def rotate(theta, vec):
@@ -776,6 +1579,8 @@ def rotate(theta, vec):
 
 
 def get_non_focal_bee_mask(x, y, theta):
+    import cv2
+
     # create empty result frame
     non_focal_bee = np.zeros((29, 29))
 
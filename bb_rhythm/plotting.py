@@ -12,6 +12,7 @@ from skimage import filters
 
 from . import utils
 from . import rhythm
+from . import time
 from . import interactions
 
 
@@ -119,25 +120,38 @@ def plot_weather_subplot(ax, dt_from, dt_to, y_label, column, weather_df):
     ax.set_xlim(xmin=dt_from, xmax=dt_to)
 
 
-def add_grey_nighttime_bars(ax, df):
-    for day in np.unique([day.date() for day in df.date]):
-        day = datetime.datetime.combine(day, df.date.iloc[0].to_pydatetime().time())
-        ax.axvspan(
-            day,
-            day + datetime.timedelta(hours=6),
-            facecolor="lightgrey",
-            edgecolor=None,
-            alpha=0.5,
-            linewidth=0,
-        )
-        ax.axvspan(
-            day + datetime.timedelta(hours=18),
-            day + datetime.timedelta(hours=24),
-            facecolor="lightgrey",
-            linewidth=0,
-            edgecolor=None,
-            alpha=0.5,
+def add_grey_nighttime_bars(ax, df, segmentation=None):
+    """
+    Shades the nights as one collection of grey bars.
+
+    :param ax:
+    :param df: pd.DataFrame with a column date
+    :param segmentation: time.DayNightSegmentation, by default the nights are
+        18:00 to 6:00 of the dates in df
+    :return:
+    """
+    if segmentation is None:
+        dt_from = df.date.min().floor("D")
+        segmentation = time.DayNightSegmentation(
+            dt_from,
+            df.date.max().floor("D") + datetime.timedelta(days=1),
+            day=("6:00", "18:00"),
+            night=("18:00", "6:00"),
+            tz=dt_from.tz,
         )
+    starts, ends = segmentation.get_spans("night")
+    ax.broken_barh(
+        [
+            (start, end - start)
+            for start, end in zip(starts.to_pydatetime(), ends.to_pydatetime())
+        ],
+        (0, 1),
+        transform=ax.get_xaxis_transform(),
+        facecolor="lightgrey",
+        edgecolor=None,
+        alpha=0.5,
+        linewidth=0,
+    )
 
 
 def add_distance_bars(ax, distance_series, n_bins, palette="Greys"):
@@ -1,24 +1,24 @@
+import concurrent.futures
+import functools
 import numpy as np
-import os
 import pandas as pd
 import datetime
 import pytz
 import scipy
-import statsmodels.formula.api as smf
-import statsmodels.sandbox.stats.runs
 import scipy.stats as stats
-from statsmodels.regression.linear_model import RegressionResults
-import statsmodels.stats.stattools
-from statsmodels.tsa.stattools import adfuller
 
 import bb_behavior.db.base
-import bb_circadian.lombscargle
 import bb_behavior.db
 
-from . import time, plotting, utils
+# statsmodels, bb_circadian and the plotting module are imported in the functions
+# using them, so that workers which only fit do not load them
+from . import time, utils, cosinor, diagnostics, statistics
 
 
 def fit_cosinor(X, Y, period=24 * 60 * 60):
+    import statsmodels.formula.api as smf
+    from statsmodels.regression.linear_model import RegressionResults
+
     data = pd.DataFrame()
     data["x"] = X
     data["y"] = Y
@@ -112,6 +112,9 @@ def fit_cosinor_per_bee(timeseries=None, velocities=None, period=24 * 60 * 60):
     :param period:
     :return:
     """
+    import statsmodels.sandbox.stats.runs
+    import statsmodels.stats.stattools
+
     # p_value alpha error correction
     X, Y = timeseries, velocities
 
@@ -132,21 +135,19 @@ def fit_cosinor_per_bee(timeseries=None, velocities=None, period=24 * 60 * 60):
     # p for amplitude
     # z test
     # Confidence Intervals for parameters
-    (ci_mesor, ci_amplitude, ci_acrophase), (
-        p_mesor,
-        p_amplitude,
-        p_acrophase,
-    ) = get_significance_values_cosinor(mesor, amplitude, acrophase, cosinor_fit)
+    (
+        (ci_mesor_lower, ci_mesor_upper),
+        (ci_amplitude_lower, ci_amplitude_upper),
+        (ci_acrophase_lower, ci_acrophase_upper),
+    ), (p_mesor, p_amplitude, p_acrophase) = get_significance_values_cosinor(
+        mesor, amplitude, acrophase, cosinor_fit
+    )
 
     # 1 - statistics of Goodness Of Fit according to Cornelissen (eqs (14) - (15))
     RSS = cosinor_fit.ssr
-    X_periodic = np.round_(X % period, 2)
-    X_unique = np.unique(X_periodic)
-    m = len(X_unique)
-    SSPE = 0
-    for x in X_unique:
-        Y_i_avg = np.mean(Y[X_periodic == x])
-        SSPE += sum((Y[X_periodic == x] - Y_i_avg) ** 2)
+    (SSPE,), (m,) = diagnostics.get_pure_error_sum_of_squares(
+        X, np.asarray(Y, dtype=np.float64), np.zeros(len(X), dtype=np.int64), 1, period
+    )
     SSLOF = RSS - SSPE
 
     # statistics of Goodness Of Fit according to Cornelissen (eqs (14) - (15))
@@ -195,9 +196,12 @@ def fit_cosinor_per_bee(timeseries=None, velocities=None, period=24 * 60 * 60):
         "p_mesor": p_mesor,
         "p_amplitude": p_amplitude,
         "p_acrophase": p_acrophase,
-        "ci_mesor": ci_mesor,
-        "ci_amplitude": ci_amplitude,
-        "ci_acrophase": ci_acrophase,
+        "ci_mesor_lower": ci_mesor_lower,
+        "ci_mesor_upper": ci_mesor_upper,
+        "ci_amplitude_lower": ci_amplitude_lower,
+        "ci_amplitude_upper": ci_amplitude_upper,
+        "ci_acrophase_lower": ci_acrophase_lower,
+        "ci_acrophase_upper": ci_acrophase_upper,
         "p_reject": p_reject,
         "r_squared": r_squared,
         "r_squared_adj": r_squared_adj,
@@ -217,8 +221,12 @@ def circadian_cosine(x, amplitude, phase, offset, period=24 * 60 * 60):
     return np.cos(x * frequency + phase) * amplitude + offset
 
 
+# bounds of the amplitude, phase and offset of the iterative circadian cosine fit
+CIRCADIAN_COSINE_BOUNDS = [(0, -np.inf, 0), (np.inf, np.inf, np.inf)]
+
+
 # This is copied and modified from bb_circadian.lombscargle
-def fit_circadian_cosine(X, Y, phase=0):
+def fit_circadian_cosine(X, Y, phase=0, method="curve_fit"):
     """Fits a cosine wave with a circadian frequency to timestamp-value pairs with the timestamps being in second precision.
 
     Arguments:
@@ -226,18 +234,28 @@ def fit_circadian_cosine(X, Y, phase=0):
             Timestamps in seconds. Do not have to be sorted.
         Y: np.array
             Values for their respective timestamps.
-        fix_minimum: boolean
-            Whether to fix offset = amplitude so that min(f(X)) == 0.
+        phase: float
+            Initial phase of the iterative fit.
+        method: str
+            "curve_fit" fits iteratively with scipy.optimize.curve_fit starting at phase.
+            "linear" solves the fit exactly, see cosinor.fit_circadian_cosine_batch.
+            The result does not depend on the initial phase and the phase is in [-pi, pi].
     Returns:
         Dictionary with all information about a fit.
     """
+    if method == "linear":
+        X = np.asarray(X)
+        fit = cosinor.fit_circadian_cosine_batch(X, Y, [0, len(X)])
+        return {
+            key: value if key == "angular_frequency" else value[0]
+            for key, value in fit.items()
+        }
     amplitude = 3 * np.std(Y) / (2 ** 0.5)
     phase = phase
     offset = np.mean(Y)
     initial_parameters = [amplitude, phase, offset]
-    bounds = [(0, -np.inf, 0), (np.inf, np.inf, np.inf)]
     fit = scipy.optimize.curve_fit(
-        circadian_cosine, X, Y, p0=initial_parameters, bounds=bounds
+        circadian_cosine, X, Y, p0=initial_parameters, bounds=CIRCADIAN_COSINE_BOUNDS
     )
     circadian_cosine_parameters = fit[0]
     y_predicted = circadian_cosine(X, *circadian_cosine_parameters)
@@ -271,7 +289,14 @@ def fit_circadian_cosine(X, Y, phase=0):
 
 
 def collect_fit_data_for_bee_date(
-    bee_id, date, velocities=None, delta=datetime.timedelta(days=1, hours=12), phase=0
+    bee_id,
+    date,
+    velocities=None,
+    delta=datetime.timedelta(days=1, hours=12),
+    phase=0,
+    method="curve_fit",
+    fit_cache=None,
+    second=None,
 ):
     if "offset" in velocities.columns:
         ts = velocities.offset.values
@@ -283,7 +308,25 @@ def collect_fit_data_for_bee_date(
     begin_dt = date - delta
     end_dt = date + delta
 
-    bee_date_data = fit_circadian_cosine(ts, v, phase=phase)
+    if fit_cache is None:
+        bee_date_data = fit_circadian_cosine(ts, v, phase=phase, method=method)
+    else:
+        key = fit_cache.get_key(
+            bee_id,
+            date,
+            24 * 60 * 60,
+            second,
+            "circadian_cosine",
+            ts,
+            v,
+            phase=phase if method != "linear" else None,
+            method=method,
+            bounds=CIRCADIAN_COSINE_BOUNDS if method != "linear" else None,
+            delta=delta,
+        )
+        bee_date_data = fit_cache.get_or_fit(
+            key, bee_id, lambda: fit_circadian_cosine(ts, v, phase=phase, method=method)
+        )
     bee_date_data["bee_id"] = bee_id
     bee_date_data["date"] = date
 
@@ -295,18 +338,27 @@ def collect_fit_data_for_bee_date(
     return bee_date_data
 
 
-def add_velocity_day_night_information(bee_date_data, velocities):
+def add_velocity_day_night_information(bee_date_data, velocities, segmentation=None):
     """
 
     :param bee_date_data:
     :param velocities:
+    :param segmentation: time.DayNightSegmentation covering the velocities, by
+        default day is 9:00 to 18:00 and night is 21:00 to 6:00 UTC
     :return:
     """
-    time_index = pd.DatetimeIndex(velocities.datetime)
-    daytime = time_index.indexer_between_time("9:00", "18:00")
-    nighttime = time_index.indexer_between_time("21:00", "6:00")
-    daytime_velocities = velocities.iloc[daytime].velocity.values
-    nighttime_velocities = velocities.iloc[nighttime].velocity.values
+    if segmentation is None and len(velocities) > 0:
+        segmentation = time.DayNightSegmentation(
+            velocities.datetime.min(), velocities.datetime.max()
+        )
+    labels = (
+        segmentation.get_labels(velocities.datetime)
+        if len(velocities) > 0
+        else np.empty(0, dtype=np.int8)
+    )
+    v = velocities.velocity.values
+    daytime_velocities = v[labels == time.DayNightSegmentation.DAY]
+    nighttime_velocities = v[labels == time.DayNightSegmentation.NIGHT]
     bee_date_data["day_mean"] = np.mean(daytime_velocities)
     bee_date_data["day_std"] = np.std(daytime_velocities)
     bee_date_data["night_mean"] = np.mean(nighttime_velocities)
@@ -314,15 +366,21 @@ def add_velocity_day_night_information(bee_date_data, velocities):
 
 
 def fit_circadianess_fit_per_bee_phase_variation(
-    day=None, bee_id=None, from_dt=None, to_dt=None, bee_age=None, phases=None
+    day=None,
+    bee_id=None,
+    from_dt=None,
+    to_dt=None,
+    bee_age=None,
+    phases=None,
+    method="curve_fit",
+    fit_cache=None,
+    second=None,
 ):
     if bee_age == -1 or bee_age == 0:
         return {None: dict(error="Bee is already dead or new to colony..")}
 
     # fetch velocities
-    velocities = bb_behavior.db.trajectory.get_bee_velocities(
-        bee_id, from_dt, to_dt, confidence_threshold=0.1, max_mm_per_second=15.0
-    )
+    velocities = utils.fetch_velocities_from_db(bee_id, from_dt, to_dt)
 
     if velocities is None:
         return {None: dict(error="No velocities could be fetched..")}
@@ -336,11 +394,20 @@ def fit_circadianess_fit_per_bee_phase_variation(
         # remove NaNs and infs
         velocities = velocities[~pd.isnull(velocities.velocity)]
         data_lst = []
+        fit_data = None
         for phase in phases:
-            # calculate circadianess
-            data = collect_fit_data_for_bee_date(
-                bee_id, day, velocities=velocities, phase=phase
-            )
+            # calculate circadianess, the linear fit does not depend on the phase
+            if method != "linear" or fit_data is None:
+                fit_data = collect_fit_data_for_bee_date(
+                    bee_id,
+                    day,
+                    velocities=velocities,
+                    phase=phase,
+                    method=method,
+                    fit_cache=fit_cache,
+                    second=second,
+                )
+            data = dict(fit_data) if fit_data else fit_data
             if data:
                 # add parameters
                 data["age"] = bee_age
@@ -360,13 +427,13 @@ def fit_circadianess_fit_per_bee_phase_variation(
 def fit_circadianess_fit_per_bee(
     day=None, bee_id=None, from_dt=None, to_dt=None, bee_age=None
 ):
+    import bb_circadian.lombscargle
+
     if bee_age == -1 or bee_age == 0:
         return {None: dict(error="Bee is already dead or new to colony..")}
 
     # fetch velocities
-    velocities = bb_behavior.db.trajectory.get_bee_velocities(
-        bee_id, from_dt, to_dt, confidence_threshold=0.1, max_mm_per_second=15.0
-    )
+    velocities = utils.fetch_velocities_from_db(bee_id, from_dt, to_dt)
 
     if velocities is None:
         return {None: dict(error="No velocities could be fetched..")}
@@ -398,13 +465,24 @@ def fit_circadianess_fit_per_bee(
     return data
 
 
-def fit_cosinor_fit_per_bee(day=None, bee_id=None, velocities=None, bee_age=None):
+def fit_cosinor_fit_per_bee(
+    day=None,
+    bee_id=None,
+    velocities=None,
+    bee_age=None,
+    fit_cache=None,
+    second=None,
+    segmentation=None,
+):
     """
 
     :param day:
     :param bee_id:
     :param velocities:
     :param bee_age:
+    :param fit_cache: utils.FitResultCache, the fit is not cached if None
+    :param second: rounding of the velocities in seconds, part of the cache key
+    :param segmentation: time.DayNightSegmentation for the day and night velocities
     :return:
     """
     # get right data types
@@ -424,7 +502,11 @@ def fit_cosinor_fit_per_bee(day=None, bee_id=None, velocities=None, bee_age=None
     assert v.shape[0] == ts.shape[0]
 
     # calculate circadianess
-    data = fit_cosinor_per_bee(ts, v)
+    if fit_cache is None:
+        data = fit_cosinor_per_bee(ts, v)
+    else:
+        key = fit_cache.get_key(bee_id, day, 24 * 60 * 60, second, "cosinor", ts, v)
+        data = fit_cache.get_or_fit(key, bee_id, lambda: fit_cosinor_per_bee(ts, v))
     if data:
         # add parameters
         data["bee_id"] = bee_id
@@ -433,7 +515,7 @@ def fit_cosinor_fit_per_bee(day=None, bee_id=None, velocities=None, bee_age=None
         # parameters for quality of velocities
         add_velocity_quality_params(data, velocities)
         # extract from parameters of fit
-        add_velocity_day_night_information(data, velocities)
+        add_velocity_day_night_information(data, velocities, segmentation)
     return data
 
 
@@ -515,16 +597,11 @@ def calculate_well_tested_circadianess_cosinor(circadianess_df):
 
 def extract_fit_parameters(circadianess_df):
     # extract parameters (amplitude, phase, offset) from fit
-    amplitude = []
-    phase = []
-    offset = []
-    for p in circadianess_df["parameters"]:
-        amplitude.append(p[0])
-        phase.append(p[1])
-        offset.append(p[2])
-    circadianess_df["amplitude"] = amplitude
-    circadianess_df["phase"] = phase
-    circadianess_df["offset"] = offset
+    parameters = np.array(circadianess_df["parameters"].tolist(), dtype=np.float64)
+    parameters = parameters.reshape(len(circadianess_df), 3)
+    circadianess_df["amplitude"] = parameters[:, 0]
+    circadianess_df["phase"] = parameters[:, 1]
+    circadianess_df["offset"] = parameters[:, 2]
     return circadianess_df
 
 
@@ -564,6 +641,8 @@ def add_phase_plt_to_df_cosinor(circadianess_df, period=24):
 
 
 def create_phase_per_date_df(circadianess_df):
+    from . import plotting
+
     circadianess_df_plt = plotting.apply_three_group_age_map_for_plotting_phase(
         circadianess_df
     )
@@ -601,42 +680,164 @@ def create_phase_per_date_df(circadianess_df):
     return pd.DataFrame(phase_per_date_df_ls)
 
 
-def get_overall_velocity_mean(from_dt, to_dt):
+class VelocityMeanAccumulator:
+    """
+    Streaming mean velocity over many bees on a fixed time grid. Each bee's
+    velocities are folded into per-bin sums and counts as they arrive, so the
+    memory only depends on the time range and resolution.
+    """
+
+    def __init__(self, from_dt, to_dt, resolution=datetime.timedelta(seconds=1)):
+        self.from_dt = pd.Timestamp(from_dt)
+        self.resolution = pd.Timedelta(resolution)
+        self.n_bins = int(np.ceil((pd.Timestamp(to_dt) - self.from_dt) / self.resolution))
+        self.velocity_sum = np.zeros(self.n_bins)
+        self.count = np.zeros(self.n_bins, dtype=np.int64)
+
+    def add(self, velocities):
+        """
+        Folds the velocities of one bee into the accumulator. NaNs and velocities
+        outside of the time range are ignored.
+
+        :param velocities: pd.DataFrame with columns "datetime" and "velocity"
+        """
+        bins = (
+            utils.get_utc_nanoseconds(velocities["datetime"])
+            - utils.get_utc_nanoseconds(self.from_dt)
+        ) // self.resolution.value
+        v = velocities["velocity"].values.astype(np.float64)
+        is_valid = (bins >= 0) & (bins < self.n_bins) & np.isfinite(v)
+        bins, v = bins[is_valid], v[is_valid]
+        if len(bins) == 0:
+            return
+        bin_min = bins.min()
+        bins -= bin_min
+        bin_max = bin_min + bins.max() + 1
+        self.velocity_sum[bin_min:bin_max] += np.bincount(bins, weights=v)
+        self.count[bin_min:bin_max] += np.bincount(bins)
+
+    def merge(self, other):
+        """
+        Adds the sums and counts of another accumulator with the same time grid.
+
+        :param other: VelocityMeanAccumulator
+        :return: self
+        """
+        assert (self.from_dt, self.resolution, self.n_bins) == (
+            other.from_dt,
+            other.resolution,
+            other.n_bins,
+        )
+        self.velocity_sum += other.velocity_sum
+        self.count += other.count
+        return self
+
+    def to_frame(self):
+        """
+        Returns the mean velocity per time bin with at least one velocity.
+
+        :return: pd.DataFrame with columns "datetime" and "velocity"
+        """
+        has_data = self.count > 0
+        return pd.DataFrame(
+            {
+                "datetime": self.from_dt
+                + pd.to_timedelta(
+                    np.flatnonzero(has_data) * self.resolution.value, unit="ns"
+                ),
+                "velocity": self.velocity_sum[has_data] / self.count[has_data],
+            }
+        )
+
+    def rolling_mean(self, window="12h"):
+        """
+        Rolling mean over the time bins with data of the mean velocities, like
+        to_frame().set_index("datetime").rolling(window).mean().
+
+        :param window: window length
+        :return: np.array aligned with the rows of to_frame()
+        """
+        has_data = self.count > 0
+        means = np.zeros(self.n_bins)
+        means[has_data] = self.velocity_sum[has_data] / self.count[has_data]
+        window_bins = max(int(pd.Timedelta(window) / self.resolution), 1)
+        mean_sum = np.concatenate([[0.0], np.cumsum(means)])
+        bin_count = np.concatenate([[0], np.cumsum(has_data)])
+        end = np.flatnonzero(has_data) + 1
+        start = np.maximum(end - window_bins, 0)
+        return (mean_sum[end] - mean_sum[start]) / (bin_count[end] - bin_count[start])
+
+
+def accumulate_overall_velocity_mean(
+    from_dt, to_dt, resolution=datetime.timedelta(seconds=1), n_workers=0
+):
+    """
+    Streams the velocities of all alive bees into a VelocityMeanAccumulator. With
+    n_workers > 0 the bees are fetched concurrently into partial accumulators
+    that are merged afterwards, every worker with its own database connection.
+
+    :param from_dt:
+    :param to_dt:
+    :param resolution: time grid resolution
+    :param n_workers: number of concurrent fetching threads
+    :return: VelocityMeanAccumulator
+    """
     # get alive bees
     alive_bees = list(bb_behavior.db.get_alive_bees(from_dt, to_dt))
 
-    velocities = pd.DataFrame(columns=["velocity", "datetime"])
-    # iterate through all bees
-    for bee_id in alive_bees:
-        # fetch velocities
-        velocities = pd.concat(
-            [
-                velocities,
-                bb_behavior.db.trajectory.get_bee_velocities(
-                    bee_id,
-                    from_dt,
-                    to_dt,
-                    confidence_threshold=0.1,
-                    max_mm_per_second=15.0,
-                )[["velocity", "datetime"]],
-            ],
-            axis=0,
+    def accumulate(bee_ids, cursor=None):
+        accumulator = VelocityMeanAccumulator(from_dt, to_dt, resolution=resolution)
+        for bee_id in bee_ids:
+            # fetch velocities
+            velocities = utils.fetch_velocities_from_db(
+                bee_id, from_dt, to_dt, cursor=cursor
+            )
+            if velocities is not None:
+                accumulator.add(velocities)
+        return accumulator
+
+    def accumulate_with_connection(bee_ids):
+        # connections and cursors must not be shared between threads
+        with bb_behavior.db.base.get_database_connection(
+            application_name="accumulate_overall_velocity_mean"
+        ) as db:
+            return accumulate(bee_ids, cursor=db.cursor())
+
+    if n_workers <= 0:
+        return accumulate(alive_bees)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        partial_accumulators = list(
+            executor.map(
+                accumulate_with_connection,
+                [alive_bees[i::n_workers] for i in range(n_workers)],
+            )
         )
-    velocities = velocities.groupby(["datetime"])["velocity"].mean().reset_index()
-    return velocities
+    return functools.reduce(
+        lambda left, right: left.merge(right), partial_accumulators
+    )
+
+
+def get_overall_velocity_mean(
+    from_dt, to_dt, resolution=datetime.timedelta(seconds=1), n_workers=0
+):
+    accumulator = accumulate_overall_velocity_mean(
+        from_dt, to_dt, resolution=resolution, n_workers=n_workers
+    )
+    return accumulator.to_frame()
 
 
-def get_normalized_velocities(dt_from, dt_to):
-    velocities_mean = get_overall_velocity_mean(
-        dt_from - datetime.timedelta(hours=6), dt_to + datetime.timedelta(hours=6)
-    )[["velocity", "datetime"]]
+def get_normalized_velocities(
+    dt_from, dt_to, resolution=datetime.timedelta(seconds=1), n_workers=0
+):
+    accumulator = accumulate_overall_velocity_mean(
+        dt_from - datetime.timedelta(hours=6),
+        dt_to + datetime.timedelta(hours=6),
+        resolution=resolution,
+        n_workers=n_workers,
+    )
+    velocities_mean = accumulator.to_frame()
     velocities_mean["velocity_normalized"] = (
-        velocities_mean.velocity.values
-        - velocities_mean.set_index("datetime")
-        .rolling("12h")
-        .mean()
-        .reset_index()["velocity"]
-        .values
+        velocities_mean.velocity.values - accumulator.rolling_mean("12h")
     )
     return velocities_mean[
         (dt_from <= velocities_mean.datetime) & (velocities_mean.datetime < dt_to)
@@ -662,7 +863,7 @@ def get_constant_fit(velocities):
 
 def get_raw_phase_df(file, velocities_path):
     bee_id = int(file[:-7])
-    velocities = pd.read_pickle(os.path.join(velocities_path, file))
+    velocities = utils.read_velocities_pickle(bee_id, velocities_path)
     velocities["datetime"] = velocities["datetime"].dt.round("2min")
     velocities = velocities.groupby(["datetime"])["velocity"].mean().reset_index()
     velocities["date"] = velocities.datetime.dt.date
@@ -692,7 +893,13 @@ def get_raw_phase_df(file, velocities_path):
 
 
 def create_10_min_mean_velocity_df_per_bee(
-    bee_id, dt_from, dt_to, velocity_df_path=None, cursor=None
+    bee_id,
+    dt_from,
+    dt_to,
+    velocity_df_path=None,
+    cursor=None,
+    age_index=None,
+    cache=None,
 ):
     """
 
@@ -701,15 +908,16 @@ def create_10_min_mean_velocity_df_per_bee(
     :param dt_to:
     :param velocity_df_path:
     :param cursor:
+    :param age_index: utils.BeeAgeIndex, fetched for the bee if None
+    :param cache: utils.VelocityCache shared by the velocity readers of a job
     :return:
     """
     # set dates
-    delta = datetime.timedelta(days=1)
     dates = list(pd.date_range(start=dt_from, end=dt_to, tz=pytz.UTC).to_pydatetime())
 
     # get velocities
     velocities = utils.fetch_velocities_from_remote_or_db(
-        bee_id, dt_to, dt_from, velocity_df_path
+        bee_id, dt_to, dt_from, velocity_df_path, cache=cache
     )
 
     # if empty return None
@@ -722,25 +930,20 @@ def create_10_min_mean_velocity_df_per_bee(
         }
     velocities.drop(columns=["time_passed"], inplace=True)
 
-    bee_age_lst = []
-
-    # iterate through all dates to get bee age
-    for current_dt in dates:
-        from_dt = current_dt
-        to_dt = current_dt + delta
-        bee_age = int(
-            bb_behavior.db.metadata.get_bee_ages(
-                [(bee_id, from_dt.date())], cursor=cursor
-            )[0][2]
+    # add age of the 24 h window starting at dt_from + n days which contains
+    # the velocity, velocities outside of the windows get age -1
+    if age_index is None:
+        age_index = utils.BeeAgeIndex.from_db(
+            [bee_id], dates[0], dates[-1], cursor=cursor
         )
-        # subset velocities
-        current_velocities = velocities[
-            (velocities["datetime"] >= from_dt) & (velocities["datetime"] < to_dt)
-        ]
-        bee_age_lst.extend([bee_age] * len(current_velocities))
-
-    # add age
-    velocities["age"] = bee_age_lst
+    window_ages = age_index.get_ages(bee_id, dates)
+    window = np.asarray(
+        (velocities["datetime"] - dates[0]) // datetime.timedelta(days=1)
+    )
+    is_in_window = (window >= 0) & (window < len(dates))
+    velocities["age"] = np.where(
+        is_in_window, window_ages[np.clip(window, 0, len(dates) - 1)], -1
+    )
     # remove -1 ages
     velocities = velocities[velocities.age != -1]
     # remove NaNs
@@ -756,7 +959,16 @@ def create_10_min_mean_velocity_df_per_bee(
 
 
 def create_cosinor_df_per_bee_time_period(
-    bee_id, to_dt, from_dt, second=60, velocity_df_path=None
+    bee_id,
+    to_dt,
+    from_dt,
+    second=60,
+    velocity_df_path=None,
+    sliding=False,
+    age_index=None,
+    fit_cache=None,
+    cache=None,
+    delta=datetime.timedelta(days=1, hours=12),
 ):
     """
 
@@ -765,11 +977,19 @@ def create_cosinor_df_per_bee_time_period(
     :param from_dt:
     :param second:
     :param velocity_df_path:
+    :param sliding: if True, the windows are fitted with running sums via
+        cosinor.fit_cosinor_sliding_window, which only yields the cosinor
+        parameters and F-test statistics but no goodness of fit statistics
+    :param age_index: utils.BeeAgeIndex, fetched for the bee if None
+    :param fit_cache: utils.FitResultCache for the per day fits
+    :param cache: utils.VelocityCache shared by the velocity readers of a job
+    :param delta: half of the fit window around each date, the sliding fit is
+        only used if it is a multiple of 12 hours
     :return:
     """
     # get velocities
     velocities = utils.fetch_velocities_from_remote_or_db(
-        bee_id, to_dt, from_dt, velocity_df_path
+        bee_id, to_dt, from_dt, velocity_df_path, cache=cache
     )
     if velocities is None:
         return {None: dict(error="No velocities could be fetched..")}
@@ -787,10 +1007,12 @@ def create_cosinor_df_per_bee_time_period(
         return {None: dict(error="No velocities could be fetched..")}
 
     # test for stationarity of velocities
-    p_adfuller = adfuller(velocities.velocity, regression="ct")[1]
+    p_adfuller = statistics.get_adf_p_values(
+        [velocities.velocity.values], regression="ct"
+    )[0]
 
     # iterate through dates of time interval and calculate cosinor fit
-    # per day with a time window of 3 consecutive days
+    # per day with a time window of date +- delta
     dates = list(
         pd.date_range(
             start="2019-08-20 12:00:00+00:00",
@@ -798,13 +1020,18 @@ def create_cosinor_df_per_bee_time_period(
             tz=pytz.UTC,
         ).to_pydatetime()
     )
-    delta = datetime.timedelta(days=1, hours=12)
-    data_ls = []
-    for current_dt in dates:
-        # get bee age
-        bee_age = int(
-            bb_behavior.db.metadata.get_bee_ages([(bee_id, current_dt.date())])[0][2]
+    if age_index is None:
+        age_index = utils.BeeAgeIndex.from_db([bee_id], dates[0], dates[-1])
+    bee_ages = age_index.get_ages(bee_id, dates)
+    segmentation = time.DayNightSegmentation(dates[0] - delta, dates[-1] + delta)
+    # the sliding fit needs windows of whole days, other windows are fitted exactly
+    if sliding and delta % datetime.timedelta(hours=12) == datetime.timedelta(0):
+        return create_sliding_cosinor_df(
+            bee_id, velocities, dates, bee_ages, delta, p_adfuller, second
         )
+    data_ls = []
+    for current_dt, bee_age in zip(dates, bee_ages):
+        bee_age = int(bee_age)
         # "Bee is already dead or new to colony.."
         if bee_age == -1 or bee_age == 0:
             continue
@@ -818,26 +1045,114 @@ def create_cosinor_df_per_bee_time_period(
             continue
 
         # get circadian fit data
-        data = pd.DataFrame(
-            fit_cosinor_fit_per_bee(
-                day=current_dt,
-                bee_id=bee_id,
-                velocities=current_velocities,
-                bee_age=bee_age,
-            )
+        data = fit_cosinor_fit_per_bee(
+            day=current_dt,
+            bee_id=bee_id,
+            velocities=current_velocities,
+            bee_age=bee_age,
+            fit_cache=fit_cache,
+            second=second,
+            segmentation=segmentation,
         )
         data["ad_fuller"] = p_adfuller
         data["fit_type"] = second
         data_ls.append(data)
 
-    # concat cosinor data to dataframe
+    # one row per fit
     if len(data_ls) > 0:
-        cosinor_df = pd.concat(data_ls)
+        cosinor_df = set_fit_record_dtypes(pd.DataFrame.from_records(data_ls))
     else:
         cosinor_df = {None: dict(error="No velocities could be fetched or bee is dead")}
     return cosinor_df
 
 
+def create_sliding_cosinor_df(
+    bee_id, velocities, dates, bee_ages, delta, p_adfuller, second
+):
+    """
+    Fits the cosinor model per day with a window of date +- delta using running
+    sums, so that every velocity is only accumulated once.
+
+    :param bee_id:
+    :param velocities:
+    :param dates: consecutive dates with a step of one day
+    :param bee_ages: bee age per date
+    :param delta: multiple of 12 hours, so that the windows consist of whole days
+    :param p_adfuller:
+    :param second:
+    :return:
+    """
+    if delta % datetime.timedelta(hours=12) != datetime.timedelta(0):
+        raise ValueError(
+            "delta has to be a multiple of 12 hours for the sliding fit, got %s" % delta
+        )
+    # bins of one day, windows of 2 * delta
+    origin = dates[0] - delta
+    window_size = int(2 * delta / datetime.timedelta(days=1))
+    bin_edges = (
+        np.arange(len(dates) + window_size) * datetime.timedelta(days=1).total_seconds()
+    )
+    ts = (velocities.datetime - origin).dt.total_seconds().values
+    references = np.array([(date - origin).total_seconds() for date in dates])
+    fits = cosinor.fit_cosinor_sliding_window(
+        ts,
+        velocities.velocity.values,
+        bin_edges,
+        window_size=window_size,
+        references=references,
+    )
+    fits.pop("params")
+    fits.pop("cov_params")
+    cosinor_df = pd.DataFrame(fits)
+    cosinor_df["bee_id"] = bee_id
+    cosinor_df["date"] = dates
+    cosinor_df["age"] = bee_ages
+    cosinor_df["ad_fuller"] = p_adfuller
+    cosinor_df["fit_type"] = second
+
+    # "Bee is already dead or new to colony.." or no velocities in window
+    cosinor_df = cosinor_df[
+        (cosinor_df.age != -1) & (cosinor_df.age != 0) & (cosinor_df.n_data_points > 0)
+    ]
+    if len(cosinor_df) == 0:
+        return {None: dict(error="No velocities could be fetched or bee is dead")}
+    return set_fit_record_dtypes(cosinor_df.reset_index(drop=True))
+
+
+# compact dtypes of the fit result tables, the fit statistics stay float64
+fit_record_dtypes = {
+    "bee_id": np.int64,
+    "age": np.int32,
+    "fit_type": np.int32,
+    "n_data_points": np.int64,
+    "data_point_dist_max": np.float32,
+    "data_point_dist_min": np.float32,
+    "data_point_dist_mean": np.float32,
+    "data_point_dist_median": np.float32,
+    "day_mean": np.float32,
+    "day_std": np.float32,
+    "night_mean": np.float32,
+    "night_std": np.float32,
+}
+
+
+def set_fit_record_dtypes(fit_df):
+    """
+    Casts the columns of a fit result table with one row per fit to the
+    fit_record_dtypes.
+
+    :param fit_df: pd.DataFrame
+    :return: pd.DataFrame
+    """
+    return fit_df.astype(
+        {
+            column: dtype
+            for column, dtype in fit_record_dtypes.items()
+            if column in fit_df.columns
+        }
+    )
+
+
 def create_grid_from_df(df, var, aggfunc):
     return pd.pivot_table(
         df, index="y", aggfunc=aggfunc, columns="x", values=var
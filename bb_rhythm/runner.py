@@ -0,0 +1,283 @@
+import concurrent.futures
+import multiprocessing.shared_memory
+import os
+
+import numpy as np
+import pandas as pd
+
+from . import utils
+
+
+class _SharedMemoryArray(np.ndarray):
+    """
+    Array on a shared memory block which keeps the block attached. numpy does
+    not collapse the base of views past subclasses, so every view of the
+    array, e.g. a column of a pd.DataFrame, keeps the block attached.
+    """
+
+
+def _attach_shared_array(name, n_rows, dtype):
+    block = multiprocessing.shared_memory.SharedMemory(name=name)
+    values = _SharedMemoryArray((n_rows,), dtype=dtype, buffer=block.buf)
+    values.shared_memory = block
+    values.flags.writeable = False
+    return values.view(np.ndarray)
+
+
+class SharedFrame:
+    """
+    Read-only pd.DataFrame whose numeric and datetime columns are kept in shared
+    memory, so that worker processes attach to them instead of receiving a
+    pickled copy per task. Other columns are pickled with the frame.
+    """
+
+    def __init__(self, df):
+        self.index = df.index if not isinstance(df.index, pd.RangeIndex) else None
+        self.n_rows = len(df)
+        self.column_order = list(df.columns)
+        self.columns = []
+        self.object_columns = {}
+        self.shared_memory = []
+        for column in df.columns:
+            values = df[column]
+            tz = None
+            if pd.api.types.is_datetime64_any_dtype(values):
+                tz = values.dt.tz
+                values = utils.get_utc_nanoseconds(values)
+            elif pd.api.types.is_numeric_dtype(values) and not isinstance(
+                values.dtype, pd.CategoricalDtype
+            ):
+                values = values.values
+            else:
+                self.object_columns[column] = values.values
+                continue
+            block = multiprocessing.shared_memory.SharedMemory(
+                create=True, size=max(values.nbytes, 1)
+            )
+            np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+            self.shared_memory.append(block)
+            self.columns.append(
+                (column, block.name, values.dtype.str, str(df[column].dtype), tz)
+            )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shared_memory"] = []
+        return state
+
+    def to_frame(self):
+        """
+        Attaches to the shared memory and returns the frame. The numeric and
+        datetime columns are read-only views on the shared memory, which stays
+        attached as long as any of them lives.
+
+        :return: pd.DataFrame
+        """
+        columns = {}
+        for column, name, dtype, column_dtype, tz in self.columns:
+            values = _attach_shared_array(name, self.n_rows, np.dtype(dtype))
+            if column_dtype.startswith("datetime64"):
+                # the utc nanoseconds are wrapped without a copy
+                values = pd.arrays.DatetimeArray(
+                    values.view("datetime64[ns]"),
+                    dtype=pd.DatetimeTZDtype(tz=tz) if tz is not None else None,
+                    copy=False,
+                )
+            columns[column] = values
+        columns.update(self.object_columns)
+        # without copy=False and in column order, pandas would copy the columns
+        return pd.DataFrame(
+            {column: columns[column] for column in self.column_order},
+            index=self.index,
+            copy=False,
+        )
+
+    def unlink(self):
+        for block in self.shared_memory:
+            block.close()
+            block.unlink()
+        self.shared_memory = []
+
+
+def share_inputs(inputs):
+    """
+    Moves large read-only inputs to shared memory. pd.DataFrames and
+    utils.BeeAgeIndex are shared, other inputs are passed as they are.
+
+    :param inputs: dict of keyword argument name to input
+    :return: dict of keyword argument name to (type, shared input)
+    """
+    shared_inputs = {}
+    for name, value in inputs.items():
+        if isinstance(value, utils.BeeAgeIndex):
+            shared_inputs[name] = ("age_index", SharedFrame(value.ages_df))
+        elif isinstance(value, pd.DataFrame):
+            shared_inputs[name] = ("frame", SharedFrame(value))
+        else:
+            shared_inputs[name] = ("value", value)
+    return shared_inputs
+
+
+def resolve_shared_inputs(shared_inputs):
+    inputs = {}
+    for name, (input_type, value) in shared_inputs.items():
+        if input_type == "age_index":
+            inputs[name] = utils.BeeAgeIndex(value.to_frame())
+        elif input_type == "frame":
+            inputs[name] = value.to_frame()
+        else:
+            inputs[name] = value
+    return inputs
+
+
+_worker_inputs = {}
+
+
+def _init_worker(shared_inputs, velocity_cache_bytes=None):
+    _worker_inputs.update(resolve_shared_inputs(shared_inputs))
+    if velocity_cache_bytes is not None:
+        # one velocity cache per worker, shared by all of its jobs
+        _worker_inputs["cache"] = utils.VelocityCache(max_bytes=velocity_cache_bytes)
+
+
+def _run_job(func, bee_id, kwargs):
+    try:
+        return bee_id, func(bee_id, **kwargs, **_worker_inputs)
+    except Exception as e:
+        return bee_id, {None: dict(error="%s: %s" % (type(e).__name__, e))}
+
+
+def get_job_weights(bee_ids, velocity_df_path=None):
+    """
+    Estimates the work per bee from the size of its velocity pickle. All bees
+    get the same weight if there is no velocity path.
+
+    :param bee_ids:
+    :param velocity_df_path:
+    :return: dict of bee_id to weight
+    """
+    weights = {}
+    for bee_id in bee_ids:
+        try:
+            weights[bee_id] = os.path.getsize(
+                os.path.join(velocity_df_path, "%d.pickle" % bee_id)
+            )
+        except (OSError, TypeError):
+            weights[bee_id] = 0
+    return weights
+
+
+def iterate_per_bee_jobs(
+    func,
+    bee_ids,
+    dt_from,
+    dt_to,
+    n_workers=None,
+    date_arguments=("dt_from", "dt_to"),
+    weights=None,
+    shared_inputs=None,
+    velocity_cache_bytes=None,
+    **kwargs
+):
+    """
+    Runs func(bee_id, dt_from, dt_to, **kwargs, **shared_inputs) for all bees in
+    a local process pool and yields (bee_id, result) as the jobs finish. Bees
+    are scheduled largest first for load balance. Large read-only inputs such as
+    the weather frame or the age index are passed via shared memory once per
+    worker instead of being pickled per job.
+
+    :param func: module level per bee function, e.g.
+        rhythm.create_cosinor_df_per_bee_time_period
+    :param bee_ids:
+    :param dt_from:
+    :param dt_to:
+    :param n_workers: number of processes, defaults to the number of cpus
+    :param date_arguments: names of the keyword arguments of func for dt_from and dt_to
+    :param weights: dict of bee_id to expected work, defaults to the size of the
+        velocity pickles in kwargs["velocity_df_path"]
+    :param shared_inputs: dict of keyword argument name to pd.DataFrame,
+        utils.BeeAgeIndex or other input shared by all jobs
+    :param velocity_cache_bytes: if given, every worker passes a
+        utils.VelocityCache of this size as cache to func, so that the jobs of a
+        worker share the velocities they read
+    :param kwargs: further keyword arguments of func
+    :return: generator of (bee_id, result)
+    """
+    if weights is None:
+        weights = get_job_weights(bee_ids, kwargs.get("velocity_df_path"))
+    bee_ids = sorted(bee_ids, key=lambda bee_id: weights.get(bee_id, 0), reverse=True)
+    kwargs = dict(kwargs, **{date_arguments[0]: dt_from, date_arguments[1]: dt_to})
+
+    shared_inputs = share_inputs(shared_inputs or {})
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_worker,
+            initargs=(shared_inputs, velocity_cache_bytes),
+        ) as executor:
+            futures = [
+                executor.submit(_run_job, func, bee_id, kwargs) for bee_id in bee_ids
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+    finally:
+        for _, value in shared_inputs.values():
+            if isinstance(value, SharedFrame):
+                value.unlink()
+
+
+def run_per_bee_jobs(
+    func,
+    bee_ids,
+    dt_from,
+    dt_to,
+    n_workers=None,
+    output_path=None,
+    date_arguments=("dt_from", "dt_to"),
+    weights=None,
+    shared_inputs=None,
+    velocity_cache_bytes=None,
+    **kwargs
+):
+    """
+    Runs a per bee function for all bees in parallel, see iterate_per_bee_jobs,
+    and collects the resulting data frames in one table. Results which are not
+    data frames, e.g. {None: dict(error=...)}, are collected as errors.
+
+    :param func:
+    :param bee_ids:
+    :param dt_from:
+    :param dt_to:
+    :param n_workers:
+    :param output_path: if given, the table is pickled to this path
+    :param date_arguments:
+    :param weights:
+    :param shared_inputs:
+    :param velocity_cache_bytes:
+    :param kwargs:
+    :return: (pd.DataFrame, dict of bee_id to error)
+    """
+    result_dfs = []
+    errors = {}
+    for bee_id, result in iterate_per_bee_jobs(
+        func,
+        bee_ids,
+        dt_from,
+        dt_to,
+        n_workers=n_workers,
+        date_arguments=date_arguments,
+        weights=weights,
+        shared_inputs=shared_inputs,
+        velocity_cache_bytes=velocity_cache_bytes,
+        **kwargs
+    ):
+        if isinstance(result, pd.DataFrame):
+            result_dfs.append(result)
+        else:
+            errors[bee_id] = result
+    result_df = (
+        pd.concat(result_dfs, ignore_index=True) if result_dfs else pd.DataFrame()
+    )
+    if output_path is not None:
+        result_df.to_pickle(output_path)
+    return result_df, errors
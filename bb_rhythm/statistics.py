@@ -1,10 +1,8 @@
+import collections
+import hashlib
 import scipy
-from sklearn.linear_model import HuberRegressor
-from sklearn.preprocessing import PolynomialFeatures
-from statsmodels import api as sm
-import statsmodels
-from statsmodels.formula import api as smf
-from statsmodels.tsa.stattools import adfuller
+import scipy.fft
+import scipy.signal
 import numpy as np
 import pandas as pd
 
@@ -19,6 +17,9 @@ def calculate_regression(
     epsilon=1.35,
     alpha=0.0001,
 ):
+    from statsmodels import api as sm
+    from statsmodels.formula import api as smf
+
     # define predictor and response variables
     y = df[y_column]
     x = df[x_column]
@@ -47,6 +48,8 @@ def calculate_regression(
 
     elif type == "polynomial":
         # define polynomial x values
+        from sklearn.preprocessing import PolynomialFeatures
+
         polynomial_features = PolynomialFeatures(degree=degree)
         xp = polynomial_features.fit_transform(X)
 
@@ -57,6 +60,8 @@ def calculate_regression(
         fit = sm.GLM(y, X, family=sm.families.Poisson()).fit()
 
     elif type == "huber":
+        from sklearn.linear_model import HuberRegressor
+
         fit = HuberRegressor(epsilon=epsilon, alpha=alpha).fit(X, y)
 
     elif type == "log":
@@ -183,29 +188,102 @@ def time_lagged_cross_correlation(p, q):
     return c
 
 
-def apply_time_lagged_cross_correlation_to_df(df, y_variable="velocity"):
-    df.velocity.replace(np.inf, np.nan).replace(-np.inf, np.nan).dropna(inplace=True)
+def batch_time_lagged_cross_correlation(x, y, max_lag=None):
+    """
+    Normalized cross-correlation as in time_lagged_cross_correlation of many pairs
+    of series on a common time grid at once via FFT, limited to the lags in
+    [-max_lag, max_lag]. Samples where x or y is NaN are left out of the
+    normalization and do not contribute to the correlation.
+
+    :param x: np.array of shape (..., T), e.g. velocities
+    :param y: np.array broadcastable to x, e.g. weather parameters
+    :param max_lag: maximum lag in samples, defaults to T - 1
+    :return: (np.array of shape (..., 2 * max_lag + 1), np.array of lags)
+    """
+    x, y = np.broadcast_arrays(
+        np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    )
+    n_samples = x.shape[-1]
+    max_lag = n_samples - 1 if max_lag is None else min(max_lag, n_samples - 1)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    n = valid.sum(axis=-1, keepdims=True)
+
+    def normalize(values):
+        mean = np.where(valid, values, 0).sum(axis=-1, keepdims=True) / n
+        centered = np.where(valid, values - mean, 0)
+        return centered, np.sqrt((centered**2).sum(axis=-1, keepdims=True) / n)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x, x_std = normalize(x)
+        y, y_std = normalize(y)
+        x = x / (x_std * n)
+        y = y / y_std
+
+    # zero padding to at least n_samples + max_lag avoids circular wrap around
+    length = scipy.fft.next_fast_len(n_samples + max_lag, real=True)
+    correlation = scipy.fft.irfft(
+        scipy.fft.rfft(x, length) * np.conj(scipy.fft.rfft(y, length)), length
+    )
+    lags = np.arange(-max_lag, max_lag + 1)
+    ccr = correlation[..., lags % length]
+    ccr[~np.all(np.isfinite(np.concatenate([x, y], axis=-1)), axis=-1)] = np.nan
+    return ccr, lags
+
+
+def get_max_min_cross_correlation(x, y, max_lag=None, lag_unit=10 / 60):
+    """
+    Maximum and minimum of the cross-correlations of many pairs of series and
+    their lags, see batch_time_lagged_cross_correlation.
+
+    :param x: np.array of shape (..., T)
+    :param y: np.array broadcastable to x
+    :param max_lag: maximum lag in samples
+    :param lag_unit: factor from samples to the lag unit, hours for 10 minute samples
+    :return: dict of np.arrays "max_corr", "max_lag", "min_corr" and "min_lag"
+    """
+    ccr, lags = batch_time_lagged_cross_correlation(x, y, max_lag=max_lag)
+    has_ccr = ~np.all(np.isnan(ccr), axis=-1)
+    max_index = np.argmax(np.where(np.isnan(ccr), -np.inf, ccr), axis=-1)
+    min_index = np.argmin(np.where(np.isnan(ccr), np.inf, ccr), axis=-1)
+    max_corr = np.take_along_axis(ccr, max_index[..., None], axis=-1)[..., 0]
+    min_corr = np.take_along_axis(ccr, min_index[..., None], axis=-1)[..., 0]
+    return {
+        "max_corr": np.where(has_ccr, max_corr, np.nan),
+        "max_lag": np.where(has_ccr, lags[max_index] * lag_unit, np.nan),
+        "min_corr": np.where(has_ccr, min_corr, np.nan),
+        "min_lag": np.where(has_ccr, lags[min_index] * lag_unit, np.nan),
+    }
+
+
+def apply_time_lagged_cross_correlation_to_df(df, y_variable="velocity", tester=None):
+    """
+
+    :param df:
+    :param y_variable:
+    :param tester: StationarityTester caching the ADF p-values, e.g. of the
+        weather shared by many bees, nothing is cached if None
+    :return:
+    """
     if len(df) == 0:
         print("df contains only nans: %s" % str(df))
         return None
-    try:
-        p_value_velocity = adfuller(df[y_variable])[1]
-    except (ValueError, statsmodels.tools.sm_exceptions.MissingDataError):
-        p_value_velocity = np.nan
+    columns = df.drop(columns=[y_variable]).columns
+    p_value_velocity, *p_values = get_adf_p_values(
+        [df[y_variable].values]
+        + [
+            df[column].replace({np.inf: np.nan, -np.inf: np.nan}).dropna().values
+            for column in columns
+        ],
+        tester=tester,
+    )
     cross_correlation_dfs = pd.DataFrame(
         columns=["lags", "parameter", "ccr", "adfuller", "adfuller_v"]
     )
-    for column in df.drop(columns=[y_variable]).columns:
+    for column, p_value in zip(columns, p_values):
         cross_correlation_df = pd.DataFrame(
             columns=["lags", "parameter", "ccr", "adfuller", "adfuller_v"]
         )
         df_subset = df[[column, y_variable]]
-        try:
-            p_value = adfuller(
-                df_subset[column].replace({np.inf: np.nan, -np.inf: np.nan}).dropna()
-            )[1]
-        except (ValueError, statsmodels.tools.sm_exceptions.MissingDataError):
-            p_value = np.nan
         try:
             cross_correlation_df["ccr"] = time_lagged_cross_correlation(
                 df_subset[y_variable],
@@ -234,3 +312,231 @@ def apply_time_lagged_cross_correlation_to_df(df, y_variable="velocity"):
                 [cross_correlation_dfs, cross_correlation_df]
             )
     return cross_correlation_dfs
+
+
+def get_adf_design(series, lag, regression="c"):
+    """
+    Regression design of the augmented Dickey-Fuller test with a fixed lag for a
+    batch of series of equal length, as in statsmodels.tsa.stattools.adfuller:
+    the differences are regressed on the lagged level, the lagged differences and
+    the deterministic trend. The non-constant columns are centered if there is a
+    constant, which does not change the test statistic of the level.
+
+    :param series: np.array of shape (N, T)
+    :param lag: number of lagged differences
+    :param regression: "n", "c", "ct" or "ctt"
+    :return: (design of shape (N, nobs, 1 + lag + n_trend), differences (N, nobs))
+    """
+    n_samples = series.shape[1]
+    diff = np.diff(series, axis=1)
+    n_obs = n_samples - 1 - lag
+    columns = [series[:, lag : n_samples - 1]]
+    columns.extend(diff[:, lag - i : n_samples - 1 - i] for i in range(1, lag + 1))
+    design = np.stack(columns, axis=-1)
+    n_trend = 0 if regression == "n" else len(regression)
+    if n_trend > 0:
+        design = design - design.mean(axis=1, keepdims=True)
+        trend = np.arange(1, n_obs + 1, dtype=np.float64)
+        trend = (trend - trend.mean()) / max(trend.std(), 1)
+        trends = [np.ones(n_obs)] + [trend**power for power in range(1, n_trend)]
+        trends = np.broadcast_to(
+            np.stack(trends, axis=-1), (len(series), n_obs, n_trend)
+        )
+        design = np.concatenate([design, trends], axis=-1)
+    return design, diff[:, lag:]
+
+
+def get_adf_statistics_fixed_lag(series, lag, regression="c"):
+    """
+    ADF test statistics of a batch of series of equal length with a fixed lag.
+
+    :param series: np.array of shape (N, T)
+    :param lag: number of lagged differences
+    :param regression: "n", "c", "ct" or "ctt"
+    :return: (test statistics, number of observations)
+    """
+    design, y = get_adf_design(series, lag, regression=regression)
+    xtx = np.einsum("nti,ntj->nij", design, design)
+    xty = np.einsum("nti,nt->ni", design, y)
+    xtx_inv = np.linalg.pinv(xtx)
+    params = np.einsum("nij,nj->ni", xtx_inv, xty)
+    resid = y - np.einsum("nti,ni->nt", design, params)
+    n_obs, n_params = design.shape[1:]
+    sigma2 = (resid**2).sum(axis=1) / (n_obs - n_params)
+    return params[:, 0] / np.sqrt(sigma2 * xtx_inv[:, 0, 0]), n_obs
+
+
+def select_adf_lag_aic(series, max_lag, regression="c"):
+    """
+    Lag with the smallest AIC for a batch of series of equal length, fitted on
+    the common observations of max_lag as in adfuller with autolag="AIC". All
+    lags are solved from one cross product matrix.
+
+    :param series: np.array of shape (N, T)
+    :param max_lag:
+    :param regression: "n", "c", "ct" or "ctt"
+    :return: np.array of lags
+    """
+    design, y = get_adf_design(series, max_lag, regression=regression)
+    xtx = np.einsum("nti,ntj->nij", design, design)
+    xty = np.einsum("nti,nt->ni", design, y)
+    yty = np.einsum("nt,nt->n", y, y)
+    n_obs = design.shape[1]
+    n_trend = design.shape[2] - 1 - max_lag
+    trend_columns = list(range(1 + max_lag, 1 + max_lag + n_trend))
+    aic = np.empty((len(series), max_lag + 1))
+    for lag in range(max_lag + 1):
+        columns = list(range(lag + 1)) + trend_columns
+        sub_xtx = xtx[:, columns][:, :, columns]
+        sub_xty = xty[:, columns]
+        params = np.einsum("nij,nj->ni", np.linalg.pinv(sub_xtx), sub_xty)
+        ssr = np.maximum(yty - np.einsum("ni,ni->n", params, sub_xty), 1e-300)
+        aic[:, lag] = n_obs * np.log(ssr / n_obs) + 2 * len(columns)
+    return np.argmin(aic, axis=1)
+
+
+def adfuller_batch(series_lst, max_lag=None, regression="c", autolag="AIC"):
+    """
+    Augmented Dickey-Fuller test of many series, equivalent to
+    statsmodels.tsa.stattools.adfuller(series, maxlag=max_lag,
+    regression=regression, autolag=autolag). Series of equal length are tested
+    together, with autolag=None with one fixed lag per batch.
+
+    :param series_lst: list of 1-d np.arrays without NaNs
+    :param max_lag: maximum (autolag="AIC") or fixed (autolag=None) lag, defaults
+        to the rule of Schwert as in adfuller
+    :param regression: "n", "c", "ct" or "ctt"
+    :param autolag: "AIC" or None
+    :return: dict of np.arrays "adf", "p_value", "used_lag" and "n_obs", NaN for
+        constant or too short series
+    """
+    from statsmodels.tsa.adfvalues import mackinnonp
+
+    n_trend = 0 if regression == "n" else len(regression)
+    result = {
+        "adf": np.full(len(series_lst), np.nan),
+        "p_value": np.full(len(series_lst), np.nan),
+        "used_lag": np.full(len(series_lst), -1, dtype=np.int64),
+        "n_obs": np.zeros(len(series_lst), dtype=np.int64),
+    }
+    series_lst = [np.asarray(series, dtype=np.float64) for series in series_lst]
+    groups = {}
+    for i, series in enumerate(series_lst):
+        n_samples = len(series)
+        lag = max_lag
+        if lag is None:
+            lag = int(np.ceil(12.0 * np.power(n_samples / 100.0, 1 / 4.0)))
+            lag = min(n_samples // 2 - n_trend - 1, lag)
+        if (
+            lag < 0
+            or lag > n_samples // 2 - n_trend - 1
+            or not np.all(np.isfinite(series))
+            or series.max() == series.min()
+        ):
+            continue
+        groups.setdefault((n_samples, lag), []).append(i)
+
+    # lag per series
+    lags = {}
+    for (n_samples, lag), indices in groups.items():
+        if autolag is None:
+            lags.update((i, lag) for i in indices)
+        elif autolag.lower() == "aic":
+            selected = select_adf_lag_aic(
+                np.stack([series_lst[i] for i in indices]), lag, regression=regression
+            )
+            lags.update(zip(indices, selected))
+        else:
+            raise NotImplementedError("autolag %s" % autolag)
+
+    # fit with the used lag on all observations of this lag
+    used_groups = {}
+    for i, lag in lags.items():
+        used_groups.setdefault((len(series_lst[i]), int(lag)), []).append(i)
+    for (n_samples, lag), indices in used_groups.items():
+        adf, n_obs = get_adf_statistics_fixed_lag(
+            np.stack([series_lst[i] for i in indices]), lag, regression=regression
+        )
+        result["adf"][indices] = adf
+        result["used_lag"][indices] = lag
+        result["n_obs"][indices] = n_obs
+        result["p_value"][indices] = [
+            mackinnonp(statistic, regression=regression, N=1) for statistic in adf
+        ]
+    return result
+
+
+class StationarityTester:
+    """
+    ADF stationarity tests with a cache keyed by a hash of the series and the
+    test parameters, so that inputs which are the same for many bees, e.g. the
+    weather of a day, are only tested once. The tester can be passed to worker
+    processes together with its cache, see precompute.
+    """
+
+    def __init__(self, max_lag=None, autolag="AIC", max_entries=100000):
+        self.max_lag = max_lag
+        self.autolag = autolag
+        self.max_entries = max_entries
+        self.p_values = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, series, regression):
+        hasher = hashlib.sha1(
+            repr((self.max_lag, self.autolag, regression)).encode()
+        )
+        hasher.update(np.ascontiguousarray(series, dtype=np.float64).tobytes())
+        return hasher.digest()
+
+    def get_p_values(self, series_lst, regression="c"):
+        """
+        :param series_lst: list of 1-d arrays without NaNs
+        :param regression: "n", "c", "ct" or "ctt"
+        :return: np.array of p-values, NaN if the series can not be tested
+        """
+        keys = [self.get_key(series, regression) for series in series_lst]
+        missing = [i for i, key in enumerate(keys) if key not in self.p_values]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            p_values = adfuller_batch(
+                [series_lst[i] for i in missing],
+                max_lag=self.max_lag,
+                regression=regression,
+                autolag=self.autolag,
+            )["p_value"]
+            for i, p_value in zip(missing, p_values):
+                self.p_values[keys[i]] = p_value
+        result = np.array([self.p_values[key] for key in keys], dtype=np.float64)
+        for key in keys:
+            self.p_values.move_to_end(key)
+        while len(self.p_values) > self.max_entries:
+            self.p_values.popitem(last=False)
+        return result
+
+    def get_p_value(self, series, regression="c"):
+        return self.get_p_values([series], regression=regression)[0]
+
+    def precompute(self, series_lst, regression="c"):
+        """
+        Tests series shared by many jobs, e.g. all weather parameters per day,
+        in one batch and keeps the results in the cache.
+        """
+        self.get_p_values(series_lst, regression=regression)
+
+    def get_stats(self):
+        return dict(hits=self.hits, misses=self.misses, n_entries=len(self.p_values))
+
+
+def get_adf_p_values(series_lst, regression="c", tester=None):
+    """
+    :param series_lst: list of 1-d arrays without NaNs
+    :param regression: "n", "c", "ct" or "ctt"
+    :param tester: StationarityTester to cache the p-values, nothing is cached
+        if None
+    :return: np.array of p-values, NaN if the series can not be tested
+    """
+    if tester is not None:
+        return tester.get_p_values(series_lst, regression=regression)
+    return adfuller_batch(series_lst, regression=regression)["p_value"]
@@ -1,5 +1,7 @@
 from suncalc import get_times
+import suncalc.suncalc
 import datetime
+import functools
 import pandas as pd
 import numpy as np
 
@@ -8,6 +10,8 @@ class SolarTimeConverter:
     def __init__(self, latitude, longitude):
         self.latitude = latitude
         self.longitude = longitude
+        # solar references in UTC nanoseconds per (reference, julian cycle)
+        self.solar_references = {}
 
     def convert_utc_to_local_mean_time(self, time_utc):
         # get local time when sun stays in zenith
@@ -37,6 +41,241 @@ class SolarTimeConverter:
         return time_shift
 
 
+    @staticmethod
+    def get_utc_and_wall_clock_nanoseconds(times):
+        """
+        :param times: pd.Series, pd.DatetimeIndex or array-like of datetimes,
+            naive datetimes are treated as UTC
+        :return: (UTC nanoseconds, nanoseconds of the wall clock of the times)
+        """
+        times = pd.DatetimeIndex(times)
+        wall_clock = times.tz_localize(None) if times.tz is not None else times
+        utc = times.tz_convert(None) if times.tz is not None else times
+        return utc.asi8, wall_clock.asi8
+
+    def get_julian_cycles(self, utc_ns):
+        # the day of the solar references as in suncalc.get_times
+        days = (
+            utc_ns / 1e6 / suncalc.suncalc.dayMs
+            - 0.5
+            + suncalc.suncalc.J1970
+            - suncalc.suncalc.J2000
+        )
+        lw = suncalc.suncalc.rad * -self.longitude
+        return np.round(days - suncalc.suncalc.J0 - lw / (2 * np.pi)).astype(np.int64)
+
+    def get_solar_references(self, times_utc, reference="solar_noon"):
+        """
+        Vectorized get_solar_reference. The reference only depends on the day,
+        so suncalc is evaluated once per day and the result is cached.
+
+        :param times_utc: pd.Series, pd.DatetimeIndex or array-like of datetimes
+        :param reference: e.g. "solar_noon", "sunrise" or "sunset"
+        :return: np.array of int64 UTC nanoseconds, pd.NaT.value if undefined
+        """
+        utc_ns, _ = self.get_utc_and_wall_clock_nanoseconds(times_utc)
+        cycles = self.get_julian_cycles(utc_ns)
+        unique_cycles, first_index, inverse = np.unique(
+            cycles, return_index=True, return_inverse=True
+        )
+        references = np.empty(len(unique_cycles), dtype=np.int64)
+        for i, (cycle, index) in enumerate(zip(unique_cycles, first_index)):
+            key = (reference, cycle)
+            if key not in self.solar_references:
+                solar_reference = self.get_solar_reference(
+                    pd.Timestamp(utc_ns[index], tz="UTC"), reference=reference
+                )
+                self.solar_references[key] = pd.Timestamp(solar_reference).value
+            references[i] = self.solar_references[key]
+        return references[inverse]
+
+    def get_time_shifts_relative_to_solar_reference(
+        self, times_utc, reference="solar_noon"
+    ):
+        """
+        Vectorized get_time_shift_relative_to_solar_reference.
+
+        :param times_utc: pd.Series, pd.DatetimeIndex or array-like of datetimes
+        :param reference:
+        :return: np.array of time shifts in hours
+        """
+        references = self.get_solar_references(times_utc, reference=reference)
+        _, wall_clock_ns = self.get_utc_and_wall_clock_nanoseconds(times_utc)
+        day_ns = pd.Timedelta(days=1).value
+        time_shift = (references - wall_clock_ns // day_ns * day_ns) / 3.6e12
+        return np.where(references == pd.NaT.value, np.nan, time_shift)
+
+    def convert_utc_to_local_mean_times(self, times_utc):
+        """
+        Vectorized convert_utc_to_local_mean_time.
+
+        :param times_utc: pd.Series, pd.DatetimeIndex or array-like of datetimes
+        :return: pd.Series of naive local mean times, with the index of times_utc
+            if it is a pd.Series
+        """
+        solar_noons = self.get_solar_references(times_utc, reference="solar_noon")
+        utc_ns, wall_clock_ns = self.get_utc_and_wall_clock_nanoseconds(times_utc)
+        day_ns = pd.Timedelta(days=1).value
+        reference_shift = (
+            wall_clock_ns // day_ns * day_ns + pd.Timedelta(hours=12).value - solar_noons
+        )
+        local_mean_times = pd.Series(
+            pd.to_datetime(utc_ns - reference_shift),
+            index=times_utc.index if isinstance(times_utc, pd.Series) else None,
+        )
+        local_mean_times[solar_noons == pd.NaT.value] = pd.NaT
+        return local_mean_times
+
+
+@functools.lru_cache(maxsize=None)
+def get_solar_time_converter(latitude, longitude):
+    """
+    :return: SolarTimeConverter shared per coordinates, so its solar references
+        are only computed once
+    """
+    return SolarTimeConverter(latitude, longitude)
+
+
+class DayNightSegmentation:
+    """
+    Precomputed day, night and twilight segments of a date range. The day and
+    night segments are either given by fixed wall clock times, inclusive at both
+    ends as pd.DatetimeIndex.indexer_between_time, or by the sunrise, sunset,
+    dawn and dusk of a SolarTimeConverter. The remaining time is twilight.
+    """
+
+    NIGHT, TWILIGHT, DAY = 0, 1, 2
+    labels = ("night", "twilight", "day")
+
+    def __init__(
+        self,
+        dt_from,
+        dt_to,
+        day=("9:00", "18:00"),
+        night=("21:00", "6:00"),
+        converter=None,
+        tz="UTC",
+    ):
+        """
+        :param dt_from: begin of the date range
+        :param dt_to: end of the date range
+        :param day: (start, end) wall clock times of the day
+        :param night: (start, end) wall clock times of the night, may wrap midnight
+        :param converter: SolarTimeConverter, if given the day is sunrise to
+            sunset and the night is dusk to dawn instead of the fixed times
+        :param tz: time zone of the wall clock, naive datetimes are taken as
+            wall clock times
+        """
+        self.tz = tz
+        self.dt_from = self.to_wall_clock_nanoseconds([dt_from])[0]
+        self.dt_to = self.to_wall_clock_nanoseconds([dt_to])[0]
+        day_ns = pd.Timedelta(days=1).value
+        # the night of the day before reaches into dt_from
+        dates = np.arange(
+            self.dt_from // day_ns * day_ns - day_ns, self.dt_to + 1, day_ns
+        )
+        if converter is None:
+            day_start, day_end = self.get_segment_offsets(day)
+            night_start, night_end = self.get_segment_offsets(night)
+            segments = [
+                (dates + day_start, dates + day_end, self.DAY),
+                (dates + night_start, dates + night_end, self.NIGHT),
+            ]
+        else:
+            # solar references of the day at noon in the wall clock
+            noons = pd.DatetimeIndex(dates + day_ns // 2).tz_localize(tz)
+            sunrise, sunset, dawn, dusk = [
+                self.to_wall_clock_nanoseconds(
+                    pd.to_datetime(
+                        converter.get_solar_references(noons, reference), utc=True
+                    )
+                )
+                for reference in ("sunrise", "sunset", "dawn", "dusk")
+            ]
+            segments = [
+                (sunrise, sunset, self.DAY),
+                (dusk[:-1], dawn[1:], self.NIGHT),
+            ]
+        starts, ends, segment_labels = [
+            np.concatenate(values)
+            for values in zip(
+                *[
+                    (start, end, np.full(len(start), label, dtype=np.int8))
+                    for start, end, label in segments
+                ]
+            )
+        ]
+        # undefined solar references, e.g. no sunset at polar latitudes
+        is_valid = (starts != pd.NaT.value) & (ends != pd.NaT.value)
+        is_valid &= (ends >= self.dt_from) & (starts <= self.dt_to)
+        order = np.argsort(starts[is_valid], kind="stable")
+        self.starts = np.maximum(starts[is_valid][order], self.dt_from)
+        self.ends = np.minimum(ends[is_valid][order], self.dt_to)
+        self.segment_labels = segment_labels[is_valid][order]
+
+    @staticmethod
+    def get_segment_offsets(segment):
+        start, end = [
+            pd.Timedelta(pd.Timestamp(time).time().isoformat()).value
+            for time in segment
+        ]
+        if end < start:
+            end += pd.Timedelta(days=1).value
+        return start, end
+
+    def to_wall_clock_nanoseconds(self, times):
+        times = pd.DatetimeIndex(times)
+        if times.tz is not None:
+            times = times.tz_convert(self.tz).tz_localize(None)
+        return times.asi8
+
+    def get_labels(self, times):
+        """
+        :param times: pd.Series, pd.DatetimeIndex or array-like of datetimes, or
+            np.array of int64 wall clock nanoseconds
+        :return: np.array of NIGHT, TWILIGHT or DAY per time, -1 outside of the
+            date range
+        """
+        if not (isinstance(times, np.ndarray) and times.dtype == np.int64):
+            times = self.to_wall_clock_nanoseconds(times)
+        index = np.searchsorted(self.starts, times, side="right") - 1
+        is_segment = index >= 0
+        is_segment[is_segment] = times[is_segment] <= self.ends[index[is_segment]]
+        labels = np.where(
+            is_segment, self.segment_labels[np.maximum(index, 0)], self.TWILIGHT
+        ).astype(np.int8)
+        labels[(times < self.dt_from) | (times > self.dt_to)] = -1
+        return labels
+
+    def get_mask(self, times, segment="night"):
+        """
+        :param times: see get_labels
+        :param segment: "day", "night" or "twilight"
+        :return: boolean np.array
+        """
+        return self.get_labels(times) == self.labels.index(segment)
+
+    def get_spans(self, segment="night"):
+        """
+        :param segment: "day", "night" or "twilight"
+        :return: (starts, ends) as pd.DatetimeIndex in the time zone tz
+        """
+        if segment == "twilight":
+            # the gaps between the day and night segments
+            bounds = np.concatenate(
+                [[self.dt_from], np.ravel([self.starts, self.ends], order="F"), [self.dt_to]]
+            )
+            starts, ends = bounds[::2], bounds[1::2]
+            is_span = ends > starts
+            starts, ends = starts[is_span], ends[is_span]
+        else:
+            is_segment = self.segment_labels == self.labels.index(segment)
+            starts, ends = self.starts[is_segment], self.ends[is_segment]
+        return tuple(
+            pd.DatetimeIndex(values).tz_localize(self.tz) for values in (starts, ends)
+        )
+
+
 def get_coordinates_berlin():
     latitude = 52.5
     longitude = 13.4
@@ -46,11 +285,12 @@ def get_coordinates_berlin():
 def apply_time_wrapper_berlin(df, reference="sunrise"):
     # create time converter
     latitude, longitude = get_coordinates_berlin()
-    berlin_time_converter = SolarTimeConverter(latitude, longitude)
+    berlin_time_converter = get_solar_time_converter(latitude, longitude)
     # get reference time for sunset
-    df["time_reference"] = df.date.apply(
-        berlin_time_converter.get_time_shift_relative_to_solar_reference,
-        reference=reference,
+    df["time_reference"] = (
+        berlin_time_converter.get_time_shifts_relative_to_solar_reference(
+            df.date, reference=reference
+        )
     )
 
 
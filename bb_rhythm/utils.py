@@ -1,5 +1,10 @@
+import collections
+import datetime
+import hashlib
 import os
+import threading
 import bb_behavior.db
+import diskcache
 import numpy as np
 import pandas as pd
 from scipy.ndimage import gaussian_filter
@@ -137,8 +142,135 @@ class Binning:
         return df
 
 
+class VelocityCache:
+    """
+    Opt-in in-process LRU cache of velocity frames with a byte budget, e.g. for
+    the velocity consumers of one job which read the same bees repeatedly. Pass
+    it as cache to the velocity readers, nothing is cached by default.
+    """
+
+    def __init__(self, max_bytes=256 * 1024**2):
+        self.max_bytes = max_bytes
+        self.frames = collections.OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, copy=True):
+        """
+        :param key:
+        :param copy: if False, the cached frame itself is returned and must not
+            be modified
+        :return: cached frame or None
+        """
+        with self.lock:
+            if key not in self.frames:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.frames.move_to_end(key)
+            velocities, _ = self.frames[key]
+        return velocities.copy() if copy else velocities
+
+    def put(self, key, velocities):
+        """
+        Caches the frame without copying it, so it must not be modified
+        afterwards, and evicts the least recently used frames until the byte
+        budget is met. Frames larger than the budget are not cached.
+
+        :param key:
+        :param velocities: pd.DataFrame
+        """
+        n_bytes = int(velocities.memory_usage(deep=True).sum())
+        if n_bytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.frames:
+                self.n_bytes -= self.frames.pop(key)[1]
+            while self.frames and self.n_bytes + n_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.frames.popitem(last=False)
+                self.n_bytes -= evicted_bytes
+                self.evictions += 1
+            self.frames[key] = (velocities, n_bytes)
+            self.n_bytes += n_bytes
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.n_bytes = 0
+
+    def get_stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            n_frames=len(self.frames),
+            n_bytes=self.n_bytes,
+            max_bytes=self.max_bytes,
+        )
+
+
+def read_velocities_pickle(bee_id, velocities_path, cache=None):
+    """
+    Reads velocities_path/<bee_id>.pickle, through the velocity cache if given.
+
+    :param bee_id:
+    :param velocities_path:
+    :param cache: VelocityCache, nothing is cached if None
+    :return: pd.DataFrame
+    """
+    key = ("pickle", velocities_path, bee_id)
+    velocities = cache.get(key) if cache is not None else None
+    if velocities is None:
+        velocities = pd.read_pickle(os.path.join(velocities_path, "%d.pickle" % bee_id))
+        if cache is not None:
+            # the cache keeps the read frame, the caller gets its only copy
+            cache.put(key, velocities)
+            velocities = velocities.copy()
+    return velocities
+
+
+def fetch_velocities_from_db(
+    bee_id, dt_from, dt_to, max_mm_per_second=15.0, cache=None, cursor=None
+):
+    """
+    Fetches the velocities of a bee from the database, through the velocity
+    cache if given.
+
+    :param bee_id:
+    :param dt_from:
+    :param dt_to:
+    :param max_mm_per_second:
+    :param cache: VelocityCache, nothing is cached if None
+    :param cursor: database cursor, by default bb_behavior opens a connection
+    :return: pd.DataFrame or None
+    """
+    key = ("db", bee_id, dt_from, dt_to, max_mm_per_second)
+    velocities = cache.get(key) if cache is not None else None
+    if velocities is None:
+        velocities = bb_behavior.db.trajectory.get_bee_velocities(
+            bee_id,
+            dt_from,
+            dt_to,
+            confidence_threshold=0.1,
+            max_mm_per_second=max_mm_per_second,
+            cursor=cursor,
+        )
+        if velocities is not None and cache is not None:
+            cache.put(key, velocities)
+            velocities = velocities.copy()
+    return velocities
+
+
 def fetch_velocities_from_remote_or_db(
-    bee_id, dt_after, dt_before, velocities_path, max_mm_per_second=15.0
+    bee_id,
+    dt_after,
+    dt_before,
+    velocities_path,
+    max_mm_per_second=15.0,
+    cache=None,
 ):
     """
 
@@ -147,32 +279,368 @@ def fetch_velocities_from_remote_or_db(
     :param dt_before:
     :param velocities_path:
     :param max_mm_per_second:
+    :param cache: VelocityCache, nothing is cached if None
     :return:
     """
     if type(bee_id) == np.int64:
         bee_id = bee_id.item()
-    try:
-        # fetch velocities
-        if velocities_path is not None:
-            velocities = pd.read_pickle(
-                os.path.join(velocities_path, "%d.pickle" % bee_id)
-            )
-            velocities.velocity[velocities.velocity > max_mm_per_second] = np.nan
-        else:
-            assert FileNotFoundError
-    except FileNotFoundError:
+    velocities = None
+    if velocities_path is not None:
+        try:
+            # fetch velocities
+            velocities = read_velocities_pickle(bee_id, velocities_path, cache=cache)
+            velocities.loc[velocities.velocity > max_mm_per_second, "velocity"] = np.nan
+        except FileNotFoundError:
+            velocities = None
+    if velocities is None:
         # fetch velocities
-        velocities = bb_behavior.db.trajectory.get_bee_velocities(
-            bee_id,
-            dt_before,
-            dt_after,
-            confidence_threshold=0.1,
-            max_mm_per_second=max_mm_per_second,
+        velocities = fetch_velocities_from_db(
+            bee_id, dt_before, dt_after, max_mm_per_second=max_mm_per_second, cache=cache
         )
     return velocities
 
 
+def get_utc_nanoseconds(datetimes):
+    """
+    Converts datetimes to int64 nanoseconds since epoch in UTC. Naive datetimes
+    are treated as UTC.
+
+    :param datetimes: pd.Series, array-like or scalar of datetimes
+    :return: np.array of int64 or int
+    """
+    if np.isscalar(datetimes) or isinstance(datetimes, datetime.datetime):
+        timestamp = pd.Timestamp(datetimes)
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.tz_convert(None)
+        return timestamp.value
+    datetimes = pd.to_datetime(pd.Series(datetimes))
+    if datetimes.dt.tz is not None:
+        datetimes = datetimes.dt.tz_convert(None)
+    return datetimes.values.astype("datetime64[ns]").astype(np.int64)
+
+
+class VelocityStore:
+    """
+    Per bee velocities as sorted int64 nanosecond timestamps with cumulative sums
+    and counts, so that the mean velocity of any time window is answered with
+    two binary searches. Each bee is loaded once from
+    velocities_path/<bee_id>.pickle or, if not available, from the database
+    for [dt_from, dt_to).
+    """
+
+    def __init__(self, velocities_path=None, dt_from=None, dt_to=None):
+        self.velocities_path = velocities_path
+        self.dt_from = dt_from
+        self.dt_to = dt_to
+        self.bees = {}
+
+    def add_velocities(self, bee_id, velocities):
+        """
+        Indexes the velocities of a bee. Non-finite velocities are ignored.
+
+        :param bee_id:
+        :param velocities: pd.DataFrame with columns "datetime" and "velocity" or None
+        """
+        if velocities is None:
+            self.bees[bee_id] = None
+            return
+        timestamps = get_utc_nanoseconds(velocities["datetime"])
+        v = velocities["velocity"].values.astype(np.float64)
+        order = np.argsort(timestamps, kind="stable")
+        timestamps, v = timestamps[order], v[order]
+        is_finite = np.isfinite(v)
+        self.bees[bee_id] = (
+            timestamps,
+            np.concatenate([[0.0], np.cumsum(np.where(is_finite, v, 0.0))]),
+            np.concatenate([[0], np.cumsum(is_finite)]),
+        )
+
+    def load(self, bee_id):
+        """
+        Returns the indexed velocities of a bee and loads them if necessary.
+
+        :param bee_id:
+        :return: (timestamps, cumulative velocity sum, cumulative count) or None
+        """
+        if type(bee_id) == np.int64:
+            bee_id = bee_id.item()
+        if bee_id not in self.bees:
+            try:
+                # fetch velocities
+                velocities = read_velocities_pickle(bee_id, self.velocities_path)
+            except (FileNotFoundError, TypeError):
+                # fetch velocities
+                velocities = fetch_velocities_from_db(bee_id, self.dt_from, self.dt_to)
+            self.add_velocities(bee_id, velocities)
+        return self.bees[bee_id]
+
+    def get_window_means(self, bee_ids, starts, ends, closed="left"):
+        """
+        Mean velocities of the windows [start, end) for closed="left" or
+        (start, end] for closed="right". Windows without velocities and bees
+        without velocities get NaN.
+
+        :param bee_ids: array-like of bee ids or a single bee id
+        :param starts: array-like of datetimes or int64 nanoseconds
+        :param ends: array-like of datetimes or int64 nanoseconds
+        :param closed: "left" or "right"
+        :return: np.array
+        """
+        starts = np.atleast_1d(_to_nanoseconds(starts))
+        ends = np.atleast_1d(_to_nanoseconds(ends))
+        bee_ids = np.broadcast_to(np.asarray(bee_ids), starts.shape)
+        means = np.full(len(starts), np.nan)
+        for bee_id in pd.unique(bee_ids):
+            velocity_index = self.load(bee_id)
+            if velocity_index is None:
+                continue
+            timestamps, velocity_sum, count = velocity_index
+            is_bee = np.flatnonzero(bee_ids == bee_id)
+            first = np.searchsorted(timestamps, starts[is_bee], side=closed)
+            last = np.searchsorted(timestamps, ends[is_bee], side=closed)
+            n = count[last] - count[first]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                means[is_bee] = np.where(
+                    n > 0, (velocity_sum[last] - velocity_sum[first]) / n, np.nan
+                )
+        return means
+
+    def get_velocity_changes(
+        self, bee_ids, interaction_starts, interaction_ends, delta_t=datetime.timedelta(0, 30)
+    ):
+        """
+        Velocity change of each bee between the delta_t before the interaction
+        start and the delta_t after the interaction end, see
+        interactions.get_velocity_change_per_bee.
+
+        :param bee_ids: array-like of bee ids
+        :param interaction_starts: array-like of datetimes
+        :param interaction_ends: array-like of datetimes
+        :param delta_t: length of the windows before and after the interaction
+        :return: (np.array of velocity changes, np.array of percent changes)
+        """
+        starts = np.atleast_1d(_to_nanoseconds(interaction_starts))
+        ends = np.atleast_1d(_to_nanoseconds(interaction_ends))
+        delta_t = pd.Timedelta(delta_t).value
+        vel_before = self.get_window_means(bee_ids, starts - delta_t, starts, "left")
+        vel_after = self.get_window_means(bee_ids, ends, ends + delta_t, "right")
+        vel_change = vel_after - vel_before
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percent_change = np.where(
+                (vel_before == 0) | ~np.isfinite(vel_before),
+                np.nan,
+                (vel_change / vel_before) * 100,
+            )
+        return vel_change, percent_change
+
+
+def _to_nanoseconds(datetimes):
+    if isinstance(datetimes, np.ndarray) and datetimes.dtype == np.int64:
+        return datetimes
+    return get_utc_nanoseconds(datetimes)
+
+
+class BeeAgeIndex:
+    """
+    Bee ages per (bee_id, date) loaded in bulk, e.g. for all bees and days of a
+    season, with vectorized lookups. Can be stored on disk for offline reuse.
+    """
+
+    def __init__(self, ages_df):
+        """
+        :param ages_df: pd.DataFrame with columns "bee_id", "date" and "age"
+        """
+        # without a copy, e.g. to keep the views of a runner.SharedFrame
+        self.ages_df = ages_df.set_axis(pd.RangeIndex(len(ages_df)), axis=0, copy=False)
+        keys = self.get_keys(self.ages_df["bee_id"].values, self.ages_df["date"])
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.ages = self.ages_df["age"].values[order].astype(np.int64)
+
+    @classmethod
+    def from_db(cls, bee_ids, dt_from, dt_to, cursor=None, chunk_size=100000):
+        """
+        Fetches the ages of all bees for all dates from dt_from to dt_to with
+        bulk calls of bb_behavior.db.metadata.get_bee_ages.
+
+        :param bee_ids:
+        :param dt_from:
+        :param dt_to:
+        :param cursor:
+        :param chunk_size: number of (bee_id, date) pairs per call
+        :return: BeeAgeIndex
+        """
+        dates = pd.date_range(
+            start=pd.Timestamp(dt_from).date(), end=pd.Timestamp(dt_to).date()
+        ).date
+        bee_ids_dates = [(int(bee_id), date) for bee_id in bee_ids for date in dates]
+        ages = []
+        for i in range(0, len(bee_ids_dates), chunk_size):
+            ages.extend(
+                bb_behavior.db.metadata.get_bee_ages(
+                    bee_ids_dates[i : i + chunk_size], cursor=cursor
+                )
+            )
+        return cls(
+            pd.DataFrame(
+                [(bee_id, date, int(age)) for bee_id, date, age in ages],
+                columns=["bee_id", "date", "age"],
+            )
+        )
+
+    @classmethod
+    def from_pickle(cls, path):
+        return cls(pd.read_pickle(path))
+
+    def to_pickle(self, path):
+        self.ages_df.to_pickle(path)
+
+    @staticmethod
+    def get_keys(bee_ids, dates):
+        dates = pd.to_datetime(pd.Series(np.atleast_1d(dates)))
+        if dates.dt.tz is not None:
+            dates = dates.dt.tz_convert("UTC").dt.tz_localize(None)
+        days = dates.values.astype("datetime64[D]").astype(np.int64)
+        bee_ids = np.broadcast_to(np.asarray(bee_ids, dtype=np.int64), days.shape)
+        return (bee_ids << 32) + days
+
+    def get_ages(self, bee_ids, dates, default=-1):
+        """
+        Looks up the ages of bees at the (UTC) dates of the given datetimes.
+
+        :param bee_ids: bee id or array-like of bee ids
+        :param dates: array-like of dates or datetimes
+        :param default: age of (bee_id, date) pairs not in the index
+        :return: np.array of int64
+        """
+        keys = self.get_keys(bee_ids, dates)
+        position = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        if len(self.keys) == 0:
+            return np.full(len(keys), default, dtype=np.int64)
+        return np.where(self.keys[position] == keys, self.ages[position], default)
+
+
+class FitResultCache:
+    """
+    Persistent on-disk cache of fit results, e.g. of rhythm.fit_cosinor_per_bee,
+    keyed by the fit parameters and a hash of the fitted data, so that reruns
+    only refit windows whose data or parameters changed. The least recently
+    used results are evicted when the cache exceeds size_limit bytes. Results
+    are tagged with their bee id for invalidation.
+    """
+
+    # increase when the fit results change, to invalidate all cached results
+    version = 3
+
+    def __init__(self, directory, size_limit=4 * 1024**3):
+        self.directory = directory
+        self.size_limit = size_limit
+        self._cache = None
+
+    def __getstate__(self):
+        # every process opens its own connection to the cache
+        state = self.__dict__.copy()
+        state["_cache"] = None
+        return state
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = diskcache.Cache(
+                self.directory,
+                size_limit=self.size_limit,
+                eviction_policy="least-recently-used",
+            )
+            self._cache.stats(enable=True)
+        return self._cache
+
+    def get_key(self, bee_id, window, period, second, model, *arrays, **parameters):
+        """
+        :param bee_id:
+        :param window: e.g. the reference date of the fitted window
+        :param period: period of the fit in seconds
+        :param second: rounding of the velocities in seconds
+        :param model: name of the fitted model
+        :param arrays: fitted data, e.g. timestamps and velocities
+        :param parameters: further parameters of the fit
+        :return: str
+        """
+        hasher = hashlib.sha256(
+            repr(
+                (
+                    self.version,
+                    int(bee_id),
+                    str(window),
+                    period,
+                    second,
+                    model,
+                    sorted(parameters.items()),
+                )
+            ).encode()
+        )
+        for values in arrays:
+            values = np.ascontiguousarray(values)
+            hasher.update(repr((values.dtype.str, values.shape)).encode())
+            hasher.update(values.tobytes())
+        return hasher.hexdigest()
+
+    def get_or_fit(self, key, bee_id, fit_func):
+        """
+        Returns the cached result for key or calls fit_func and caches its result.
+
+        :param key: see get_key
+        :param bee_id:
+        :param fit_func: function without arguments returning the fit result
+        :return: fit result
+        """
+        result = self.cache.get(key, default=None)
+        if result is None:
+            result = fit_func()
+            self.cache.set(key, result, tag=int(bee_id))
+        return result
+
+    def invalidate(self, bee_id=None):
+        """
+        Removes the cached results of a bee or all results if bee_id is None.
+
+        :param bee_id:
+        :return: number of removed results
+        """
+        if bee_id is None:
+            return self.cache.clear()
+        return self.cache.evict(int(bee_id))
+
+    def get_stats(self):
+        hits, misses = self.cache.stats()
+        return dict(
+            hits=hits,
+            misses=misses,
+            n_results=len(self.cache),
+            n_bytes=self.cache.volume(),
+            size_limit=self.size_limit,
+        )
+
+    def close(self):
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+
+
 def split_ci_lower_upper(df, variables):
+    """
+    Converts a fit table with two rows per fit, one per confidence interval
+    bound, to one row per fit with "ci_<var>_lower" and "ci_<var>_upper"
+    columns. Tables which already have these columns are returned as copies.
+
+    :param df: pd.DataFrame
+    :param variables: e.g. ["mesor", "amplitude", "acrophase"]
+    :return: pd.DataFrame
+    """
+    if all(
+        "ci_%s_lower" % var in df.columns and "ci_%s" % var not in df.columns
+        for var in variables
+    ):
+        return df.reset_index(drop=True)
     df_plt = df.copy()
     df_plt = df_plt[df_plt["index"] == 0]
     df_plt.drop(columns="index", inplace=True)
@@ -1,23 +1,22 @@
 import datetime
-from wetterdienst.provider.dwd.observation import (
-    DwdObservationRequest,
-    DwdObservationResolution,
-)
-from wetterdienst import Settings
-from functools import reduce
+import json
 import pandas as pd
 import numpy as np
 import pytz
 import os
 
-import bb_behavior.db
-
 from . import statistics, utils
 
 
 def get_weather_parameter_df(
     dt_from, dt_to, parameter, station_name="Berlin-Tempelhof"
 ):
+    from wetterdienst import Settings
+    from wetterdienst.provider.dwd.observation import (
+        DwdObservationRequest,
+        DwdObservationResolution,
+    )
+
     settings = Settings(tidy=True, si_units=False, humanize=True)
     parameter = [(param) for param in parameter]
     stations = DwdObservationRequest(
@@ -33,23 +32,276 @@ def get_weather_parameter_df(
     return weather_lst[0].df
 
 
-def combine_weather_frames(df):
-    dfs = []
-    for name, group in df.groupby(["parameter"]):
-        group.rename(columns={"value": name}, inplace=True)
-        group.drop(columns=["parameter"], inplace=True)
-        dfs.append(group)
-    df_merged = reduce(
-        lambda left, right: pd.merge(
-            left,
-            right,
-            left_on=["date", "station_id"],
-            right_on=["date", "station_id"],
-            how="outer",
-        ),
-        dfs,
+class WeatherStore:
+    """
+    Local store of the 10 minute DWD observations of one station, partitioned by
+    parameter and month in directory/<station_name>/<parameter>/<YYYY-MM>.pickle.
+    Only the intervals which are not in the store yet are fetched. In offline
+    mode nothing is fetched, missing intervals are taken from the fixture file,
+    a pickled tidy weather frame as returned by get_weather_parameter_df, and a
+    ValueError is raised if there is no fixture.
+
+    DWD publishes recent observations with a delay, so within recent_window
+    before now an interval only counts as stored up to its last observation and
+    the rest is fetched again by later updates.
+    """
+
+    def __init__(
+        self,
+        directory,
+        station_name="Berlin-Tempelhof",
+        offline=False,
+        fixture_path=None,
+        recent_window=datetime.timedelta(days=3),
+    ):
+        self.directory = directory
+        self.station_name = station_name
+        self.offline = offline
+        self.fixture_path = fixture_path
+        self.recent_window = recent_window
+        self._fixture = None
+
+    @property
+    def fixture(self):
+        if self._fixture is None and self.fixture_path is not None:
+            self._fixture = pd.read_pickle(self.fixture_path)
+        return self._fixture
+
+    @staticmethod
+    def to_utc(dt):
+        dt = pd.Timestamp(dt)
+        return dt.tz_localize("UTC") if dt.tzinfo is None else dt.tz_convert("UTC")
+
+    def get_parameter_directory(self, parameter):
+        return os.path.join(self.directory, self.station_name, parameter)
+
+    def get_coverage(self, parameter):
+        """
+        :param parameter:
+        :return: dict of month to the (first, last) datetime stored for it
+        """
+        path = os.path.join(self.get_parameter_directory(parameter), "coverage.json")
+        if not os.path.exists(path):
+            return {}
+        with open(path) as file:
+            coverage = json.load(file)
+        return {
+            month: (pd.Timestamp(start), pd.Timestamp(end))
+            for month, (start, end) in coverage.items()
+        }
+
+    def set_coverage(self, parameter, coverage):
+        path = os.path.join(self.get_parameter_directory(parameter), "coverage.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(
+                {
+                    month: (start.isoformat(), end.isoformat())
+                    for month, (start, end) in coverage.items()
+                },
+                file,
+            )
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def get_months(dt_from, dt_to):
+        """
+        Splits [dt_from, dt_to] into the parts within each month.
+
+        :return: list of (month, start, end)
+        """
+        month_starts = pd.date_range(
+            dt_from.replace(day=1, hour=0, minute=0, second=0, microsecond=0),
+            dt_to,
+            freq="MS",
+        )
+        return [
+            (
+                month_start.strftime("%Y-%m"),
+                max(dt_from, month_start),
+                min(dt_to, month_start + pd.offsets.MonthBegin() - pd.Timedelta(1)),
+            )
+            for month_start in month_starts
+        ]
+
+    def get_missing_intervals(self, dt_from, dt_to, parameter):
+        """
+        :param dt_from:
+        :param dt_to:
+        :param parameter:
+        :return: list of (start, end) not covered by the store, adjacent
+            intervals are joined
+        """
+        coverage = self.get_coverage(parameter)
+        missing = []
+        for month, start, end in self.get_months(dt_from, dt_to):
+            if month not in coverage:
+                missing.append((start, end))
+                continue
+            covered_start, covered_end = coverage[month]
+            if start < covered_start:
+                missing.append((start, covered_start))
+            if end > covered_end:
+                missing.append((covered_end, end))
+        intervals = []
+        for start, end in missing:
+            if intervals and start - intervals[-1][1] <= pd.Timedelta(minutes=10):
+                intervals[-1] = (intervals[-1][0], end)
+            else:
+                intervals.append((start, end))
+        return intervals
+
+    def fetch(self, dt_from, dt_to, parameter):
+        if not self.offline:
+            return get_weather_parameter_df(
+                dt_from.to_pydatetime(),
+                dt_to.to_pydatetime(),
+                parameter=[parameter],
+                station_name=self.station_name,
+            )
+        if self.fixture is None:
+            raise ValueError(
+                "%s from %s to %s is not in the weather store and the store is offline"
+                % (parameter, dt_from, dt_to)
+            )
+        fixture = self.fixture
+        return fixture[
+            (fixture.parameter == parameter)
+            & (fixture.date >= dt_from)
+            & (fixture.date <= dt_to)
+        ]
+
+    def read_month(self, parameter, month):
+        path = os.path.join(self.get_parameter_directory(parameter), "%s.pickle" % month)
+        if not os.path.exists(path):
+            return None
+        return pd.read_pickle(path)
+
+    def write(self, parameter, df, dt_from, dt_to):
+        """
+        Adds fetched observations of [dt_from, dt_to] to the monthly partitions.
+        """
+        os.makedirs(self.get_parameter_directory(parameter), exist_ok=True)
+        coverage = self.get_coverage(parameter)
+        months = df.date.dt.tz_convert("UTC").dt.strftime("%Y-%m")
+        for month, start, end in self.get_months(dt_from, dt_to):
+            month_df = pd.concat([self.read_month(parameter, month), df[months == month]])
+            month_df = month_df.drop_duplicates(subset=["date"], keep="last")
+            path = os.path.join(
+                self.get_parameter_directory(parameter), "%s.pickle" % month
+            )
+            month_df.sort_values("date").reset_index(drop=True).to_pickle(path + ".tmp")
+            os.replace(path + ".tmp", path)
+            if month in coverage:
+                start = min(start, coverage[month][0])
+                end = max(end, coverage[month][1])
+            coverage[month] = (start, end)
+        self.set_coverage(parameter, coverage)
+
+    def update(self, dt_from, dt_to, parameters):
+        """
+        Fetches the intervals of [dt_from, dt_to] which are not in the store yet.
+
+        :param dt_from:
+        :param dt_to:
+        :param parameters: list of DWD parameter names
+        :return: dict of parameter to the observations of the missing intervals
+        """
+        dt_from, dt_to = self.to_utc(dt_from), self.to_utc(dt_to)
+        now = pd.Timestamp.now(tz="UTC")
+        if not self.offline:
+            # do not mark intervals as covered which are not observed yet
+            dt_to = min(dt_to, now)
+        fetched = {}
+        for parameter in parameters:
+            fetched[parameter] = []
+            for start, end in self.get_missing_intervals(dt_from, dt_to, parameter):
+                df = self.fetch(start, end, parameter)
+                if self.offline:
+                    fetched[parameter].append(df)
+                    continue
+                if end > now - self.recent_window:
+                    # recent observations may not be published yet
+                    observed = df.date[df.value.notna()]
+                    end = min(end, observed.max()) if len(observed) > 0 else None
+                if end is not None and end >= start:
+                    self.write(parameter, df, start, end)
+        return fetched
+
+    def get_weather_parameter_df(self, dt_from, dt_to, parameters):
+        """
+        Returns the tidy observations of [dt_from, dt_to] like
+        get_weather_parameter_df and fetches the intervals missing in the store.
+
+        :param dt_from:
+        :param dt_to:
+        :param parameters: list of DWD parameter names
+        :return: pd.DataFrame
+        """
+        fetched = self.update(dt_from, dt_to, parameters)
+        dt_from, dt_to = self.to_utc(dt_from), self.to_utc(dt_to)
+        dfs = []
+        for parameter in parameters:
+            for month, _, _ in self.get_months(dt_from, dt_to):
+                dfs.append(self.read_month(parameter, month))
+            dfs.extend(fetched[parameter])
+        dfs = [df for df in dfs if df is not None]
+        if len(dfs) == 0:
+            return pd.DataFrame(columns=["station_id", "parameter", "date", "value"])
+        df = pd.concat(dfs, ignore_index=True)
+        df = df[(df.date >= dt_from) & (df.date <= dt_to)]
+        return df.drop_duplicates(subset=["parameter", "date"]).reset_index(drop=True)
+
+    def to_fixture(self, path, dt_from, dt_to, parameters):
+        """
+        Writes the stored observations of [dt_from, dt_to] to a fixture file for
+        the offline mode.
+        """
+        self.get_weather_parameter_df(dt_from, dt_to, parameters).to_pickle(path)
+
+
+def pivot_weather_frame(df, dtype=np.float32):
+    """
+    Creates a wide table with one row per (date, station_id) and one column per
+    parameter from a tidy weather frame in a single pass. The rows are sorted by
+    date and station.
+
+    :param df: pd.DataFrame with the columns "station_id", "parameter", "date" and "value"
+    :param dtype: dtype of the parameter columns
+    :return: pd.DataFrame with the columns "station_id", "date" and the parameters
+    """
+    date_codes, dates = pd.factorize(df["date"], sort=True)
+    station_codes, stations = pd.factorize(df["station_id"], sort=True)
+    parameter_codes, parameters = pd.factorize(df["parameter"], sort=True)
+
+    # integer row key of (date, station)
+    keys = date_codes.astype(np.int64) * max(len(stations), 1) + station_codes
+    row_keys, rows = np.unique(keys, return_inverse=True)
+    values = np.full((len(row_keys), len(parameters)), np.nan, dtype=dtype)
+    values[rows, parameter_codes] = df["value"].values
+
+    weather_df = pd.DataFrame(
+        {
+            "station_id": stations.take(row_keys % max(len(stations), 1)),
+            "date": dates.take(row_keys // max(len(stations), 1)),
+        }
+    )
+    for i, parameter in enumerate(parameters):
+        weather_df[parameter] = values[:, i]
+    return weather_df
+
+
+def combine_weather_frames(df, dtype=np.float32):
+    """
+    Combines the parameters of a tidy weather frame to one column each, see
+    pivot_weather_frame.
+
+    :param df:
+    :param dtype:
+    :return:
+    """
+    return pivot_weather_frame(
+        df.drop(columns=["quality", "dataset"], errors="ignore"), dtype=dtype
     )
-    return df_merged
 
 
 def get_weather_frame(
@@ -57,11 +309,25 @@ def get_weather_frame(
     dt_to,
     station_name="Berlin-Tempelhof",
     weather_params=["wind_speed", "temperature_air_mean_200"],
+    weather_store=None,
 ):
-    df = get_weather_parameter_df(
-        dt_from, dt_to, parameter=weather_params, station_name=station_name
-    )
-    df.drop(columns=["quality", "dataset"], inplace=True)
+    """
+
+    :param dt_from:
+    :param dt_to:
+    :param station_name:
+    :param weather_params:
+    :param weather_store: WeatherStore of the station, the observations are
+        requested from DWD directly if None
+    :return:
+    """
+    if weather_store is None:
+        df = get_weather_parameter_df(
+            dt_from, dt_to, parameter=weather_params, station_name=station_name
+        )
+    else:
+        df = weather_store.get_weather_parameter_df(dt_from, dt_to, weather_params)
+    df = df.drop(columns=["quality", "dataset"], errors="ignore")
     weather_df = combine_weather_frames(df)
     return weather_df
 
@@ -120,8 +386,55 @@ def create_min_max_ccr_df_per_bee(bee_id, cc_df):
     return df_corr
 
 
+def get_day_grid(
+    datetimes, values, dt_from, n_days, step=datetime.timedelta(minutes=10)
+):
+    """
+    Averages values on a grid of n_days days from dt_from with the given step,
+    the datetimes are rounded to the step as in combine_weather_velocity_dfs.
+
+    :param datetimes: pd.Series of datetimes
+    :param values: np.array of shape (N,) or (N, n_columns)
+    :param dt_from: start of the first day
+    :param n_days:
+    :param step:
+    :return: np.array of shape (n_days, steps per day) or (n_columns, n_days,
+        steps per day) with NaN where there are no values
+    """
+    values = np.asarray(values, dtype=np.float64)
+    is_series = values.ndim == 1
+    values = values.reshape(len(values), -1)
+    steps_per_day = int(datetime.timedelta(days=1) / step)
+    n_steps = n_days * steps_per_day
+
+    # round half to even to the step like pd.Series.dt.round
+    step_ns = pd.Timedelta(step).value
+    steps, remainder = np.divmod(utils.get_utc_nanoseconds(datetimes), step_ns)
+    steps += (2 * remainder > step_ns) | ((2 * remainder == step_ns) & (steps % 2 == 1))
+    slots = steps - utils.get_utc_nanoseconds(dt_from) // step_ns
+    valid = (slots >= 0) & (slots < n_steps)
+
+    grid = np.full((values.shape[1], n_steps), np.nan)
+    for i in range(values.shape[1]):
+        is_value = valid & np.isfinite(values[:, i])
+        counts = np.bincount(slots[is_value], minlength=n_steps)
+        sums = np.bincount(
+            slots[is_value], weights=values[is_value, i], minlength=n_steps
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            grid[i] = sums / counts
+    grid = grid.reshape(values.shape[1], n_days, steps_per_day)
+    return grid[0] if is_series else grid
+
+
 def create_ccr_df_per_bee_from_period(
-    bee_id, dt_from, dt_to, velocity_weather_df, delta=datetime.timedelta(days=1)
+    bee_id,
+    dt_from,
+    dt_to,
+    velocity_weather_df,
+    delta=datetime.timedelta(days=1),
+    age_index=None,
+    stationarity_tester=None,
 ):
     """
 
@@ -130,14 +443,17 @@ def create_ccr_df_per_bee_from_period(
     :param dt_to:
     :param velocity_weather_df:
     :param delta:
+    :param age_index: utils.BeeAgeIndex, fetched for the bee if None
+    :param stationarity_tester: statistics.StationarityTester, e.g. with the
+        weather tests precomputed, see precompute_weather_stationarity
     :return:
     """
     dates = list(pd.date_range(start=dt_from, end=dt_to, tz=pytz.UTC).to_pydatetime())
+    if age_index is None:
+        age_index = utils.BeeAgeIndex.from_db([bee_id], dates[0], dates[-1])
     cross_correlations_dfs = []
-    for current_dt in dates:
-        bee_age = int(
-            bb_behavior.db.metadata.get_bee_ages([(bee_id, current_dt.date())])[0][2]
-        )
+    for current_dt, bee_age in zip(dates, age_index.get_ages(bee_id, dates)):
+        bee_age = int(bee_age)
         if bee_age < 1:
             print("Bee age: %d" % bee_age)
             continue
@@ -149,7 +465,7 @@ def create_ccr_df_per_bee_from_period(
             print("No velocities for %s" % str(current_dt))
             continue
         cross_correlation_df = statistics.apply_time_lagged_cross_correlation_to_df(
-            velocity_weather_df_day
+            velocity_weather_df_day, tester=stationarity_tester
         )
         if cross_correlation_df is None:
             print("df: %s" % str(velocity_weather_df_day))
@@ -164,8 +480,60 @@ def create_ccr_df_per_bee_from_period(
     return cc_df
 
 
+def precompute_weather_stationarity(
+    weather_df,
+    dt_from,
+    dt_to,
+    delta=datetime.timedelta(days=1),
+    stationarity_tester=None,
+):
+    """
+    Tests all weather parameters of all days once for stationarity, so that the
+    bee independent tests are taken from the cache of the tester in
+    create_ccr_df_per_bee_from_period. The tester can be passed to the workers
+    of runner.run_per_bee_jobs as a shared input.
+
+    :param weather_df: wide weather frame with "date" and one column per parameter
+    :param dt_from:
+    :param dt_to:
+    :param delta:
+    :param stationarity_tester: statistics.StationarityTester, a new one if None
+    :return: statistics.StationarityTester
+    """
+    if stationarity_tester is None:
+        stationarity_tester = statistics.StationarityTester()
+    weather_df = weather_df.drop(
+        columns=["station_id", "lat", "long"], errors="ignore"
+    ).set_index("date")
+    series_lst = []
+    for current_dt in pd.date_range(start=dt_from, end=dt_to, tz=pytz.UTC):
+        weather_df_day = weather_df[
+            (weather_df.index >= current_dt) & (weather_df.index < current_dt + delta)
+        ]
+        for column in weather_df_day.columns:
+            series_lst.append(
+                weather_df_day[column]
+                .replace({np.inf: np.nan, -np.inf: np.nan})
+                .dropna()
+                .values
+            )
+    stationarity_tester.precompute(series_lst)
+    return stationarity_tester
+
+
 def calculate_weather_activity_cross_correlation(
-    bee_id, dt_from, dt_to, weather_df_path=None, velocity_df_path=None, cc_path=None
+    bee_id,
+    dt_from,
+    dt_to,
+    weather_df_path=None,
+    velocity_df_path=None,
+    cc_path=None,
+    age_index=None,
+    weather_df=None,
+    weather_store=None,
+    weather_params=["wind_speed", "temperature_air_mean_200"],
+    stationarity_tester=None,
+    cache=None,
 ):
     """
 
@@ -175,15 +543,32 @@ def calculate_weather_activity_cross_correlation(
     :param weather_df_path:
     :param velocity_df_path:
     :param cc_path:
+    :param age_index: utils.BeeAgeIndex, fetched for the bee if None
+    :param weather_df: weather frame to use instead of reading weather_df_path
+    :param weather_store: WeatherStore to read the weather_params of the period
+        from instead of reading weather_df_path
+    :param weather_params:
+    :param stationarity_tester: statistics.StationarityTester
+    :param cache: utils.VelocityCache shared by the velocity readers of a job
     :return:
     """
     # fetch weather df
-    weather_df = pd.read_pickle(weather_df_path)
-    weather_df.drop(columns=["lat", "long"], inplace=True)
+    if weather_df is not None:
+        weather_df = weather_df.copy()
+    elif weather_store is not None:
+        weather_df = get_weather_frame(
+            dt_from,
+            pd.Timestamp(dt_to) + datetime.timedelta(days=1),
+            weather_params=weather_params,
+            weather_store=weather_store,
+        )
+    else:
+        weather_df = pd.read_pickle(weather_df_path)
+    weather_df.drop(columns=["lat", "long"], inplace=True, errors="ignore")
 
     # fetch velocities
     velocity_df = utils.fetch_velocities_from_remote_or_db(
-        bee_id, dt_to, dt_from, velocity_df_path
+        bee_id, dt_to, dt_from, velocity_df_path, cache=cache
     )
     if velocity_df is None:
         return {None: "No velocities could be fetched"}
@@ -196,7 +581,12 @@ def calculate_weather_activity_cross_correlation(
 
     # per bee_id full cross correlation velocity and weather per day
     cc_df = create_ccr_df_per_bee_from_period(
-        bee_id, dt_from, dt_to, velocity_weather_df
+        bee_id,
+        dt_from,
+        dt_to,
+        velocity_weather_df,
+        age_index=age_index,
+        stationarity_tester=stationarity_tester,
     )
     if cc_df is None:
         return {None: "Bee is dead"}
@@ -205,3 +595,137 @@ def calculate_weather_activity_cross_correlation(
     # get per bee, per day, per weather param max, min ccr
     df_corr = create_min_max_ccr_df_per_bee(bee_id, cc_df)
     return df_corr
+
+
+def create_min_max_ccr_df(
+    velocity_dfs,
+    weather_df,
+    dt_from,
+    dt_to,
+    age_index=None,
+    max_lag=None,
+    chunk_size=256,
+):
+    """
+    Maximum and minimum cross-correlation of the 10 minute mean velocities of
+    all bees with all weather parameters per day, as create_min_max_ccr_df_per_bee
+    for all bees at once. The velocities and the weather are lined up on a common
+    10 minute grid and all bee x parameter x day correlations are computed in one
+    batched FFT, see statistics.get_max_min_cross_correlation.
+
+    :param velocity_dfs: dict of bee_id to pd.DataFrame with "datetime" and "velocity"
+    :param weather_df: wide weather frame with "date" and one column per parameter
+    :param dt_from:
+    :param dt_to:
+    :param age_index: utils.BeeAgeIndex, fetched for the bees if None
+    :param max_lag: maximum lag in 10 minute steps, defaults to all lags
+    :param chunk_size: number of bees per batch
+    :return: pd.DataFrame with the columns "bee_id", "date", "age", "parameter",
+        "max_corr", "max_lag", "min_corr" and "min_lag"
+    """
+    dates = pd.date_range(start=dt_from, end=dt_to, tz=pytz.UTC)
+    bee_ids = np.array(list(velocity_dfs.keys()), dtype=np.int64)
+    parameters = [
+        column
+        for column in weather_df.columns
+        if column not in ["date", "station_id", "lat", "long"]
+    ]
+    if age_index is None:
+        age_index = utils.BeeAgeIndex.from_db(bee_ids, dates[0], dates[-1])
+
+    # (parameter, day, step) and (bee, day, step) grids
+    weather = get_day_grid(
+        weather_df["date"], weather_df[parameters].values, dates[0], len(dates)
+    )
+    velocities = np.stack(
+        [
+            get_day_grid(
+                velocity_dfs[bee_id]["datetime"],
+                velocity_dfs[bee_id]["velocity"].replace([np.inf, -np.inf], np.nan),
+                dates[0],
+                len(dates),
+            )
+            for bee_id in bee_ids
+        ]
+    ).reshape(len(bee_ids), len(dates), -1)
+
+    ccr = {}
+    for start in range(0, len(bee_ids), chunk_size):
+        chunk_ccr = statistics.get_max_min_cross_correlation(
+            velocities[start : start + chunk_size, None], weather[None], max_lag=max_lag
+        )
+        for column, values in chunk_ccr.items():
+            ccr.setdefault(column, []).append(values)
+    ccr = {column: np.concatenate(values) for column, values in ccr.items()}
+    n_pairs = np.sum(~np.isnan(velocities[:, None]) & ~np.isnan(weather[None]), axis=-1)
+
+    # (bee, parameter, day) index of the bees alive with velocities at the day
+    ages = age_index.get_ages(np.repeat(bee_ids, len(dates)), np.tile(dates, len(bee_ids)))
+    ages = ages.reshape(len(bee_ids), 1, len(dates))
+    bee_index, parameter_index, day_index = np.nonzero((ages >= 1) & (n_pairs > 0))
+    df_corr = pd.DataFrame(
+        {
+            "bee_id": bee_ids[bee_index],
+            "date": dates[day_index],
+            "age": ages[bee_index, 0, day_index],
+            "parameter": np.array(parameters, dtype=object)[parameter_index],
+        }
+    )
+    for column, values in ccr.items():
+        df_corr[column] = values[bee_index, parameter_index, day_index]
+    return df_corr.sort_values(["bee_id", "date", "parameter"]).reset_index(drop=True)
+
+
+def calculate_weather_activity_cross_correlation_batch(
+    bee_ids,
+    dt_from,
+    dt_to,
+    weather_df_path=None,
+    velocity_df_path=None,
+    age_index=None,
+    weather_df=None,
+    weather_store=None,
+    weather_params=["wind_speed", "temperature_air_mean_200"],
+    max_lag=None,
+    cache=None,
+):
+    """
+    Per bee, per day and per weather parameter max and min cross-correlation of
+    the velocities with the weather for many bees at once, see
+    create_min_max_ccr_df and calculate_weather_activity_cross_correlation.
+
+    :param bee_ids:
+    :param dt_from:
+    :param dt_to:
+    :param weather_df_path:
+    :param velocity_df_path:
+    :param age_index: utils.BeeAgeIndex, fetched for the bees if None
+    :param weather_df:
+    :param weather_store:
+    :param weather_params:
+    :param max_lag: maximum lag in 10 minute steps
+    :param cache: utils.VelocityCache shared by the velocity readers of a job
+    :return: pd.DataFrame
+    """
+    if weather_df is None and weather_store is not None:
+        weather_df = get_weather_frame(
+            dt_from,
+            pd.Timestamp(dt_to) + datetime.timedelta(days=1),
+            weather_params=weather_params,
+            weather_store=weather_store,
+        )
+    elif weather_df is None:
+        weather_df = pd.read_pickle(weather_df_path)
+
+    velocity_dfs = {}
+    for bee_id in bee_ids:
+        velocity_df = utils.fetch_velocities_from_remote_or_db(
+            bee_id, dt_to, dt_from, velocity_df_path, cache=cache
+        )
+        if velocity_df is not None and len(velocity_df) > 0:
+            velocity_dfs[bee_id] = velocity_df
+    if len(velocity_dfs) == 0:
+        return {None: "No velocities could be fetched"}
+    return create_min_max_ccr_df(
+        velocity_dfs, weather_df, dt_from, dt_to, age_index=age_index, max_lag=max_lag
+    )
@@ -0,0 +1,90 @@
+"""
+Measures the import time of the bb_rhythm modules used by fitting workers in
+fresh interpreters and checks that importing them does not load the heavy
+dependencies of plotting, image processing and weather download.
+
+    python benchmarks/import_time.py --max-seconds 2
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = [
+    "matplotlib",
+    "seaborn",
+    "skimage",
+    "cv2",
+    "wetterdienst",
+    "sklearn",
+    "statsmodels",
+    "bb_circadian",
+]
+
+WORKER_MODULES = [
+    "bb_rhythm.cosinor",
+    "bb_rhythm.diagnostics",
+    "bb_rhythm.interactions",
+    "bb_rhythm.rhythm",
+    "bb_rhythm.runner",
+    "bb_rhythm.statistics",
+    "bb_rhythm.time",
+    "bb_rhythm.utils",
+    "bb_rhythm.weather_api",
+]
+
+MEASURE_CODE = """
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(%r)
+seconds = time.perf_counter() - start
+heavy = sorted({name.split(".")[0] for name in sys.modules} & set(%r))
+print(json.dumps(dict(seconds=seconds, heavy_modules=heavy)))
+"""
+
+
+def measure_import(module, n_repeats=3):
+    """
+    :param module: module name
+    :param n_repeats: number of fresh interpreters, the fastest import is reported
+    :return: dict with the import time in seconds and the loaded heavy modules
+    """
+    results = []
+    for _ in range(n_repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", MEASURE_CODE % (module, HEAVY_MODULES)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return min(results, key=lambda result: result["seconds"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=WORKER_MODULES)
+    parser.add_argument("--n-repeats", type=int, default=3)
+    parser.add_argument(
+        "--max-seconds", type=float, default=None, help="fail if an import is slower"
+    )
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        result = measure_import(module, n_repeats=args.n_repeats)
+        too_slow = args.max_seconds is not None and result["seconds"] > args.max_seconds
+        failed |= too_slow or bool(result["heavy_modules"])
+        print(
+            "%-24s %7.3f s  %s"
+            % (
+                module,
+                result["seconds"],
+                ", ".join(result["heavy_modules"]) or "no heavy modules",
+            )
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Compares the bulk interaction path of bb_rhythm.interactions with the per frame
+query bb_behavior.db.find_interactions_in_frame on the live database and fails
+if the bee pairs or their locations differ.
+
+    python benchmarks/interaction_equivalence.py --cam-id 0 \
+        --dt-from 2019-08-20T12:00:00+00:00 --minutes 5
+"""
+import argparse
+import datetime
+import sys
+
+import numpy as np
+import pandas as pd
+
+import bb_behavior.db
+
+from bb_rhythm import interactions
+
+COLUMNS = [
+    "timestamp",
+    "bee_id0",
+    "bee_id1",
+    "x0",
+    "y0",
+    "theta0",
+    "x1",
+    "y1",
+    "theta1",
+]
+
+
+def get_per_frame_interactions(
+    cam_id, dt_from, dt_to, cursor, max_distance, min_confidence
+):
+    """
+    :return: pd.DataFrame of the interactions of find_interactions_in_frame
+    """
+    rows = []
+    frame_data = bb_behavior.db.get_frames(cam_id, dt_from, dt_to, cursor=cursor)
+    for dt, frame_id, _ in frame_data:
+        if dt >= dt_to:
+            continue
+        for i in bb_behavior.db.find_interactions_in_frame(
+            frame_id=frame_id,
+            cursor=cursor,
+            max_distance=max_distance,
+            min_confidence=min_confidence,
+        ):
+            rows.append((dt, i[1], i[2], i[5], i[6], i[7], i[8], i[9], i[10]))
+    return pd.DataFrame.from_records(rows, columns=COLUMNS)
+
+
+def get_bulk_interactions(
+    cam_id, dt_from, dt_to, connection, max_distance, min_confidence
+):
+    """
+    :return: pd.DataFrame of the interactions of fetch_interactions_bulk
+    """
+    bee_ids0, bee_ids1, timestamps, locations_bee0, locations_bee1 = (
+        interactions.fetch_interactions_bulk(
+            [cam_id],
+            dt_from,
+            dt_to,
+            connection,
+            max_distance=max_distance,
+            min_confidence=min_confidence,
+        )
+    )
+    return pd.DataFrame(
+        dict(
+            zip(
+                COLUMNS,
+                [timestamps, bee_ids0, bee_ids1, *locations_bee0.T, *locations_bee1.T],
+            )
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cam-id", type=int, default=0)
+    parser.add_argument(
+        "--dt-from", type=datetime.datetime.fromisoformat, required=True
+    )
+    parser.add_argument("--minutes", type=float, default=5)
+    parser.add_argument("--max-distance", type=float, default=14.0)
+    parser.add_argument("--min-confidence", type=float, default=0.25)
+    args = parser.parse_args()
+    dt_to = args.dt_from + datetime.timedelta(minutes=args.minutes)
+
+    connection = bb_behavior.db.get_database_connection(
+        application_name="interaction_equivalence"
+    )
+    per_frame_df = get_per_frame_interactions(
+        args.cam_id,
+        args.dt_from,
+        dt_to,
+        connection.cursor(),
+        args.max_distance,
+        args.min_confidence,
+    )
+    bulk_df = get_bulk_interactions(
+        args.cam_id,
+        args.dt_from,
+        dt_to,
+        connection,
+        args.max_distance,
+        args.min_confidence,
+    )
+
+    dfs = []
+    for df in (per_frame_df, bulk_df):
+        df = df.assign(timestamp=pd.to_datetime(df.timestamp, utc=True))
+        dfs.append(df.sort_values(COLUMNS).reset_index(drop=True))
+    equal = len(dfs[0]) == len(dfs[1])
+    if equal:
+        equal = (dfs[0][COLUMNS[:3]].values == dfs[1][COLUMNS[:3]].values).all()
+        equal &= np.allclose(
+            dfs[0][COLUMNS[3:]].values.astype(float),
+            dfs[1][COLUMNS[3:]].values.astype(float),
+        )
+    print(
+        "per frame: %d interactions, bulk: %d interactions, %s"
+        % (len(dfs[0]), len(dfs[1]), "equal" if equal else "DIFFERENT")
+    )
+    sys.exit(0 if equal else 1)
+
+
+if __name__ == "__main__":
+    main()
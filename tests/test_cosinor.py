@@ -0,0 +1,142 @@
+import numpy as np
+import pytest
+
+from bb_rhythm import cosinor
+
+DAY = 24 * 60 * 60
+
+
+def get_random_series(n_series=6, seed=0, min_samples=50, max_samples=2000):
+    """
+    Noisy circadian cosines on a minute grid of 3 days with random lengths,
+    amplitudes and phases.
+    """
+    rng = np.random.default_rng(seed)
+    timeseries_lst, velocities_lst = [], []
+    for _ in range(n_series):
+        n = rng.integers(min_samples, max_samples)
+        timeseries = np.sort(
+            rng.choice(np.arange(-1.5 * DAY, 1.5 * DAY, 60.0), n, replace=False)
+        )
+        velocities = (
+            2
+            + rng.uniform(0, 2)
+            * np.cos(2 * np.pi * timeseries / DAY + rng.uniform(-3, 3))
+            + rng.normal(0, 1, n)
+        )
+        timeseries_lst.append(timeseries)
+        velocities_lst.append(velocities)
+    return timeseries_lst, velocities_lst
+
+
+def fit_cosinor_batch(timeseries_lst, velocities_lst, **kwargs):
+    timeseries, offsets = cosinor.concatenate_series(timeseries_lst)
+    velocities, _ = cosinor.concatenate_series(velocities_lst)
+    return cosinor.fit_cosinor_batch(timeseries, velocities, offsets, **kwargs)
+
+
+def test_fit_cosinor_batch_matches_ols():
+    import statsmodels.api as sm
+
+    timeseries_lst, velocities_lst = get_random_series()
+    fits = fit_cosinor_batch(timeseries_lst, velocities_lst)
+    for i, (timeseries, velocities) in enumerate(zip(timeseries_lst, velocities_lst)):
+        beta_x, gamma_x = cosinor.get_cosinor_design(timeseries)
+        ols = sm.OLS(
+            velocities, np.column_stack([np.ones(len(timeseries)), beta_x, gamma_x])
+        ).fit()
+        np.testing.assert_allclose(fits["params"][i], ols.params, rtol=1e-8)
+        np.testing.assert_allclose(fits["cov_params"][i], ols.cov_params(), rtol=1e-8)
+        np.testing.assert_allclose(fits["RSS"][i], ols.ssr, rtol=1e-8)
+        np.testing.assert_allclose(fits["r_squared"][i], ols.rsquared, rtol=1e-8)
+        np.testing.assert_allclose(fits["p_value"][i], ols.f_pvalue, rtol=1e-6)
+
+
+def test_fit_cosinor_batch_matches_fit_cosinor_per_bee():
+    rhythm = pytest.importorskip("bb_rhythm.rhythm")
+
+    timeseries_lst, velocities_lst = get_random_series()
+    fits = fit_cosinor_batch(timeseries_lst, velocities_lst)
+    for i, (timeseries, velocities) in enumerate(zip(timeseries_lst, velocities_lst)):
+        expected = rhythm.fit_cosinor_per_bee(timeseries, velocities)
+        for key in (
+            "mesor",
+            "amplitude",
+            "phase",
+            "p_value",
+            "p_mesor",
+            "p_amplitude",
+            "ci_mesor_lower",
+            "ci_amplitude_upper",
+            "ci_acrophase_lower",
+            "r_squared",
+            "r_squared_adj",
+            "RSS",
+        ):
+            np.testing.assert_allclose(
+                fits[key][i], expected[key], rtol=1e-6, atol=1e-12, err_msg=key
+            )
+
+
+def test_too_short_series_give_nan():
+    fits = fit_cosinor_batch([np.arange(3.0) * 600], [np.ones(3)])
+    assert np.isnan(fits["mesor"][0])
+    assert fits["n_data_points"][0] == 3
+
+
+def test_fit_cosinor_sliding_window_matches_batch():
+    timeseries, velocities = [
+        values[0]
+        for values in get_random_series(n_series=1, min_samples=3000, max_samples=4000)
+    ]
+    # windows of 3 days moved by 12 hours
+    bin_edges = np.arange(-1.5 * DAY, 1.5 * DAY + 1, DAY / 2)
+    fits = cosinor.fit_cosinor_sliding_window(
+        timeseries, velocities, bin_edges, window_size=6
+    )
+    fits_short = cosinor.fit_cosinor_sliding_window(
+        timeseries, velocities, bin_edges, window_size=2
+    )
+
+    for window_fits, window_size in ((fits, 6), (fits_short, 2)):
+        timeseries_lst, velocities_lst = [], []
+        for start, end in zip(bin_edges[:-window_size], bin_edges[window_size:]):
+            is_window = (timeseries >= start) & (timeseries < end)
+            # the windows are fitted relative to their centers
+            timeseries_lst.append(timeseries[is_window] - (start + end) / 2)
+            velocities_lst.append(velocities[is_window])
+        expected = fit_cosinor_batch(timeseries_lst, velocities_lst)
+        for key in ("mesor", "amplitude", "phase", "p_value", "r_squared", "RSS"):
+            np.testing.assert_allclose(
+                window_fits[key], expected[key], rtol=1e-6, atol=1e-9, err_msg=key
+            )
+
+
+def test_fit_circadian_cosine_batch_matches_curve_fit():
+    rhythm = pytest.importorskip("bb_rhythm.rhythm")
+
+    rng = np.random.default_rng(1)
+    X_lst, Y_lst = [], []
+    for offset in (2.0, 1.0, 3.0, 0.5):
+        X = rng.uniform(-1.5 * DAY, 1.5 * DAY, 500)
+        Y = (
+            offset
+            + rng.uniform(0.5, 2) * np.cos(2 * np.pi * X / DAY + rng.uniform(-3, 3))
+            + rng.normal(0, 0.5, len(X))
+        )
+        X_lst.append(X)
+        Y_lst.append(Y)
+    X, offsets = cosinor.concatenate_series(X_lst)
+    Y, _ = cosinor.concatenate_series(Y_lst)
+    fits = cosinor.fit_circadian_cosine_batch(X, Y, offsets)
+    for i in range(len(X_lst)):
+        expected = rhythm.fit_circadian_cosine(X_lst[i], Y_lst[i])
+        amplitude, phase, offset = expected["parameters"]
+        phase = (phase + np.pi) % (2 * np.pi) - np.pi
+        np.testing.assert_allclose(
+            fits["parameters"][i], [amplitude, phase, offset], rtol=1e-4, atol=1e-6
+        )
+        for key in ("circadian_sse", "linear_sse", "constant_sse", "r_squared"):
+            np.testing.assert_allclose(
+                fits[key][i], expected[key], rtol=1e-6, err_msg=key
+            )
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+import scipy.stats
+
+from bb_rhythm import cosinor, diagnostics
+
+from test_cosinor import get_random_series
+
+
+def get_residuals():
+    timeseries_lst, velocities_lst = get_random_series(seed=2)
+    timeseries, offsets = cosinor.concatenate_series(timeseries_lst)
+    velocities, _ = cosinor.concatenate_series(velocities_lst)
+    fits = cosinor.fit_cosinor_batch(
+        timeseries, velocities, offsets, return_residuals=True
+    )
+    return timeseries, velocities, fits["resid"], offsets
+
+
+def test_residual_tests_match_per_series_tests():
+    import statsmodels.sandbox.stats.runs
+    import statsmodels.stats.stattools
+
+    _, _, residuals, offsets = get_residuals()
+    n_segments = len(offsets) - 1
+    segment_ids = cosinor.get_segment_ids(offsets)
+    dw = diagnostics.get_durbin_watson(residuals, segment_ids, n_segments)
+    p_ks = diagnostics.get_ks_normality_p_values(residuals, segment_ids, n_segments)
+    p_runs = diagnostics.get_runs_test_p_values(residuals, segment_ids, n_segments)
+    for i in range(n_segments):
+        resid = residuals[offsets[i] : offsets[i + 1]]
+        np.testing.assert_allclose(
+            dw[i], statsmodels.stats.stattools.durbin_watson(resid), rtol=1e-10
+        )
+        np.testing.assert_allclose(
+            p_ks[i],
+            scipy.stats.kstest(
+                resid, cdf=scipy.stats.norm(*scipy.stats.norm.fit(resid)).cdf
+            ).pvalue,
+            rtol=1e-8,
+        )
+        np.testing.assert_allclose(
+            p_runs[i],
+            statsmodels.sandbox.stats.runs.runstest_2samp(
+                resid[resid >= 0], resid[resid < 0]
+            )[1],
+            rtol=1e-8,
+        )
+
+
+def test_pure_error_sum_of_squares_matches_groupby():
+    timeseries, velocities, _, offsets = get_residuals()
+    n_segments = len(offsets) - 1
+    sspe, m = diagnostics.get_pure_error_sum_of_squares(
+        timeseries, velocities, cosinor.get_segment_ids(offsets), n_segments
+    )
+    for i in range(n_segments):
+        x_periodic = np.round(timeseries[offsets[i] : offsets[i + 1]] % (24 * 3600), 2)
+        y = velocities[offsets[i] : offsets[i + 1]]
+        groups = np.unique(x_periodic)
+        expected = sum(
+            ((y[x_periodic == x] - y[x_periodic == x].mean()) ** 2).sum()
+            for x in groups
+        )
+        np.testing.assert_allclose(sspe[i], expected, rtol=1e-10)
+        assert m[i] == len(groups)
+
+
+def test_goodness_of_fit_batch_matches_fit_cosinor_per_bee():
+    rhythm = pytest.importorskip("bb_rhythm.rhythm")
+
+    timeseries, velocities, residuals, offsets = get_residuals()
+    fits = diagnostics.get_cosinor_goodness_of_fit_batch(
+        timeseries, velocities, residuals, offsets
+    )
+    for i in range(len(offsets) - 1):
+        expected = rhythm.fit_cosinor_per_bee(
+            timeseries[offsets[i] : offsets[i + 1]],
+            velocities[offsets[i] : offsets[i + 1]],
+        )
+        for key in ("p_reject", "p_ks", "p_hom", "dw", "p_runs", "RSS", "SSPE"):
+            np.testing.assert_allclose(
+                fits[key][i], expected[key], rtol=1e-6, atol=1e-12, err_msg=key
+            )
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+interactions = pytest.importorskip("bb_rhythm.interactions")
+
+
+def get_random_interactions(seed=0, n=3000):
+    """
+    Per frame interactions of a few bee pairs at 3 Hz over 20 minutes.
+    """
+    rng = np.random.default_rng(seed)
+    frames = pd.date_range("2019-08-20 12:00", periods=3600, freq="333ms", tz="UTC")
+    timestamps = frames[np.sort(rng.integers(0, len(frames), n))]
+    bee_ids0 = rng.integers(0, 6, n)
+    bee_ids1 = bee_ids0 + rng.integers(1, 4, n)
+    locations_bee0 = rng.uniform(0, 300, (n, 3))
+    locations_bee1 = rng.uniform(0, 300, (n, 3))
+    return bee_ids0, bee_ids1, timestamps, locations_bee0, locations_bee1
+
+
+def sort_events(interaction_df):
+    return interaction_df.sort_values(
+        ["interaction_start", "bee_id0", "bee_id1"]
+    ).reset_index(drop=True)
+
+
+def test_find_proximity_pairs_matches_brute_force():
+    rng = np.random.default_rng(1)
+    frame_ids = np.repeat(np.arange(5) * 1000 + 7, 200)
+    x = rng.uniform(-50, 400, len(frame_ids))
+    y = rng.uniform(0, 300, len(frame_ids))
+    i, j = interactions.find_proximity_pairs(frame_ids, x, y, max_distance=14.0)
+
+    expected = set()
+    for frame_id in np.unique(frame_ids):
+        indices = np.flatnonzero(frame_ids == frame_id)
+        distances = np.hypot(
+            x[indices, None] - x[indices], y[indices, None] - y[indices]
+        )
+        first, second = np.nonzero(np.triu(distances < 14.0, k=1))
+        expected.update(zip(indices[first], indices[second]))
+    assert len(i) == len(expected)
+    assert set(zip(i, j)) == expected
+
+
+@pytest.mark.parametrize("chunk_size", ["1min", "7min"])
+def test_streaming_clusterer_matches_cluster_interactions(chunk_size):
+    bee_ids0, bee_ids1, timestamps, locations_bee0, locations_bee1 = (
+        get_random_interactions()
+    )
+    expected = interactions.cluster_interactions(
+        bee_ids0, bee_ids1, timestamps, locations_bee0, locations_bee1
+    )
+
+    clusterer = interactions.StreamingInteractionClusterer()
+    chunk_edges = pd.date_range(
+        timestamps[0].floor(chunk_size),
+        timestamps[-1] + pd.Timedelta(chunk_size),
+        freq=chunk_size,
+    )
+    interaction_dfs = []
+    for chunk_from, chunk_to in zip(chunk_edges[:-1], chunk_edges[1:]):
+        is_chunk = (timestamps >= chunk_from) & (timestamps < chunk_to)
+        interaction_dfs.append(
+            clusterer.add(
+                bee_ids0[is_chunk],
+                bee_ids1[is_chunk],
+                timestamps[is_chunk],
+                locations_bee0[is_chunk],
+                locations_bee1[is_chunk],
+                until=chunk_to,
+            )
+        )
+    interaction_dfs.append(clusterer.flush())
+    pd.testing.assert_frame_equal(
+        sort_events(pd.concat(interaction_dfs, ignore_index=True)),
+        sort_events(expected),
+    )
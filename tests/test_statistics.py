@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from bb_rhythm import statistics
+
+
+def get_random_series_lst(seed=0):
+    """
+    Random walks, stationary AR(1) series and trends of a few shared lengths.
+    """
+    rng = np.random.default_rng(seed)
+    series_lst = []
+    for n in (60, 144, 144, 144, 300, 300):
+        noise = rng.normal(0, 1, n)
+        series_lst.append(np.cumsum(noise))
+        ar = np.zeros(n)
+        for t in range(1, n):
+            ar[t] = 0.5 * ar[t - 1] + noise[t]
+        series_lst.append(ar)
+        series_lst.append(0.05 * np.arange(n) + ar)
+    return series_lst
+
+
+@pytest.mark.parametrize("regression", ["c", "ct"])
+@pytest.mark.parametrize("autolag", ["AIC", None])
+def test_adfuller_batch_matches_adfuller(regression, autolag):
+    from statsmodels.tsa.stattools import adfuller
+
+    series_lst = get_random_series_lst()
+    max_lag = None if autolag else 4
+    result = statistics.adfuller_batch(
+        series_lst, max_lag=max_lag, regression=regression, autolag=autolag
+    )
+    for i, series in enumerate(series_lst):
+        adf, p_value, used_lag, n_obs = adfuller(
+            series, maxlag=max_lag, regression=regression, autolag=autolag
+        )[:4]
+        np.testing.assert_allclose(result["adf"][i], adf, rtol=1e-6)
+        np.testing.assert_allclose(result["p_value"][i], p_value, rtol=1e-6)
+        assert result["used_lag"][i] == used_lag
+        assert result["n_obs"][i] == n_obs
+
+
+def test_adfuller_batch_skips_constant_and_short_series():
+    result = statistics.adfuller_batch([np.ones(100), np.arange(3.0)])
+    assert np.all(np.isnan(result["p_value"]))
+
+
+def test_stationarity_tester_matches_adfuller_batch():
+    series_lst = get_random_series_lst(seed=1)
+    tester = statistics.StationarityTester()
+    tester.precompute(series_lst[:5])
+    p_values = statistics.get_adf_p_values(series_lst, tester=tester)
+    np.testing.assert_array_equal(
+        p_values, statistics.adfuller_batch(series_lst)["p_value"]
+    )
+    assert tester.get_stats()["hits"] == 5
+
+
+def test_batch_cross_correlation_matches_time_lagged_cross_correlation():
+    rng = np.random.default_rng(2)
+    x = rng.normal(0, 1, (4, 144))
+    y = np.roll(x, 3, axis=1) + rng.normal(0, 0.5, x.shape)
+    ccr, lags = statistics.batch_time_lagged_cross_correlation(x, y)
+    for i in range(len(x)):
+        expected = statistics.time_lagged_cross_correlation(
+            pd.Series(x[i]), pd.Series(y[i])
+        )
+        np.testing.assert_allclose(ccr[i], expected, rtol=1e-8, atol=1e-12)
+
+    # limited lags are the central lags of the full correlation
+    ccr_limited, lags_limited = statistics.batch_time_lagged_cross_correlation(
+        x, y, max_lag=12
+    )
+    np.testing.assert_array_equal(lags_limited, np.arange(-12, 13))
+    np.testing.assert_allclose(ccr_limited, ccr[:, np.isin(lags, lags_limited)])
+
+    extremes = statistics.get_max_min_cross_correlation(x, y, max_lag=12, lag_unit=1)
+    np.testing.assert_allclose(extremes["max_corr"], ccr_limited.max(axis=1))
+    np.testing.assert_array_equal(
+        extremes["max_lag"], lags_limited[ccr_limited.argmax(axis=1)]
+    )
+    np.testing.assert_allclose(extremes["min_corr"], ccr_limited.min(axis=1))
+
+
+def test_batch_cross_correlation_leaves_out_nans():
+    rng = np.random.default_rng(3)
+    x = rng.normal(0, 1, 100)
+    y = rng.normal(0, 1, 100)
+    x[[5, 50]] = np.nan
+    is_valid = ~np.isnan(x)
+    ccr, _ = statistics.batch_time_lagged_cross_correlation(x, y)
+    # the zero lag is the correlation of the valid samples
+    np.testing.assert_allclose(
+        ccr[len(x) - 1], np.corrcoef(x[is_valid], y[is_valid])[0, 1], rtol=1e-10
+    )
@@ -0,0 +1,69 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bb_rhythm import time
+
+
+@pytest.mark.parametrize("tz", ["UTC", "Europe/Berlin"])
+def test_day_night_segmentation_matches_indexer_between_time(tz):
+    dt_from = pd.Timestamp("2019-10-25 00:00", tz="UTC")
+    dt_to = pd.Timestamp("2019-10-30 00:00", tz="UTC")
+    rng = np.random.default_rng(0)
+    # random seconds and all full minutes, i.e. the segment bounds, of the range
+    times = pd.DatetimeIndex(
+        np.sort(
+            np.concatenate(
+                [
+                    dt_from.value
+                    + rng.integers(0, (dt_to - dt_from).value, 10000)
+                    // 10**9
+                    * 10**9,
+                    pd.date_range(dt_from, dt_to, freq="1min").asi8,
+                ]
+            )
+        )
+    ).tz_localize("UTC")
+    segmentation = time.DayNightSegmentation(dt_from, dt_to, tz=tz)
+
+    # the wall clock of the time zone, which changes to winter time in the range
+    local_times = times.tz_convert(tz)
+    for segment, bounds in (("day", ("9:00", "18:00")), ("night", ("21:00", "6:00"))):
+        expected = np.zeros(len(times), dtype=bool)
+        expected[local_times.indexer_between_time(*bounds)] = True
+        np.testing.assert_array_equal(
+            segmentation.get_mask(times, segment), expected, err_msg=segment
+        )
+    labels = segmentation.get_labels(pd.Series(times))
+    np.testing.assert_array_equal(
+        segmentation.get_mask(times, "twilight"),
+        ~(segmentation.get_mask(times, "day") | segmentation.get_mask(times, "night")),
+    )
+    assert np.all(labels >= 0)
+
+
+def test_day_night_segmentation_outside_of_range():
+    segmentation = time.DayNightSegmentation(
+        datetime.datetime(2019, 8, 20, 12), datetime.datetime(2019, 8, 21, 12)
+    )
+    labels = segmentation.get_labels(
+        [datetime.datetime(2019, 8, 20, 11), datetime.datetime(2019, 8, 21, 13)]
+    )
+    np.testing.assert_array_equal(labels, [-1, -1])
+
+
+def test_day_night_segmentation_spans():
+    segmentation = time.DayNightSegmentation(
+        datetime.datetime(2019, 8, 20), datetime.datetime(2019, 8, 22)
+    )
+    starts, ends = segmentation.get_spans("night")
+    np.testing.assert_array_equal(
+        starts.tz_localize(None),
+        pd.to_datetime(["2019-08-20 00:00", "2019-08-20 21:00", "2019-08-21 21:00"]),
+    )
+    np.testing.assert_array_equal(
+        ends.tz_localize(None),
+        pd.to_datetime(["2019-08-20 06:00", "2019-08-21 06:00", "2019-08-22 00:00"]),
+    )